@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""Memory and time of building the DataCite request body for large records,
+the former pipeline (str replacements, base64 decoded to str, json.dumps,
+encoded again when sent) against payload.build_payload.
+
+Runs without a CKAN site:
+
+    python bin/benchmark_payload.py
+    python bin/benchmark_payload.py --sizes 1 10 50 --repeat 3
+"""
+import argparse
+import base64
+import collections
+import json
+import time
+import tracemalloc
+
+from ckanext.datacite_publication import payload
+
+CREATOR = '''
+    <creator>
+      <creatorName nameType="Personal">Doe {0}, Jane</creatorName>
+      <givenName>Jane</givenName>
+      <familyName>Doe {0}</familyName>
+      <nameIdentifier nameIdentifierScheme="ORCID" schemeURI="https://orcid.org">0000-0002-1825-{0:04d}</nameIdentifier>
+      <affiliation>Swiss Federal Institute for Forest, Snow and Landscape Research WSL</affiliation>
+    </creator>'''
+
+
+def make_record(size):
+    """DataCite like XML of about size bytes, indented, with many creators"""
+    head = '<?xml version="1.0" encoding="UTF-8"?>\n<resource xmlns="http://datacite.org/schema/kernel-4">\n' \
+           '  <identifier identifierType="DOI">10.12345/envidat.1</identifier>\n  <creators>'
+    tail = '\n  </creators>\n  <titles>\n    <title>Large dataset</title>\n  </titles>\n</resource>\n'
+    creators = []
+    length = len(head) + len(tail)
+    i = 0
+    while length < size:
+        creator = CREATOR.format(i % 10000)
+        creators.append(creator)
+        length += len(creator)
+        i += 1
+    return head + ''.join(creators) + tail
+
+
+def former_payload(doi, url, xml):
+    xml = xml.replace('\n', '').replace('\t', '')
+    xml_encoded = base64.b64encode(xml.encode('utf-8'))
+    data = collections.OrderedDict()
+    data['id'] = doi.strip()
+    data['type'] = 'dois'
+    data['attributes'] = collections.OrderedDict()
+    data['attributes']['event'] = ''
+    data['attributes']['doi'] = doi
+    data['attributes']['url'] = url
+    data['attributes']['xml'] = xml_encoded.decode()
+    # encoded by requests before sending
+    return json.dumps({'data': data}).encode('utf-8')
+
+
+def new_payload(doi, url, xml):
+    return payload.build_payload(doi, url, xml, update=True)
+
+
+def measure(build, xml, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        body = build('10.12345/envidat.1', 'https://www.envidat.ch/dataset/large', xml)
+        timings.append(time.perf_counter() - start)
+        del body
+    # traced separately, tracemalloc slows down the allocations
+    tracemalloc.start()
+    body = build('10.12345/envidat.1', 'https://www.envidat.ch/dataset/large', xml)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del body
+    return min(timings), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 50], help='record sizes in MB')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        xml = make_record(size * 1024 * 1024)
+        former = former_payload('10.12345/envidat.1', 'u', xml)
+        print('{0} MB record ({1} bytes, request body {2} bytes)'.format(size, len(xml), len(former)))
+        del former
+        for name, build in [('former', former_payload), ('build_payload', new_payload)]:
+            elapsed, peak = measure(build, xml, args.repeat)
+            print('  {0:>13}: {1:8.1f} ms, peak memory {2:8.1f} MB ({3:.1f}x the record)'.format(
+                name, elapsed * 1000, peak / 1024 / 1024, peak / len(xml)))
+
+
+if __name__ == '__main__':
+    main()
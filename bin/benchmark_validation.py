@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""Validation time per record of the DataCite XML, compiling the XSD for every
+record (as before) and with the compiled schema cached in the process.
+
+Runs without a CKAN site:
+
+    python bin/benchmark_validation.py --records 20
+    python bin/benchmark_validation.py --xsd /path/to/kernel-4/metadata.xsd --xml record.xml --records 200
+"""
+import argparse
+import statistics
+import time
+
+from ckantoolkit import config
+
+DEFAULT_XSD = 'https://schema.datacite.org/meta/kernel-4/metadata.xsd'
+
+DEFAULT_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<resource xmlns="http://datacite.org/schema/kernel-4"
+          xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+          xsi:schemaLocation="http://datacite.org/schema/kernel-4 http://schema.datacite.org/meta/kernel-4/metadata.xsd">
+  <identifier identifierType="DOI">10.12345/envidat.1</identifier>
+  <creators>
+    <creator>
+      <creatorName nameType="Personal">Doe, Jane</creatorName>
+      <givenName>Jane</givenName>
+      <familyName>Doe</familyName>
+    </creator>
+  </creators>
+  <titles>
+    <title xml:lang="en">Benchmark dataset</title>
+  </titles>
+  <publisher>EnviDat</publisher>
+  <publicationYear>2020</publicationYear>
+  <resourceType resourceTypeGeneral="Dataset">Dataset</resourceType>
+  <subjects>
+    <subject>benchmark</subject>
+  </subjects>
+  <descriptions>
+    <description descriptionType="Abstract">Record used to measure the validation time.</description>
+  </descriptions>
+</resource>
+'''
+
+
+def measure(validate, records):
+    timings = []
+    for i in range(records):
+        start = time.perf_counter()
+        valid, errors = validate()
+        timings.append(time.perf_counter() - start)
+        if not valid:
+            raise SystemExit('Invalid record: {0}'.format('; '.join(errors)))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--xsd', default=DEFAULT_XSD, help='XSD url or path (default DataCite kernel 4)')
+    parser.add_argument('--xml', default=None, help='DataCite XML record (default a minimal kernel 4 record)')
+    parser.add_argument('--records', type=int, default=20, help='number of validations')
+    args = parser.parse_args()
+
+    config.update({'datacite_publication.xsd.datacite': args.xsd})
+
+    from ckanext.datacite_publication import validation
+
+    xml = DEFAULT_XML
+    if args.xml:
+        with open(args.xml, 'rb') as xml_file:
+            xml = xml_file.read()
+
+    def uncached():
+        return validation.CachedSchema(args.xsd, validation.load_schema(args.xsd)).validate(xml)
+
+    def cached():
+        return validation.validate_xml(xml)
+
+    for name, validate in [('compiled per record', uncached), ('cached schema', cached)]:
+        timings = measure(validate, args.records)
+        print('{0}: {1} records, ms per record: mean {2:.2f}, median {3:.2f}, max {4:.2f}'.format(
+            name, len(timings), statistics.mean(timings) * 1000, statistics.median(timings) * 1000,
+            max(timings) * 1000))
+
+
+if __name__ == '__main__':
+    main()
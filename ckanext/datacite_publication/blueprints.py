@@ -4,7 +4,11 @@ from ckan.common import g
 import ckan.lib.base as base
 import ckan.lib.helpers as h
 
-from flask import Blueprint, request
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+
+import ckanext.datacite_publication.logic as logic
+import ckanext.datacite_publication.model as outbox
+import ckanext.datacite_publication.export as export
 
 from logging import getLogger
 
@@ -60,10 +64,38 @@ def get_blueprints(name, module):
         u'publish_resource',
         publish_resource
     )
+    blueprint.add_url_rule(
+        # 'export_doi_index',
+        u'/datacite_publication/doi_index/export',
+        u'export_doi_index',
+        export_doi_index
+    )
+
+    blueprint.add_url_rule(
+        # 'request_publication_job',
+        u'/datacite_publication/dataset/<id>/<operation>',
+        u'request_publication_job',
+        request_publication_job,
+        methods=[u'POST']
+    )
+    blueprint.add_url_rule(
+        # 'publication_job_status',
+        u'/datacite_publication/jobs/<job_id>',
+        u'publication_job_status',
+        publication_job_status
+    )
 
     return blueprint
 
 
+# actions of the JSON publication endpoints
+JOB_ACTIONS = {
+    'approve': 'datacite_approve_publication_package',
+    'publish': 'datacite_finish_publication_package',
+    'update': 'datacite_update_publication_package'
+}
+
+
 def _get_context():
     return {u"model": model, u"session": model.Session,
             u"user": g.user,
@@ -141,7 +173,9 @@ def approve_publication_package(id):
     except toolkit.ValidationError:
         toolkit.abort(400, 'Validation error')
 
-    if result.get('success', True):
+    if result.get('success', True) and result.get('pending', False):
+        h.flash_notice('DOI publication approval queued, the users will be notified.')
+    elif result.get('success', True):
         h.flash_notice('DOI publication approved.')
     else:
         error_message = 'Error approving dataset publication: \n' + result.get('error', 'Internal Exception, please '
@@ -204,7 +238,9 @@ def finish_publication_package(id):
     except toolkit.ValidationError:
         toolkit.abort(400, 'Validation error')
 
-    if result.get('success', True):
+    if result.get('success', True) and result.get('pending', False):
+        h.flash_notice('DOI publication queued, it will be sent to DataCite shortly.')
+    elif result.get('success', True):
         h.flash_notice('DOI publication finished.')
     else:
         error_message = 'Error finishing dataset publication: \n' + result.get('error',
@@ -235,7 +271,11 @@ def update_publication_package(id):
     except toolkit.ValidationError:
         toolkit.abort(400, 'Validation error')
 
-    if result.get('success', True):
+    if result.get('success', True) and result.get('unchanged', False):
+        h.flash_notice('DOI metadata unchanged, nothing to update.')
+    elif result.get('success', True) and result.get('pending', False):
+        h.flash_notice('DOI metadata update queued, it will be sent to DataCite shortly.')
+    elif result.get('success', True):
         h.flash_notice('DOI metadata updated.')
     else:
         error_message = 'Error updating dataset: \n' + result.get('error',
@@ -281,3 +321,110 @@ def publish_resource(dataset_id, id):
 
     return toolkit.redirect_to(controller='resource', action='read',
                                id=dataset_id, resource_id=id)
+
+
+def export_doi_index():
+    """Stream the DOI index rows of the site as NDJSON or CSV (admins only).
+    """
+    context = _get_context()
+
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in export.EXPORT_FORMATS:
+        toolkit.abort(400, 'Unknown export format, allowed: ' + ', '.join(export.EXPORT_FORMATS))
+
+    data_dict = {'entity_type': request.args.get('entity_type'),
+                 'date_from': request.args.get('date_from'),
+                 'date_to': request.args.get('date_to'),
+                 'include_metadata': request.args.get('include_metadata', 'false').lower() == 'true'}
+
+    log.debug("controller: export_doi_index: {0}".format(data_dict))
+
+    try:
+        rows = logic.iter_doi_index(data_dict, context)
+    except toolkit.NotAuthorized:
+        toolkit.abort(403, 'Not authorized')
+    except toolkit.ValidationError as e:
+        toolkit.abort(400, 'Validation error: {0}'.format(e.error_dict))
+
+    filename = 'doi_index.' + export_format
+    return Response(stream_with_context(export.iter_export(rows, export_format)),
+                    mimetype=export.CONTENT_TYPES[export_format],
+                    headers={'Content-Disposition': 'attachment; filename="{0}"'.format(filename)})
+
+
+def _json_error(status, error):
+    response = jsonify({'success': False, 'error': error})
+    response.status_code = status
+    return response
+
+
+def request_publication_job(id, operation):
+    """Request the approval, publication or update of a dataset, answered with JSON.
+       202 with the job id and status url when it is queued in the outbox (an unchanged update
+       is done by the job). Needs the outbox, the operations are not run synchronously by this
+       endpoint.
+    """
+    context = _get_context()
+
+    log.debug("controller: request_publication_job: {0} {1}".format(operation, id))
+
+    action = JOB_ACTIONS.get(operation)
+    if not action:
+        return _json_error(404, 'Unknown operation, allowed: ' + ', '.join(JOB_ACTIONS))
+    if not outbox.is_enabled():
+        return _json_error(501, 'Publication jobs need the outbox (datacite_publication.outbox = true), '
+                                'use the dataset pages or the actions instead')
+
+    data_dict = {'id': id}
+    # retries with the same key get the result of the first request
+    if request.headers.get('Idempotency-Key'):
+        data_dict['idempotency_key'] = request.headers['Idempotency-Key']
+    if operation == 'update':
+        data_dict['force'] = toolkit.asbool((request.get_json(silent=True) or request.args).get('force', False))
+
+    try:
+        result = toolkit.get_action(action)(context, data_dict)
+    except toolkit.ObjectNotFound:
+        return _json_error(404, 'Dataset not found')
+    except toolkit.NotAuthorized:
+        return _json_error(403, 'Not authorized')
+    except toolkit.ValidationError as e:
+        return _json_error(400, e.error_dict)
+
+    if not result.get('pending', False):
+        response = jsonify(result)
+        if result.get('success', True):
+            response.status_code = 200
+        else:
+            response.status_code = 504 if result.get('deadline_exceeded', False) else 500
+        return response
+
+    status_url = h.url_for(request.blueprint + '.publication_job_status', job_id=result['outbox_id'],
+                           qualified=True)
+    response = jsonify({'success': True, 'error': None, 'job_id': result['outbox_id'], 'operation': operation,
+                        'stage': 'queued', 'status_url': status_url})
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    return response
+
+
+def publication_job_status(job_id):
+    """Status of a publication job as JSON: stage (queued, exporting, validating, sending, sent,
+       done or failed), error and timings.
+    """
+    context = _get_context()
+
+    try:
+        status = toolkit.get_action('datacite_publication_status')(context, {'id': job_id})
+    except toolkit.ObjectNotFound:
+        return _json_error(404, 'Job not found')
+    except toolkit.NotAuthorized:
+        return _json_error(403, 'Not authorized')
+    except toolkit.ValidationError as e:
+        return _json_error(400, e.error_dict)
+
+    response = jsonify(status)
+    if not status['finished']:
+        # hint for the clients polling
+        response.headers['Retry-After'] = '2'
+    return response
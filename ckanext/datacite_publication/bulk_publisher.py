@@ -0,0 +1,123 @@
+import asyncio
+import concurrent.futures
+import functools
+import time
+
+from ckantoolkit import config, asint
+
+from ckanext.datacite_publication.datacite_publisher import DatacitePublisher, Deadline, DeadlineExceeded
+
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """Rate limiter of the event loop: rate requests per second on average, bursts of up to burst requests"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class BulkPublisher(object):
+    """Publishes (POST) or updates (PUT) many DOIs in DataCite concurrently.
+
+       The event loop only schedules: the payloads are exported, validated and built and the
+       requests are sent (through the shared session of the DatacitePublisher) by a thread pool,
+       at most concurrency items at a time and rate requests per second.
+    """
+
+    def __init__(self, publisher=None, concurrency=None, rate=None, burst=None):
+        self.publisher = publisher or DatacitePublisher()
+        self.concurrency = concurrency or asint(config.get('datacite_publication.bulk.concurrency', 8))
+        self.rate = float(rate if rate is not None else config.get('datacite_publication.bulk.rate', 10))
+        self.burst = float(burst if burst is not None else config.get('datacite_publication.bulk.burst', 0))
+
+    def publish_many(self, items):
+        """Sends the items, dicts with doi, pkg, xml (exported if missing) and update (PUT instead of POST).
+           Returns a list of results (id, doi, success, error) in the same order.
+        """
+        if not items:
+            return []
+        start = time.monotonic()
+        results = asyncio.run(self._publish_many(items))
+        failed = len([result for result in results if not result['success']])
+        log.info('Bulk DataCite publication of {0} DOIs in {1:.1f}s, {2} failed'.format(
+            len(results), time.monotonic() - start, failed))
+        return results
+
+    async def _publish_many(self, items):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        bucket = TokenBucket(self.rate, self.burst)
+
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency) as executor:
+            tasks = []
+            for item in items:
+                await semaphore.acquire()
+                tasks += [asyncio.ensure_future(self._send(loop, executor, semaphore, bucket, item))]
+            return await asyncio.gather(*tasks)
+
+    def _prepare(self, item):
+        xml = item.get('xml')
+        if not xml:
+            xml = self.publisher.export_package(item['pkg'], item.get('context', {}))
+        if not self.publisher.validate_xml(xml):
+            return None
+        url = self.publisher.get_package_url(item['pkg'])
+        return self.publisher.build_payload(item['doi'], url, xml, update=item.get('update', False))
+
+    async def _send(self, loop, executor, semaphore, bucket, item):
+        doi = item['doi']
+        update = item.get('update', False)
+        result = {'id': item['pkg'].get('id'), 'doi': doi, 'success': False, 'error': None}
+        try:
+            # export, validation and payload (CPU bound) in the thread pool too, the event loop keeps
+            # scheduling the other items meanwhile
+            try:
+                payload = await loop.run_in_executor(executor, self._prepare, item)
+            except Exception as e:
+                log.error('Exception preparing the DataCite payload of {0}: {1}'.format(doi, e))
+                result['error'] = 'Exception when preparing the DataCite metadata: {0}'.format(e)
+                return result
+            if not payload:
+                result['error'] = 'Dataset XML validation failed'
+                return result
+
+            deadline = Deadline()
+            if update:
+                await bucket.acquire()
+                result['error'] = await loop.run_in_executor(executor, self.publisher.check_package_identifiers,
+                                                             doi, item['pkg'], deadline)
+            if not result['error']:
+                await bucket.acquire()
+                published_doi, error = await loop.run_in_executor(
+                    executor, functools.partial(self.publisher.send_payload, doi, payload, update=update,
+                                                deadline=deadline))
+                result['success'] = not error
+                result['error'] = error
+        except DeadlineExceeded as e:
+            result['error'] = str(e)
+        except Exception as e:
+            log.error('Exception sending {0} to DataCite: {1}'.format(doi, e))
+            result['error'] = 'Exception when publishing to DataCite: {0}'.format(e)
+        finally:
+            semaphore.release()
+        if result['error']:
+            log.error('error sending {0} to DataCite: {1}'.format(doi, result['error']))
+        return result
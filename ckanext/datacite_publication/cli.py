@@ -0,0 +1,227 @@
+import sys
+import time
+
+import click
+
+from ckantoolkit import config
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+import ckanext.datacite_publication.doi_db_schema as doi_db_schema
+import ckanext.datacite_publication.export as export
+import ckanext.datacite_publication.logic as logic
+import ckanext.datacite_publication.model as outbox
+import ckanext.datacite_publication.validation as validation
+from ckanext.datacite_publication.datacite_publisher import DatacitePublisher
+from ckanext.datacite_publication.doi_db_index import get_engine, DataciteIndexDOI
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# datasets exported and sent per bulk update action
+UPDATE_CHUNK_SIZE = 500
+
+
+def get_commands():
+    return [datacite_publication]
+
+
+def _get_index_engine(url):
+    url = url or config.get('datacite_publication.sqlalchemy.url')
+    if not url:
+        raise click.UsageError('Missing datacite_publication.sqlalchemy.url in config (or --url)')
+    return get_engine(url)
+
+
+@click.group(name='datacite-publication', short_help='DataCite publication commands')
+def datacite_publication():
+    pass
+
+
+@datacite_publication.command('init-db', short_help='Create the DOI index table and its indexes')
+@click.option('--url', default=None, help='DOI index database url, default datacite_publication.sqlalchemy.url')
+@click.option('--prefix', 'prefixes', multiple=True,
+              help='DOI prefix to register (repeatable), default datacite_publication.doi_prefix')
+@click.option('--site-id', 'site_ids', multiple=True,
+              help='CKAN site to register (repeatable), default datacite_publication.site_id')
+def init_db(url, prefixes, site_ids):
+    """Creates the doi_realisation table (and the prefix and site tables) if they do not
+       exist, then adds any missing required index. Registers the prefixes and the sites
+       the DOIs refer to and, in PostgreSQL, creates the suffix sequence of each prefix.
+    """
+    engine = _get_index_engine(url)
+    prefixes = prefixes or [prefix for prefix in [config.get('datacite_publication.doi_prefix')] if prefix]
+    site_ids = site_ids or [site_id for site_id in [config.get('datacite_publication.site_id')] if site_id]
+    created = doi_db_schema.init_db(engine)
+    for name in created:
+        click.echo('Created index {0}'.format(name))
+    added_prefixes, added_sites = doi_db_schema.add_prefixes_and_sites(engine, prefixes, site_ids)
+    for prefix in added_prefixes:
+        click.echo('Added DOI prefix {0}'.format(prefix))
+    for site_id in added_sites:
+        click.echo('Added CKAN site {0}'.format(site_id))
+    click.secho('DOI index database initialised', fg='green')
+
+
+@datacite_publication.command('check-db', short_help='Verify the DOI index table and report missing indexes')
+@click.option('--url', default=None, help='DOI index database url, default datacite_publication.sqlalchemy.url')
+@click.option('--create-missing', is_flag=True, default=False,
+              help='Create the missing indexes and drop the obsolete constraints they replace')
+def check_db(url, create_missing):
+    """Verifies the doi_realisation table against the live database."""
+    engine = _get_index_engine(url)
+
+    if create_missing:
+        for name in doi_db_schema.create_missing_indexes(engine):
+            click.echo('Created index {0}'.format(name))
+        for name in doi_db_schema.drop_obsolete_constraints(engine):
+            click.echo('Dropped obsolete constraint {0}'.format(name))
+
+    problems = doi_db_schema.check_db(engine)
+    for problem in problems:
+        click.secho(problem, fg='red')
+    if problems:
+        sys.exit(1)
+    click.secho('DOI index database OK', fg='green')
+
+
+@datacite_publication.command('export-doi-index', short_help='Export the DOI index rows of the site')
+@click.option('--format', 'export_format', type=click.Choice(export.EXPORT_FORMATS), default='ndjson')
+@click.option('--entity-type', type=click.Choice(['package', 'resource']), default=None)
+@click.option('--date-from', default=None, help='Only DOIs created since this ISO date')
+@click.option('--date-to', default=None, help='Only DOIs created before this ISO date')
+@click.option('--include-metadata', is_flag=True, default=False, help='Include the stored package metadata')
+@click.option('--output', type=click.File('w'), default='-', help='Output file, default stdout')
+def export_doi_index(export_format, entity_type, date_from, date_to, include_metadata, output):
+    """Streams all the doi_realisation rows of the configured site_id as NDJSON or CSV."""
+    try:
+        date_from = export.parse_date(date_from)
+        date_to = export.parse_date(date_to)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+    rows = DataciteIndexDOI().iter_dois(entity_type=entity_type, date_from=date_from, date_to=date_to,
+                                        include_metadata=include_metadata)
+    total = 0
+    for line in export.iter_export(rows, export_format):
+        output.write(line)
+        total += 1
+    log.info('Exported DOI index ({0} lines)'.format(total))
+
+
+def _get_published_package_ids():
+    query = model.Session.query(model.Package.id)\
+        .join(model.PackageExtra, model.PackageExtra.package_id == model.Package.id)\
+        .filter(model.Package.state == 'active')\
+        .filter(model.PackageExtra.key == 'publication_state')\
+        .filter(model.PackageExtra.value == 'published')
+    return [package_id for (package_id,) in query]
+
+
+def _get_active_package_ids():
+    query = model.Session.query(model.Package.id)\
+        .filter(model.Package.state == 'active')\
+        .filter(model.Package.type == 'dataset')
+    return [package_id for (package_id,) in query]
+
+
+@datacite_publication.command('update-dois', short_help='Update the published datasets in DataCite concurrently')
+@click.argument('ids', nargs=-1)
+@click.option('--all', 'all_published', is_flag=True, default=False, help='Update all the published datasets')
+@click.option('--force', is_flag=True, default=False, help='Send also the datasets unchanged since the last update')
+@click.option('--concurrency', type=int, default=None, help='Concurrent requests, default '
+                                                            'datacite_publication.bulk.concurrency')
+@click.option('--rate', type=float, default=None, help='Requests per second, default datacite_publication.bulk.rate')
+def update_dois(ids, all_published, force, concurrency, rate):
+    """Re-sends the metadata and url of the given (or all) published datasets to DataCite,
+       e.g. after a change of the landing page urls.
+    """
+    if all_published:
+        ids = _get_published_package_ids()
+    if not ids:
+        raise click.UsageError('Give the ids of the datasets or --all')
+
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    ids = list(ids)
+    failed = 0
+    for start in range(0, len(ids), UPDATE_CHUNK_SIZE):
+        context = {'user': site_user['name']}
+        data_dict = {'ids': ids[start:start + UPDATE_CHUNK_SIZE], 'force': force, 'concurrency': concurrency,
+                     'rate': rate}
+        result = toolkit.get_action('datacite_update_publication_package_bulk')(context, data_dict)
+
+        for dataset_result in result['results']:
+            if dataset_result.get('unchanged'):
+                click.echo('{0} {1}: unchanged'.format(dataset_result['id'], dataset_result['doi']))
+            elif dataset_result['success']:
+                click.secho('{0} {1}: updated'.format(dataset_result['id'], dataset_result['doi']), fg='green')
+            else:
+                failed += 1
+                click.secho('{0} {1}: {2}'.format(dataset_result['id'], dataset_result['doi'],
+                                                  dataset_result['error']), fg='red')
+    if failed:
+        click.secho('{0} of {1} datasets could not be updated'.format(failed, len(ids)), fg='red')
+        sys.exit(1)
+
+
+@datacite_publication.command('validate', short_help='Validate the DataCite XML of the datasets')
+@click.argument('ids', nargs=-1)
+@click.option('--all', 'all_datasets', is_flag=True, default=False, help='Validate all the active datasets')
+@click.option('--published', is_flag=True, default=False, help='Validate all the published datasets')
+@click.option('--processes', type=int, default=None, help='Validation processes, default '
+                                                          'datacite_publication.validation.processes or the cpus')
+def validate(ids, all_datasets, published, processes):
+    """Exports the DataCite XML of the given (or all) datasets and validates it against the XSD
+       in a pool of processes, e.g. as a nightly check before publishing.
+    """
+    if published:
+        ids = _get_published_package_ids()
+    elif all_datasets:
+        ids = _get_active_package_ids()
+    if not ids:
+        raise click.UsageError('Give the ids of the datasets, --all or --published')
+
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    datacite_publisher = DatacitePublisher()
+
+    def iter_records():
+        # exported here, one at a time, while the workers validate
+        for package_id in ids:
+            try:
+                yield package_id, datacite_publisher.export_package({'id': package_id}, {'user': site_user['name']})
+            except Exception as e:
+                log.error('Could not export {0}: {1}'.format(package_id, e))
+                yield package_id, ''
+
+    invalid = 0
+    for package_id, valid, errors in validation.iter_validate(iter_records(), processes=processes):
+        if valid:
+            click.echo('{0}: valid'.format(package_id))
+        else:
+            invalid += 1
+            click.secho('{0}: {1}'.format(package_id, '; '.join(errors)), fg='red')
+    if invalid:
+        click.secho('{0} of {1} datasets are not valid'.format(invalid, len(ids)), fg='red')
+        sys.exit(1)
+    click.secho('{0} datasets valid'.format(len(ids)), fg='green')
+
+
+@datacite_publication.command('outbox-worker', short_help='Send the publications and updates of the DataCite outbox')
+@click.option('--once', is_flag=True, default=False, help='Send the due entries and exit (e.g. from cron)')
+@click.option('--interval', type=float, default=10, help='Seconds between the checks for due entries')
+@click.option('--limit', type=int, default=100, help='Entries sent per check')
+def outbox_worker(once, interval, limit):
+    """Sends the DataCite publications and updates recorded in the outbox (datacite_publication.outbox),
+       retrying the failed ones with backoff. Also picks up the entries the job queue could not send.
+    """
+    outbox.setup()
+    while True:
+        sent, failed = logic.process_outbox(limit)
+        if sent or failed:
+            click.echo('DataCite outbox: {0} sent, {1} failed'.format(sent, failed))
+        if once:
+            break
+        # the next batch right away if this one was full
+        if sent + failed < limit:
+            time.sleep(interval)
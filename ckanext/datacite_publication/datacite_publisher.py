@@ -1,23 +1,296 @@
 import collections
+import datetime
+import email.utils
+import hashlib
 import json
+import os
+import random
 import requests
+import threading
+import time
 import traceback
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
-import base64
+from urllib3.exceptions import NewConnectionError
 
-from ckantoolkit import config
+from ckantoolkit import config, asint
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 from ckan.lib.helpers import url_for
 
+from lxml import etree
 
 from ckanext.package_converter.model.record import Record, XMLRecord
 from ckanext.package_converter.model.metadata_format import MetadataFormats
 
+import ckanext.datacite_publication.payload as payload
+import ckanext.datacite_publication.validation as validation
+
 import logging
 
 log = logging.getLogger(__name__)
 
+# process-wide HTTP sessions to the DataCite API, keyed by url and account, keeping the connections alive
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(datacite_url, account_name, account_password):
+    """Returns the pooled session for the DataCite API and account, created once per process"""
+    pid = os.getpid()
+    key = (datacite_url, account_name, account_password)
+    with _sessions_lock:
+        session, session_pid = _sessions.get(key, (None, None))
+        if session is None or session_pid != pid:
+            # do not close a session inherited after a fork, the parent still owns its sockets
+            pool_size = asint(config.get('datacite_publication.http.pool_size', 10))
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.auth = HTTPBasicAuth(account_name, account_password)
+            session.headers.update({'Content-Type': 'application/vnd.api+json',
+                                    'Accept': 'application/vnd.api+json'})
+            _sessions[key] = (session, pid)
+            log.debug('Created DataCite HTTP session for pid {0}: {1} (pool size {2})'.format(
+                pid, datacite_url, pool_size))
+        return session
+
+
+# operations on the DataCite API with their own timeouts
+HTTP_OPERATIONS = ['lookup', 'publish', 'update']
+
+# responses retried for the idempotent methods, a POST only when rate limited (never processed)
+IDEMPOTENT_METHODS = ['GET', 'HEAD', 'PUT', 'DELETE']
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline(object):
+    """Time limit of a whole publication (export, validation and HTTP requests), no limit if seconds is 0"""
+
+    def __init__(self, seconds=None):
+        if seconds is None:
+            seconds = asint(config.get('datacite_publication.publish_deadline', 120))
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds if seconds else None
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return self.expires - time.monotonic()
+
+    def check(self, stage):
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded('Publication deadline of {0}s exceeded before {1}'.format(self.seconds, stage))
+
+    def get_timeout(self, timeout, stage):
+        """Returns the (connect, read) timeout, limited to the remaining time"""
+        self.check(stage)
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        return min(timeout[0], remaining), min(timeout[1], remaining)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """Fails fast while the DataCite API is down: opens after failure_threshold consecutive failures
+       (errors, timeouts, 5xx responses), lets a single trial request through after reset_timeout seconds
+       and closes again when it succeeds.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self.last_failure = None
+        self.opened = None
+        self._opened_monotonic = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        return self.state == self.OPEN
+
+    def before_request(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_monotonic < self.reset_timeout:
+                    self.rejected += 1
+                    raise CircuitOpenError('DataCite API unavailable, circuit breaker open since {0} '
+                                           '(last failure: {1})'.format(self.opened, self.last_failure))
+                self.state = self.HALF_OPEN
+                log.info('Circuit breaker {0} half open, trying a request'.format(self.name))
+            if self.state == self.HALF_OPEN:
+                if self._trial:
+                    self.rejected += 1
+                    raise CircuitOpenError('DataCite API unavailable, circuit breaker waiting for a trial request')
+                self._trial = True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                log.info('Circuit breaker {0} closed'.format(self.name))
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial = False
+
+    def record_neutral(self):
+        """Ends a trial request without changing the state or the failure count (e.g. rate limited)"""
+        with self._lock:
+            self._trial = False
+
+    def record_failure(self, reason):
+        with self._lock:
+            self.failures += 1
+            self.last_failure = reason
+            self._trial = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and
+                                                self.failures >= self.failure_threshold):
+                log.error('Circuit breaker {0} open after {1} failures, last: {2}'.format(
+                    self.name, self.failures, reason))
+                self.state = self.OPEN
+                self.opened = datetime.datetime.utcnow().isoformat()
+                self._opened_monotonic = time.monotonic()
+
+    def get_state(self):
+        with self._lock:
+            retry_in = None
+            if self.state == self.OPEN:
+                retry_in = max(0, self.reset_timeout - (time.monotonic() - self._opened_monotonic))
+            return {'name': self.name, 'state': self.state, 'failures': self.failures,
+                    'failure_threshold': self.failure_threshold, 'reset_timeout': self.reset_timeout,
+                    'opened': self.opened, 'retry_in': retry_in, 'last_failure': self.last_failure,
+                    'rejected': self.rejected}
+
+
+# process-wide circuit breakers, keyed by DataCite API url
+_circuit_breakers = {}
+
+
+def get_circuit_breaker(datacite_url):
+    """Returns the circuit breaker of the DataCite API url, shared by the threads of the process"""
+    with _sessions_lock:
+        circuit_breaker = _circuit_breakers.get(datacite_url)
+        if circuit_breaker is None:
+            circuit_breaker = CircuitBreaker(
+                datacite_url,
+                failure_threshold=asint(config.get('datacite_publication.circuit_breaker.failure_threshold', 5)),
+                reset_timeout=asint(config.get('datacite_publication.circuit_breaker.reset_timeout', 60)))
+            _circuit_breakers[datacite_url] = circuit_breaker
+        return circuit_breaker
+
+
+class LookupCache(object):
+    """DataCite identifiers of the DOIs looked up recently (LRU, at most max_size), fresh for ttl seconds.
+       Expired entries keep their ETag, the DOI is then revalidated with a conditional GET.
+    """
+
+    def __init__(self, ttl=300, max_size=1000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.revalidated = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, doi):
+        """Returns (ids, etag, fresh) of the DOI, (None, None, False) if unknown"""
+        with self._lock:
+            entry = self._entries.get(doi)
+            if entry is None:
+                return None, None, False
+            self._entries.move_to_end(doi)
+            ids, etag, expires = entry
+            fresh = time.monotonic() < expires
+            if fresh:
+                self.hits += 1
+            return list(ids), etag, fresh
+
+    def put(self, doi, ids, etag=None):
+        with self._lock:
+            self._entries[doi] = (list(ids), etag, time.monotonic() + self.ttl)
+            self._entries.move_to_end(doi)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def refresh(self, doi):
+        """The DOI did not change (304), fresh again for ttl seconds"""
+        with self._lock:
+            entry = self._entries.get(doi)
+            if entry is not None:
+                self._entries[doi] = (entry[0], entry[1], time.monotonic() + self.ttl)
+                self.revalidated += 1
+
+    def invalidate(self, doi=None):
+        """Drops the DOI, or all of them"""
+        with self._lock:
+            if doi:
+                self._entries.pop(doi, None)
+            else:
+                self._entries.clear()
+
+    def get_state(self):
+        with self._lock:
+            return {'ttl': self.ttl, 'max_size': self.max_size, 'size': len(self._entries),
+                    'hits': self.hits, 'revalidated': self.revalidated}
+
+
+# process-wide lookup caches, keyed by DataCite API url
+_lookup_caches = {}
+
+
+def get_lookup_cache(datacite_url):
+    """Returns the lookup cache of the DataCite API url, None if disabled (ttl 0)"""
+    ttl = asint(config.get('datacite_publication.http.lookup_cache_ttl', 300))
+    if ttl <= 0:
+        return None
+    with _sessions_lock:
+        lookup_cache = _lookup_caches.get(datacite_url)
+        if lookup_cache is None:
+            lookup_cache = LookupCache(
+                ttl=ttl, max_size=asint(config.get('datacite_publication.http.lookup_cache_size', 1000)))
+            _lookup_caches[datacite_url] = lookup_cache
+        return lookup_cache
+
+
+def _is_connect_error(error):
+    # the request did not reach the server
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)
+
+
+def _get_retry_after(response):
+    # Retry-After in seconds or as an HTTP date
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
 
 class DatacitePublisher(plugins.SingletonPlugin):
 
@@ -27,12 +300,107 @@ class DatacitePublisher(plugins.SingletonPlugin):
         self.account_password = config.get('datacite_publication.account_password', '')
         self.url_prefix = config.get('datacite_publication.url_prefix', '')
 
-    def get_doi_identifiers(self, doi):
+        # (connect, read) timeouts in seconds per operation
+        connect_timeout = float(config.get('datacite_publication.http.connect_timeout', 5))
+        read_timeout = float(config.get('datacite_publication.http.read_timeout', 30))
+        self.timeouts = {}
+        for operation in HTTP_OPERATIONS:
+            self.timeouts[operation] = (
+                float(config.get('datacite_publication.http.{0}.connect_timeout'.format(operation), connect_timeout)),
+                float(config.get('datacite_publication.http.{0}.read_timeout'.format(operation), read_timeout)))
+
+        # retries with exponential backoff and full jitter
+        self.retries = asint(config.get('datacite_publication.http.retries', 3))
+        self.backoff = float(config.get('datacite_publication.http.backoff', 0.5))
+        self.backoff_max = float(config.get('datacite_publication.http.backoff_max', 30))
+
+    @property
+    def session(self):
+        return get_session(self.datacite_url, self.account_name, self.account_password)
+
+    @property
+    def circuit_breaker(self):
+        return get_circuit_breaker(self.datacite_url)
+
+    @property
+    def lookup_cache(self):
+        return get_lookup_cache(self.datacite_url)
+
+    def get_backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff * (2 ** attempt)))
+
+    def request(self, method, operation, url, deadline=None, **kwargs):
+        """Sends a request to the DataCite API with the timeouts of the operation, within the deadline.
+           Transient failures are retried (POST only if it did not reach DataCite or was rate limited),
+           honouring Retry-After. Raises DeadlineExceeded if the deadline expires while waiting for
+           the response and CircuitOpenError while the API is considered down.
+        """
+        deadline = deadline or Deadline(0)
+        idempotent = method in IDEMPOTENT_METHODS
+        circuit_breaker = self.circuit_breaker
+        attempt = 0
+        while True:
+            timeout = deadline.get_timeout(self.timeouts[operation], 'DataCite {0} request'.format(operation))
+            circuit_breaker.before_request()
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                circuit_breaker.record_failure(str(e))
+                if isinstance(e, requests.exceptions.Timeout):
+                    deadline.check('DataCite {0} response'.format(operation))
+                if attempt >= self.retries or not (idempotent or _is_connect_error(e)) or circuit_breaker.is_open():
+                    raise
+                wait = self.get_backoff(attempt)
+                reason = str(e)
+            except Exception as e:
+                # any other error (e.g. ChunkedEncodingError, TooManyRedirects) must end a half open trial too
+                circuit_breaker.record_failure(str(e) or type(e).__name__)
+                raise
+            else:
+                if response.status_code >= 500:
+                    circuit_breaker.record_failure('HTTP {0}'.format(response.status_code))
+                elif response.status_code == 429:
+                    # rate limited: neither a sign that the API is down nor that it recovered
+                    circuit_breaker.record_neutral()
+                else:
+                    circuit_breaker.record_success()
+                retry = response.status_code in RETRY_STATUS_CODES if idempotent else response.status_code == 429
+                if attempt >= self.retries or not retry or circuit_breaker.is_open():
+                    return response
+                retry_after = _get_retry_after(response)
+                wait = retry_after if retry_after is not None else self.get_backoff(attempt)
+                reason = 'HTTP {0}'.format(response.status_code)
+
+            remaining = deadline.remaining()
+            if remaining is not None and wait >= remaining:
+                raise DeadlineExceeded('Publication deadline of {0}s exceeded, DataCite {1} request failed ({2}) '
+                                       'and the next retry is in {3:.1f}s'.format(deadline.seconds, operation,
+                                                                                  reason, wait))
+            attempt += 1
+            log.warning('DataCite {0} request failed ({1}), retry {2}/{3} in {4:.1f}s'.format(
+                operation, reason, attempt, self.retries, wait))
+            time.sleep(wait)
+
+    def get_doi_identifiers(self, doi, deadline=None):
+        """Dataset and resource ids in the alternateIdentifiers of the DOI in DataCite. Cached for the
+           lookup cache ttl, then revalidated with If-None-Match, and dropped after our own updates.
+        """
         datacite_url_endpoint = self.datacite_url + '/' + doi
         ids = []
 
+        lookup_cache = self.lookup_cache
+        cached_ids, etag, fresh = lookup_cache.get(doi) if lookup_cache else (None, None, False)
+        if fresh:
+            log.debug("Found published ids = [{0}] for {1} (cached)".format(', '.join(cached_ids), doi))
+            return cached_ids
+
         try:
-            r = requests.get(datacite_url_endpoint)
+            headers = {'If-None-Match': etag} if etag else {}
+            r = self.request('GET', 'lookup', datacite_url_endpoint, deadline=deadline, headers=headers)
+            if r.status_code == 304 and cached_ids is not None:
+                lookup_cache.refresh(doi)
+                log.debug("Found published ids = [{0}] for {1} (not modified)".format(', '.join(cached_ids), doi))
+                return cached_ids
             if r.status_code == 200:
                 data = json.loads(r.content)
                 alternate_ids = data.get('data').get('attributes').get('alternateIdentifiers')
@@ -42,51 +410,61 @@ class DatacitePublisher(plugins.SingletonPlugin):
                         url = alt_id.get('alternateIdentifier')
                         ids += [url.rsplit('/')[-1]]
                 log.debug("Found published ids = [{0}] at {1}".format(', '.join(ids), datacite_url_endpoint))
+                if lookup_cache:
+                    lookup_cache.put(doi, ids, r.headers.get('ETag'))
                 return ids
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             log.error("get_doi_identifiers FAILED, exception: {0}".format(e))
 
         return []
 
-    def publish(self, doi, pkg=None, context={}, *args, **kwargs):
+    def invalidate_doi(self, doi):
+        """Drops the cached lookup of a DOI changed by us"""
+        lookup_cache = self.lookup_cache
+        if lookup_cache:
+            lookup_cache.invalidate(doi)
 
-        update_doi = kwargs.get('update', False)
-
-        # dataset data
-        package_id = pkg['id']
+    def get_package_url(self, pkg):
         url = config.get('ckan.site_url', '') + '/dataset/' + pkg.get('name', pkg['id'])
-
         if self.url_prefix:
             url = self.url_prefix + pkg.get('name', pkg['id'])
+        return url
+
+    def export_package(self, pkg, context={}):
+        # get converted package, raises ObjectNotFound
+        converted_package = toolkit.get_action(
+            'package_export')(
+            context,
+            {'id': pkg['id'], 'format': 'datacite'}
+        )
+        # whitespace is normalized when building the payload
+        return converted_package
+
+    def get_publication_hash(self, xml, url):
+        """Hash of the canonical (C14N) DataCite XML and the landing page url of a DOI"""
+        xml_bytes = xml
+        if isinstance(xml, str):
+            xml_bytes = xml.encode('utf-8')
+        parser = etree.XMLParser(remove_blank_text=True)
+        canonical_xml = etree.tostring(etree.fromstring(xml_bytes, parser), method='c14n')
+        return hashlib.sha256(url.encode('utf-8') + b'\n' + canonical_xml).hexdigest()
 
-        if update_doi:
-            log.debug("*** Updating id = {0}, url = {1}".format(package_id, url))
-            # check published data match
-            published_ids = self.get_doi_identifiers(doi)
-            if published_ids and package_id not in published_ids and pkg.get('name') not in published_ids:
-                return None, 'Dataset id ({0}, {1}) do not match published ids: [{2}]'.format(package_id,
-                                                                                              pkg.get('name'),
-                                                                                              ', '.join(published_ids))
-        else:
-            log.debug(f"Publishing id = {package_id}, url = {url}")
-
-        # get converted package
-        metadata_format = 'datacite'
-
+    def validate_xml(self, xml, metadata_format='datacite'):
+        # compiled schema cached in the process
         try:
-            converted_package = toolkit.get_action(
-                'package_export')(
-                context,
-                {'id': package_id, 'format': metadata_format}
-            )
-        except toolkit.ObjectNotFound:
-            log.debug("Failed exporting package metadata, dataset not found")
-            return None, 'Dataset not found'
-
-        xml = converted_package.replace('\n', '').replace('\t', '')
-        log.debug(f"Package XML generated {xml}")
+            valid, errors = validation.validate_xml(xml, metadata_format)
+        except validation.SchemaLoadError as e:
+            log.warning(f"{e}, validating with the package converter")
+            return self._validate_record(xml, metadata_format)
+        if valid:
+            log.debug("Validation successful")
+        else:
+            log.error(f"Converted Validation FAILED: {'; '.join(errors)}")
+        return valid
 
-        # Validate        
+    def _validate_record(self, xml, metadata_format='datacite'):
         try:
             converted_record = XMLRecord.from_record(
                 Record(MetadataFormats().get_metadata_formats(metadata_format)[0], xml))
@@ -96,52 +474,64 @@ class DatacitePublisher(plugins.SingletonPlugin):
             log.error(f"Converted Validation FAILED, exception: {e}")
             traceback.print_exc()
             validation_result = False
+        return validation_result
 
-        if not validation_result:
-            return None, 'Dataset XML validation failed'
-
-        # encode 64
-        xml_bytes = xml
-        if isinstance(xml, str):
-            xml_bytes = xml.encode('utf-8')
-        xml_encoded = base64.b64encode(xml_bytes)
-
-        # prepare JSON
-        headers = {"Content-Type": "application/vnd.api+json"}
-        auth = HTTPBasicAuth(self.account_name, self.account_password)
-
-        data = collections.OrderedDict()
-        data['id'] = doi.strip()
-        data['type'] = 'dois'
-        data['attributes'] = collections.OrderedDict()
-        # TODO check for update if this state is correct
-        if update_doi:
-            data['attributes']['event'] = ""
-        else:
-            data['attributes']['event'] = "publish"
-        data['attributes']['doi'] = doi
-        data['attributes']['url'] = url
-        data['attributes']['xml'] = xml_encoded.decode()
-        args = {'data': data}
-
-        args_json = json.dumps(args)
-        log.debug(f"Args JSON for datacite {args_json}")
+    def build_payload(self, doi, url, xml, update=False):
+        """JSON body (bytes) of the DataCite REST API request publishing (POST) or updating (PUT) a DOI"""
+        return payload.build_payload(doi, url, xml, update=update)
 
+    def check_package_identifiers(self, doi, pkg, deadline=None):
+        """Returns an error if the DOI is registered in DataCite for another dataset"""
+        package_id = pkg['id']
+        published_ids = self.get_doi_identifiers(doi, deadline=deadline)
+        if published_ids and package_id not in published_ids and pkg.get('name') not in published_ids:
+            return 'Dataset id ({0}, {1}) do not match published ids: [{2}]'.format(package_id,
+                                                                                    pkg.get('name'),
+                                                                                    ', '.join(published_ids))
+        return None
+
+    def is_doi_registered(self, doi, pkg, deadline=None):
+        """True if the DOI is registered in DataCite for the dataset (e.g. by a request that failed after
+           DataCite applied it), looked up without the cache
+        """
+        self.invalidate_doi(doi)
+        published_ids = self.get_doi_identifiers(doi, deadline=deadline)
+        return pkg['id'] in published_ids or pkg.get('name') in published_ids
+
+    def send_payload(self, doi, args_json, update=False, deadline=None):
+        """Sends the payload of a DOI to DataCite, returns (published doi, error)"""
         datacite_url_endpoint = self.datacite_url
-        if update_doi:
+        if update:
             datacite_url_endpoint = self.datacite_url + '/' + doi
         log.debug(f"REST request send to URL: {datacite_url_endpoint}")
 
-        if update_doi:
-            r = requests.put(datacite_url_endpoint, headers=headers, auth=auth, data=args_json)
-        else:
-            r = requests.post(datacite_url_endpoint, headers=headers, auth=auth, data=args_json)
+        try:
+            if update:
+                r = self.request('PUT', 'update', datacite_url_endpoint, deadline=deadline, data=args_json)
+            else:
+                r = self.request('POST', 'publish', datacite_url_endpoint, deadline=deadline, data=args_json)
+        except requests.exceptions.Timeout as e:
+            # the request may have been applied anyway
+            self.invalidate_doi(doi)
+            msg = 'DataCite API did not respond in time: {0}'.format(e)
+            log.error(msg)
+            return None, msg
+        except CircuitOpenError as e:
+            log.error(str(e))
+            return None, str(e)
+        except requests.exceptions.RequestException as e:
+            # connection refused, DNS failure, broken response... the request may have been applied too
+            self.invalidate_doi(doi)
+            msg = 'DataCite API request failed: {0}'.format(e)
+            log.error(msg)
+            return None, msg
 
         if r.status_code == 201 or r.status_code == 200:
+            self.invalidate_doi(doi)
             published_doi = r.json().get('data').get('id')
             return published_doi, None
         else:
-            if update_doi:
+            if update:
                 msg = f"Error updating DataCite: HTTP Code: {r.status_code}, error: {r.json()}"
                 log.debug(msg)
                 return None, msg
@@ -150,6 +540,50 @@ class DatacitePublisher(plugins.SingletonPlugin):
                 log.debug(msg)
                 return None, msg
 
+    def publish(self, doi, pkg=None, context={}, *args, **kwargs):
+
+        update_doi = kwargs.get('update', False)
+        deadline = kwargs.get('deadline') or Deadline()
+        # called with the stage reached (exporting, validating, sending)
+        on_stage = kwargs.get('on_stage') or (lambda stage: None)
+
+        # dataset data
+        package_id = pkg['id']
+        url = self.get_package_url(pkg)
+
+        if update_doi:
+            log.debug("*** Updating id = {0}, url = {1}".format(package_id, url))
+            # check published data match
+            error = self.check_package_identifiers(doi, pkg, deadline=deadline)
+            if error:
+                return None, error
+        else:
+            log.debug(f"Publishing id = {package_id}, url = {url}")
+
+        # get converted package, unless already exported by the caller
+        xml = kwargs.get('xml')
+        if not xml:
+            deadline.check('export')
+            on_stage('exporting')
+            try:
+                xml = self.export_package(pkg, context)
+            except toolkit.ObjectNotFound:
+                log.debug("Failed exporting package metadata, dataset not found")
+                return None, 'Dataset not found'
+        log.debug(f"Package XML generated ({len(xml)} characters)")
+
+        # Validate
+        deadline.check('validation')
+        on_stage('validating')
+        if not self.validate_xml(xml):
+            return None, 'Dataset XML validation failed'
+
+        args_json = self.build_payload(doi, url, xml, update=update_doi)
+        log.debug(f"Args JSON for datacite ({len(args_json)} bytes)")
+        on_stage('sending')
+
+        return self.send_payload(doi, args_json, update=update_doi, deadline=deadline)
+
     def publish_resource(self, doi, resource=None, package={}, context={}, *args, **kwargs):
 
         # resource data
@@ -157,6 +591,7 @@ class DatacitePublisher(plugins.SingletonPlugin):
 
         # update
         update_doi = kwargs.get('update', False)
+        deadline = kwargs.get('deadline') or Deadline()
 
         # dataset data
         package_id = package.get('name', package['id'])
@@ -169,7 +604,7 @@ class DatacitePublisher(plugins.SingletonPlugin):
         if update_doi:
             log.debug("Updating resource id = {0}, url = {1}".format(id, url))
             # check published data match
-            published_ids = self.get_doi_identifiers(doi)
+            published_ids = self.get_doi_identifiers(doi, deadline=deadline)
             if id not in published_ids:
                 return None, 'Resource id ({0}) do not match published ids: [{1}]'.format(id, ', '.join(published_ids))
         else:
@@ -178,6 +613,7 @@ class DatacitePublisher(plugins.SingletonPlugin):
         # get converted package
         metadata_format = 'datacite'
 
+        deadline.check('export')
         try:
             converted_resource = toolkit.get_action(
                 'resource_export')(
@@ -187,46 +623,14 @@ class DatacitePublisher(plugins.SingletonPlugin):
         except toolkit.ObjectNotFound:
             return None, 'Resource not found'
 
-        xml = converted_resource.replace('\n', '').replace('\t', '')
+        xml = converted_resource
 
         # Validate
-        try:
-            converted_record = XMLRecord.from_record(
-                Record(MetadataFormats().get_metadata_formats(metadata_format)[0], xml))
-            validation_result = converted_record.validate()
-            log.debug("Validation result: {0}".format(validation_result))
-        except Exception as e:
-            log.error("Converted Validation FAILED, exception: {0}".format(e))
-            traceback.print_exc()
-            validation_result = False
-
-        if not validation_result:
+        deadline.check('validation')
+        if not self.validate_xml(xml, metadata_format):
             return None, 'Dataset XML validation failed'
 
-        # encode 64
-        xml_bytes = xml
-        if isinstance(xml, str):
-            xml_bytes = xml.encode('utf-8')
-        xml_encoded = base64.b64encode(xml_bytes)
-
-        # prepare JSON
-        headers = {"Content-Type": "application/vnd.api+json"}
-        auth = HTTPBasicAuth(self.account_name, self.account_password)
-
-        data = collections.OrderedDict()
-        data['id'] = doi
-        data['type'] = 'dois'
-        data['attributes'] = collections.OrderedDict()
-        if update_doi:
-            data['attributes']['event'] = ""
-        else:
-            data['attributes']['event'] = "publish"
-        data['attributes']['doi'] = doi
-        data['attributes']['url'] = url
-        data['attributes']['xml'] = xml_encoded.decode()
-        args = {'data': data}
-
-        args_json = json.dumps(args)
+        args_json = self.build_payload(doi, url, xml, update=update_doi)
         # log.debug(args_json)
 
         datacite_url_endpoint = self.datacite_url
@@ -234,15 +638,32 @@ class DatacitePublisher(plugins.SingletonPlugin):
             datacite_url_endpoint = self.datacite_url + '/' + doi
         log.debug(" REST request send to URL: {0}".format(datacite_url_endpoint))
 
-        if update_doi:
-            r = requests.put(datacite_url_endpoint, headers=headers, auth=auth, data=args_json)
-        else:
-            r = requests.post(datacite_url_endpoint, headers=headers, auth=auth, data=args_json)
+        try:
+            if update_doi:
+                r = self.request('PUT', 'update', datacite_url_endpoint, deadline=deadline, data=args_json)
+            else:
+                r = self.request('POST', 'publish', datacite_url_endpoint, deadline=deadline, data=args_json)
+        except requests.exceptions.Timeout as e:
+            # the request may have been applied anyway
+            self.invalidate_doi(doi)
+            msg = 'DataCite API did not respond in time: {0}'.format(e)
+            log.error(msg)
+            return None, msg
+        except CircuitOpenError as e:
+            log.error(str(e))
+            return None, str(e)
+        except requests.exceptions.RequestException as e:
+            # connection refused, DNS failure, broken response... the request may have been applied too
+            self.invalidate_doi(doi)
+            msg = 'DataCite API request failed: {0}'.format(e)
+            log.error(msg)
+            return None, msg
 
         # print(r.status_code)
         # print(r.json())
 
         if r.status_code == 201 or r.status_code == 200:
+            self.invalidate_doi(doi)
             published_doi = r.json().get('data').get('id')
             return published_doi, None
         else:
@@ -1,35 +1,288 @@
 import sqlalchemy
-from sqlalchemy import and_
-
+from sqlalchemy import and_, or_
+from sqlalchemy import event, exc
+from sqlalchemy.dialects import postgresql
+
+import atexit
+import base64
+import collections
+import datetime
+import os
+import socket
+import sqlite3
 import sys
+import threading
 import traceback
 import json
+import uuid
+import zlib
 
-from ckantoolkit import config
+from ckantoolkit import config, asbool, asint, aslist
 import ckan.plugins as plugins
 
 from ckanext.datacite_publication.minter import DatacitePublicationMinter
+import ckanext.datacite_publication.doi_db_schema as doi_db_schema
+import ckanext.datacite_publication.suffix_generator as suffix_generator
 
 import logging
 
 log = logging.getLogger(__name__)
 
+DOI_REALISATION_TABLE = 'doi_realisation'
+
+# process-wide registry of engines and reflected tables, keyed by database url
+_engines = {}
+_tables = {}
+_registry_lock = threading.Lock()
+
+
+def _add_fork_protection(engine):
+    # Connections inherited from a parent process (uwsgi/gunicorn prefork) must not
+    # be reused by the child, they are invalidated on checkout and reopened.
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info['pid'] != pid:
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                'Connection record belongs to pid {0}, attempting to check out in pid {1}'.format(
+                    connection_record.info['pid'], pid))
+
+
+def _get_engine_options(url):
+    database_url = sqlalchemy.engine.url.make_url(url)
+    if database_url.get_backend_name() == 'sqlite':
+        # embedded DOI index (tests, benchmarks), connections are used from several threads
+        if database_url.database in [None, '', ':memory:']:
+            # every connection would get its own empty database, a single one is checked out at a time
+            memory_connection = sqlite3.connect(':memory:', check_same_thread=False)
+            return {'creator': lambda: memory_connection,
+                    'poolclass': sqlalchemy.pool.QueuePool, 'pool_size': 1, 'max_overflow': 0}
+        return {'connect_args': {'check_same_thread': False,
+                                 'timeout': asint(config.get('datacite_publication.sqlalchemy.sqlite_timeout', 30))},
+                'poolclass': sqlalchemy.pool.QueuePool,
+                'pool_size': asint(config.get('datacite_publication.sqlalchemy.pool_size', 5)),
+                'max_overflow': asint(config.get('datacite_publication.sqlalchemy.max_overflow', 10))}
+
+    return {'client_encoding': 'utf8',
+            'pool_size': asint(config.get('datacite_publication.sqlalchemy.pool_size', 5)),
+            'max_overflow': asint(config.get('datacite_publication.sqlalchemy.max_overflow', 10)),
+            'pool_pre_ping': asbool(config.get('datacite_publication.sqlalchemy.pool_pre_ping', True)),
+            'pool_recycle': asint(config.get('datacite_publication.sqlalchemy.pool_recycle', 3600))}
+
+
+def get_engine(url):
+    """Returns the engine for the given database url, created once per process"""
+    pid = os.getpid()
+    with _registry_lock:
+        engine, engine_pid = _engines.get(url, (None, None))
+        if engine is None or engine_pid != pid:
+            # do not dispose an engine inherited after a fork, the parent still owns its sockets
+            engine = sqlalchemy.create_engine(url, **_get_engine_options(url))
+            _add_fork_protection(engine)
+            _engines[url] = (engine, pid)
+            _tables.pop(url, None)
+            log.debug('Created DOI index engine for pid {0}: {1}'.format(pid, engine))
+        return engine
+
+
+def get_table(url, table_name=DOI_REALISATION_TABLE):
+    """Returns the reflected table for the given database url, reflected only once"""
+    engine = get_engine(url)
+    with _registry_lock:
+        tables = _tables.setdefault(url, {})
+        table = tables.get(table_name)
+        if table is None:
+            if engine.dialect.name == 'sqlite':
+                # embedded DOI index, created on first use
+                doi_db_schema.init_db(engine)
+            table = sqlalchemy.Table(table_name, sqlalchemy.MetaData(), autoload=True, autoload_with=engine)
+            tables[table_name] = table
+        return table
+
+
+# leased suffixes are not handed out in the last seconds of their lease (at most a tenth of the TTL),
+# the insert must happen before another process can reclaim them
+SUFFIX_LEASE_MARGIN = 60
+
+# new suffixes tried when the insert of a leased suffix is rejected because another process used it
+SUFFIX_CONFLICT_RETRIES = 3
+
+
+class SuffixPool(object):
+    """Suffix numbers leased by this process for a prefix and tag until expires (UTC), handed out locally"""
+
+    def __init__(self, url, prefix, tag):
+        self.url = url
+        self.prefix = prefix
+        self.tag = tag
+        self.pid = os.getpid()
+        self.lease_ids = []
+        self.expires = None
+        self.values = collections.deque()
+        self.lock = threading.Lock()
+
+    def is_expired(self, margin=0):
+        """True if the lease ends within margin seconds, other processes may reclaim the values then"""
+        return self.expires is not None and \
+            datetime.datetime.utcnow() + datetime.timedelta(seconds=margin) >= self.expires
+
+
+# process-wide suffix pools, keyed by (database url, prefix, tag)
+_suffix_pools = {}
+
+
+def get_suffix_pool(url, prefix, tag):
+    pid = os.getpid()
+    with _registry_lock:
+        pool = _suffix_pools.get((url, prefix, tag))
+        if pool is None or pool.pid != pid:
+            # the values leased by a parent process are not ours, they are reclaimed after the TTL
+            pool = SuffixPool(url, prefix, tag)
+            _suffix_pools[(url, prefix, tag)] = pool
+        return pool
+
+
+@atexit.register
+def release_suffix_leases():
+    """Expires the leases of this process so that other processes can reclaim the unused suffixes"""
+    doi_suffix_lease = doi_db_schema.doi_suffix_lease
+    pid = os.getpid()
+    for pool in list(_suffix_pools.values()):
+        if pool.pid != pid or not pool.lease_ids or not pool.values:
+            continue
+        try:
+            get_engine(pool.url).execute(doi_suffix_lease.update()
+                                         .where(doi_suffix_lease.c.lease_id.in_(pool.lease_ids))
+                                         .values(expires=datetime.datetime.utcnow()))
+            pool.values.clear()
+        except Exception as e:
+            log.warning('Could not release the DOI suffix leases {0}: {1}'.format(pool.lease_ids, e))
+
+
+METADATA_ENCODINGS = ['json', 'zlib', 'zstd']
+
+
+def _get_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError('Metadata encoding "zstd" requires the zstandard package')
+    return zstandard
+
+
+def project_metadata(metadata, fields=None):
+    """Keeps only the given top level fields of the metadata dict (all of them if no fields)"""
+    if not fields or not isinstance(metadata, dict):
+        return metadata
+    return dict((field, metadata[field]) for field in fields if field in metadata)
+
+
+def encode_metadata(metadata, encoding='json'):
+    """Serializes the metadata to be stored in doi_realisation.metadata. Compressed values
+       are stored in base64 preceded by the encoding name ('zlib:...', 'zstd:...')
+    """
+    metadata_json = json.dumps(metadata, separators=(',', ':'))
+    if encoding == 'json':
+        return metadata_json
+
+    if encoding == 'zlib':
+        compressed = zlib.compress(metadata_json.encode('utf-8'))
+    elif encoding == 'zstd':
+        compressed = _get_zstandard().ZstdCompressor().compress(metadata_json.encode('utf-8'))
+    else:
+        raise ValueError('Unknown metadata encoding "{0}", allowed: {1}'.format(encoding,
+                                                                                ', '.join(METADATA_ENCODINGS)))
+    return encoding + ':' + base64.b64encode(compressed).decode('ascii')
+
+
+def decode_metadata(value):
+    """Reads a doi_realisation.metadata value stored in any of the supported formats"""
+    if value is None or isinstance(value, (dict, list)):
+        # JSON/JSONB column
+        return value
+    if value.startswith('zlib:'):
+        return json.loads(zlib.decompress(base64.b64decode(value[len('zlib:'):])).decode('utf-8'))
+    if value.startswith('zstd:'):
+        decompressed = _get_zstandard().ZstdDecompressor().decompress(base64.b64decode(value[len('zstd:'):]))
+        return json.loads(decompressed.decode('utf-8'))
+    return json.loads(value)
+
 
 class DataciteIndexDOI(DatacitePublicationMinter):
     def __init__(self):
 
         self.prefix = config.get('datacite_publication.doi_prefix')
         self.url = config.get('datacite_publication.sqlalchemy.url')
+        # optional replica for the read only checks
+        self.read_url = config.get('datacite_publication.sqlalchemy.read_url', '')
         self.site_id = config.get('datacite_publication.site_id')
 
+        # suffixes leased in blocks by this process (0: generated by the database on insert)
+        self.suffix_block_size = asint(config.get('datacite_publication.suffix_block_size', 0))
+        self.suffix_block_ttl = asint(config.get('datacite_publication.suffix_block_ttl', 3600))
+        self.suffix_tag = config.get('datacite_publication.suffix_tag', doi_db_schema.DEFAULT_TAG)
+        # ulid: compact time ordered suffixes generated here (tag + ulid), no sequence or leasing involved
+        self.suffix_generator = config.get('datacite_publication.suffix_generator', '')
+
+        # stored metadata, all fields as plain JSON by default
+        self.metadata_fields = aslist(config.get('datacite_publication.metadata.fields', ''))
+        self.metadata_encoding = config.get('datacite_publication.metadata.encoding', 'json')
+        if self.metadata_encoding not in METADATA_ENCODINGS:
+            raise ValueError('Unknown metadata encoding "{0}", allowed: {1}'.format(
+                self.metadata_encoding, ', '.join(METADATA_ENCODINGS)))
+        if self.metadata_encoding == 'zstd':
+            _get_zstandard()
+
         # TODO: check prefix exists
-        self.con = sqlalchemy.create_engine(self.url, client_encoding='utf8')
-        self.meta = sqlalchemy.MetaData(bind=self.con, reflect=True)
 
-    def is_doi_valid(self, doi, ckan_id, entity_type='package'):
+    @property
+    def con(self):
+        return get_engine(self.url)
+
+    @property
+    def read_con(self):
+        if self.read_url:
+            return get_engine(self.read_url)
+        return self.con
+
+    @property
+    def doi_realisation(self):
+        return get_table(self.url)
+
+    def warm_up(self):
+        '''Creates the engines and reflects the DOI table so that the first request does not pay for it'''
+        self.doi_realisation
+        for engine in {self.con, self.read_con}:
+            with engine.connect() as connection:
+                connection.execute(sqlalchemy.select([sqlalchemy.literal(1)]))
+
+    def encode_metadata(self, pkg):
+        metadata = project_metadata(pkg, self.metadata_fields)
+        if isinstance(self.doi_realisation.c.metadata.type, sqlalchemy.types.JSON):
+            # JSON/JSONB column, serialized by the database driver
+            return metadata
+        return encode_metadata(metadata, self.metadata_encoding)
+
+    def get_doi_metadata(self, prefix, suffix, con=None):
+        """Returns the stored metadata of a DOI, decoded, or None if the DOI does not exist"""
+        doi_realisation = self.doi_realisation
+        clause = sqlalchemy.select([doi_realisation.c.metadata]
+                                   ).where(doi_realisation.c.prefix_id == prefix
+                                           ).where(doi_realisation.c.suffix_id == suffix)
+        row = (con or self.read_con).execute(clause).first()
+        if not row:
+            return None
+        return decode_metadata(row[0])
+
+    def is_doi_valid(self, doi, ckan_id, entity_type='package', con=None):
         prefix = doi.split('/', 1)[0]
         suffix = doi.split('/', 1)[1]
-        doi_realisation = self.meta.tables['doi_realisation']
+        doi_realisation = self.doi_realisation
 
         log.debug(
             'check_doi doi = {0}, ckan_id = {1}, entity_type = {2}, site_id = "{3}"'.format(doi, ckan_id, entity_type,
@@ -40,7 +293,7 @@ class DataciteIndexDOI(DatacitePublicationMinter):
                                    ).where(doi_realisation.c.site_id == self.site_id
                                            ).where(doi_realisation.c.ckan_entity == entity_type
                                                    ).where(doi_realisation.c.ckan_id == ckan_id)
-        results = self.con.execute(clause).fetchall()
+        results = (con or self.read_con).execute(clause).fetchall()
         log.debug(results)
         if not results:
             log.warning('CKAN ID not found ({entity_type}): {ckan_id}'.format(entity_type=entity_type, ckan_id=ckan_id))
@@ -60,9 +313,9 @@ class DataciteIndexDOI(DatacitePublicationMinter):
                                                                                            ckan_id=ckan_id))
         return False
 
-    def is_doi_existing(self, prefix, suffix):
+    def is_doi_existing(self, prefix, suffix, con=None):
 
-        doi_realisation = self.meta.tables['doi_realisation']
+        doi_realisation = self.doi_realisation
         log.debug('is_doi_existing doi = {0}/{1}'.format(prefix, suffix))
 
         clause = sqlalchemy.select([doi_realisation.c.prefix_id,
@@ -70,7 +323,7 @@ class DataciteIndexDOI(DatacitePublicationMinter):
                                    ).where(doi_realisation.c.prefix_id == prefix
                                            ).where(doi_realisation.c.suffix_id == suffix)
 
-        results = self.con.execute(clause).fetchall()
+        results = (con or self.read_con).execute(clause).fetchall()
 
         if not results:
             log.debug('FALSE')
@@ -79,15 +332,15 @@ class DataciteIndexDOI(DatacitePublicationMinter):
             log.debug('TRUE')
             return True
 
-    def is_dataset_published(self, ckan_id, entity_type):
-        doi_realisation = self.meta.tables['doi_realisation']
+    def is_dataset_published(self, ckan_id, entity_type, con=None):
+        doi_realisation = self.doi_realisation
         log.debug('is_dataset_published = {0} {1}'.format(id, entity_type))
         clause = sqlalchemy.select([doi_realisation.c.prefix_id,
                                     doi_realisation.c.suffix_id]
                                    ).where(doi_realisation.c.site_id == self.site_id
                                            ).where(doi_realisation.c.ckan_entity == entity_type
                                                    ).where(doi_realisation.c.ckan_id == ckan_id)
-        results = self.con.execute(clause).fetchall()
+        results = (con or self.read_con).execute(clause).fetchall()
         log.debug(results)
         if not results:
             log.debug('CKAN ID not found ({entity_type}): {ckan_id}'.format(entity_type=entity_type, ckan_id=ckan_id))
@@ -101,9 +354,47 @@ class DataciteIndexDOI(DatacitePublicationMinter):
             log.warning('CKAN ID already has a DOI: ' + doi)
             return True, doi
 
+    def iter_dois(self, entity_type=None, date_from=None, date_to=None, after=None, limit=None,
+                  include_metadata=False, batch_size=1000):
+        """Yields the DOI rows of the site as dicts ordered by doi_pk, using a server side cursor
+           so that memory stays flat. Filters by entity type and date_created range [date_from, date_to).
+        """
+        doi_realisation = self.doi_realisation
+        columns = [column for column in doi_realisation.columns
+                   if include_metadata or column.name != 'metadata']
+
+        clause = sqlalchemy.select(columns).where(doi_realisation.c.site_id == self.site_id)
+        if entity_type:
+            clause = clause.where(doi_realisation.c.ckan_entity == entity_type)
+        if date_from:
+            clause = clause.where(doi_realisation.c.date_created >= date_from)
+        if date_to:
+            clause = clause.where(doi_realisation.c.date_created < date_to)
+        if after:
+            clause = clause.where(doi_realisation.c.doi_pk > after)
+        clause = clause.order_by(doi_realisation.c.doi_pk)
+        if limit:
+            clause = clause.limit(limit)
+
+        connection = self.read_con.connect().execution_options(stream_results=True)
+        try:
+            result = connection.execute(clause)
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    row_dict = dict(row)
+                    row_dict['doi'] = '{0}/{1}'.format(row_dict['prefix_id'], row_dict['suffix_id'])
+                    if include_metadata:
+                        row_dict['metadata'] = decode_metadata(row_dict['metadata'])
+                    yield row_dict
+        finally:
+            connection.close()
+
     def mint(self, prefix, pkg=None, *args, **kwargs):
         # metadata
-        pkg_metadata = json.dumps(pkg)
+        pkg_metadata = self.encode_metadata(pkg)
 
         # user
         ckan_user = kwargs.get('user', 'undefined')
@@ -113,100 +404,337 @@ class DataciteIndexDOI(DatacitePublicationMinter):
         return self.mint_doi(ckan_id=pkg.get('id', "None"), ckan_user=ckan_user, ckan_name=pkg.get('name', "None"),
                              prefix=prefix, suffix=suffix, metadata=pkg_metadata, entity_type=entity_type)
 
-    def mint_doi(self, ckan_id, ckan_user, ckan_name, prefix=None, suffix=None, metadata="{}", entity_type='package'):
+    def mint_many(self, prefix, pkgs, user='undefined', *args, **kwargs):
+        """Reserves a DOI for each of the packages in a single transaction.
+           Returns a list of (doi, error) in the same order as pkgs.
+        """
+        entity_type = kwargs.get('entity', 'package')
+
+        prefix_id = self.prefix
+        if prefix:
+            prefix_id = prefix
+
+        rows = [dict(prefix_id=prefix_id, ckan_id=pkg.get('id', "None"), ckan_user=user,
+                     ckan_name=pkg.get('name', "None"), site_id=self.site_id, metadata=self.encode_metadata(pkg),
+                     ckan_entity=entity_type) for pkg in pkgs]
+        if not rows:
+            return []
+
+        log.debug("mint_many prefix = {0}, total = {1}, site_id = '{2}'".format(prefix_id, len(rows), self.site_id))
+
+        try:
+            if self.suffix_generator == 'ulid':
+                for values, suffix in zip(rows, suffix_generator.generate_ulids(len(rows))):
+                    values.update(suffix_id=self.suffix_tag + suffix, tag_id=self.suffix_tag)
+            elif self.suffix_block_size:
+                for values, suffix in zip(rows, self.take_suffixes(prefix_id, len(rows))):
+                    values.update(suffix_id=suffix, tag_id=self.suffix_tag)
+            minted = self.insert_dois(rows)
+            if self.suffix_block_size and self.suffix_generator != 'ulid':
+                for attempt in range(SUFFIX_CONFLICT_RETRIES):
+                    taken = [values for values in rows if values['ckan_id'] not in minted and
+                             self._is_leased_suffix_taken(prefix_id, values['suffix_id'], values['ckan_id'],
+                                                          entity_type)]
+                    if not taken:
+                        break
+                    log.warning('{0} leased DOI suffixes already used, retrying with other ones'.format(len(taken)))
+                    for values, suffix in zip(taken, self.take_suffixes(prefix_id, len(taken))):
+                        values['suffix_id'] = suffix
+                    minted.update(self.insert_dois(taken))
+        except Exception as e:
+            error = "Could not mint DOIs, exception: " + str(e)
+            traceback.print_exc()
+            log.error(error)
+            return [(None, error)] * len(rows)
 
-        doi_realisation = self.meta.tables['doi_realisation']
+        results = []
+        for values in rows:
+            minted_doi = minted.get(values['ckan_id'])
+            if minted_doi:
+                results += [(minted_doi[0] + '/' + minted_doi[1], None)]
+            else:
+                if self.suffix_block_size and self.suffix_generator != 'ulid':
+                    self._return_suffix(prefix_id, values['suffix_id'])
+                results += [(None, self._get_mint_conflict_error(prefix_id, None, values['ckan_id'], entity_type))]
+        return results
+
+    def mint_doi(self, ckan_id, ckan_user, ckan_name, prefix=None, suffix=None, metadata="{}", entity_type='package'):
 
         log.debug(
             "mint_doi doi = {0}/{1}, ckan_id = {2}, ckan_user= {3}, " +
             "entity_type = {4}, site_id = '{5}'".format(prefix, suffix, ckan_id, ckan_user, entity_type, self.site_id))
 
-        # check if already exists
         prefix_id = self.prefix
         if prefix:
             prefix_id = prefix
 
+        values = dict(prefix_id=prefix_id, ckan_id=ckan_id, ckan_name=ckan_name, ckan_user=ckan_user,
+                      site_id=self.site_id, metadata=metadata, ckan_entity=entity_type)
         if suffix:
-            if self.is_doi_existing(prefix_id, suffix):
-                error = "ERROR minting DOI: Already exists"
+            values['suffix_id'] = suffix
+
+        # insert row, uniqueness of the DOI and of the ckan entity is enforced by the database
+        leased_suffix = None
+        attempt = 0
+        while True:
+            try:
+                if not suffix and self.suffix_generator == 'ulid':
+                    values.update(suffix_id=self.suffix_tag + suffix_generator.generate_ulids(1)[0],
+                                  tag_id=self.suffix_tag)
+                elif not suffix and self.suffix_block_size:
+                    leased_suffix = self.take_suffixes(prefix_id, 1)[0]
+                    values.update(suffix_id=leased_suffix, tag_id=self.suffix_tag)
+                minted = self.insert_doi(values)
+                if minted or not leased_suffix or attempt >= SUFFIX_CONFLICT_RETRIES or \
+                        not self._is_leased_suffix_taken(prefix_id, leased_suffix, ckan_id, entity_type):
+                    break
+            except Exception as e:
+                error = "Could not mint DOI, exception: " + str(e)
+                traceback.print_exc()
                 log.error(error)
                 return None, error
-
-        # check if ckan_id already registered
-        has_doi, existing_doi = self.is_dataset_published(ckan_id, entity_type)
-        if has_doi:
-            error = "ERROR minting DOI: Dataset already published, DOI: " + existing_doi
-            return None, error
-
-        # insert row
-        try:
-            if suffix:
-                mint_insert = doi_realisation.insert().values(prefix_id=prefix_id, suffix_id=suffix, ckan_id=ckan_id,
-                                                              ckan_name=ckan_name, ckan_user=ckan_user,
-                                                              site_id=self.site_id, metadata=metadata,
-                                                              ckan_entity=entity_type)
-            else:
-                mint_insert = doi_realisation.insert().values(prefix_id=prefix_id, ckan_id=ckan_id, ckan_name=ckan_name,
-                                                              ckan_user=ckan_user, site_id=self.site_id,
-                                                              metadata=metadata, ckan_entity=entity_type)
-
-            log.debug(mint_insert.compile().params)
-            result = self.con.execute(mint_insert)
-            inserted_primary_key = result.inserted_primary_key[0]
-
-            clause = sqlalchemy.select([doi_realisation.c.prefix_id,
-                                        doi_realisation.c.suffix_id]
-                                       ).where(doi_realisation.c.doi_pk == inserted_primary_key)
-
-            results = self.con.execute(clause).fetchall()
-        except Exception as e:
-            error = "Could not mint DOI, exception: " + str(e)
-            traceback.print_exc()
+            attempt += 1
+            log.warning('Leased DOI suffix {0}/{1} already used, retrying with another one'.format(prefix_id,
+                                                                                                 leased_suffix))
+
+        if not minted:
+            if leased_suffix:
+                self._return_suffix(prefix_id, leased_suffix)
+            error = self._get_mint_conflict_error(prefix_id, suffix, ckan_id, entity_type)
             log.error(error)
             return None, error
 
-        log.debug(str(results))
-
-        for result in results:
-            doi = result[0] + '/' + result[1]
-            log.debug("NEW DOI = " + doi)
-            return doi, None
-
-        error = "Could not retrieve inserted DOI"
-        log.error(error)
-        return None, error
+        doi = minted[0] + '/' + minted[1]
+        log.debug("NEW DOI = " + doi)
+        return doi, None
+
+    def insert_doi(self, values):
+        """Inserts a DOI row in a single statement (PostgreSQL) or transaction (other dialects).
+           Returns the minted (prefix, suffix) or None if the DOI or the ckan entity are already registered.
+        """
+        doi_realisation = self.doi_realisation
+        returning = [doi_realisation.c.prefix_id, doi_realisation.c.suffix_id]
+
+        if self.con.dialect.name == 'postgresql':
+            mint_insert = postgresql.insert(doi_realisation).values(**values).on_conflict_do_nothing()\
+                .returning(*returning)
+            with self.con.begin() as connection:
+                row = connection.execute(mint_insert).first()
+            if not row:
+                return None
+            return str(row[0]), str(row[1])
+
+        conflict = and_(doi_realisation.c.site_id == values['site_id'],
+                        doi_realisation.c.ckan_entity == values['ckan_entity'],
+                        doi_realisation.c.ckan_id == values['ckan_id'])
+        if values.get('suffix_id'):
+            conflict = or_(conflict, and_(doi_realisation.c.prefix_id == values['prefix_id'],
+                                          doi_realisation.c.suffix_id == values['suffix_id']))
+        try:
+            with self.con.begin() as connection:
+                if connection.execute(sqlalchemy.select([doi_realisation.c.doi_pk]).where(conflict)).first():
+                    return None
+                if not values.get('suffix_id'):
+                    # done by a trigger in PostgreSQL
+                    tag = values.get('tag_id', doi_db_schema.DEFAULT_TAG)
+                    values = dict(values, suffix_id=tag + str(self._get_next_suffix_value(connection,
+                                                                                        values['prefix_id'])))
+                result = connection.execute(doi_realisation.insert().values(**values))
+                row = connection.execute(sqlalchemy.select(returning).where(
+                    doi_realisation.c.doi_pk == result.inserted_primary_key[0])).first()
+        except exc.IntegrityError as e:
+            log.debug("DOI insert rejected by the database: {0}".format(e))
+            return None
+        return str(row[0]), str(row[1])
+
+    def insert_dois(self, rows):
+        """Inserts several DOI rows with a multi-row INSERT ... RETURNING (PostgreSQL).
+           Returns a dict ckan_id: (prefix, suffix) with the rows actually inserted.
+        """
+        if self.con.dialect.name != 'postgresql':
+            minted = {}
+            for values in rows:
+                minted_doi = self.insert_doi(values)
+                if minted_doi:
+                    minted[values['ckan_id']] = minted_doi
+            return minted
+
+        doi_realisation = self.doi_realisation
+        mint_insert = postgresql.insert(doi_realisation).values(rows).on_conflict_do_nothing()\
+            .returning(doi_realisation.c.ckan_id, doi_realisation.c.prefix_id, doi_realisation.c.suffix_id)
+        with self.con.begin() as connection:
+            results = connection.execute(mint_insert).fetchall()
+        return dict((str(row[0]), (str(row[1]), str(row[2]))) for row in results)
+
+    def _get_next_suffix_value(self, connection, prefix, count=1):
+        # equivalent of the PostgreSQL sequence per prefix, the row stays locked until the transaction ends.
+        # Returns the first of count consecutive values.
+        doi_suffix_sequence = doi_db_schema.doi_suffix_sequence
+        result = connection.execute(doi_suffix_sequence.update()
+                                    .where(doi_suffix_sequence.c.prefix_id == prefix)
+                                    .values(last_value=doi_suffix_sequence.c.last_value + count))
+        if result.rowcount == 0:
+            connection.execute(doi_suffix_sequence.insert().values(prefix_id=prefix, last_value=count))
+            return 1
+        return connection.execute(sqlalchemy.select([doi_suffix_sequence.c.last_value])
+                                  .where(doi_suffix_sequence.c.prefix_id == prefix)).scalar() - count + 1
+
+    def take_suffixes(self, prefix, count):
+        """Hands out count suffixes from the blocks leased by this process, leasing new blocks if needed"""
+        pool = get_suffix_pool(self.url, prefix, self.suffix_tag)
+        margin = min(SUFFIX_LEASE_MARGIN, self.suffix_block_ttl / 10.0)
+        with pool.lock:
+            if pool.values and pool.is_expired(margin):
+                log.debug('DOI suffix lease {0} expired, dropping {1} unused suffixes'.format(pool.lease_ids,
+                                                                                            len(pool.values)))
+                pool.values.clear()
+            while len(pool.values) < count:
+                self._lease_suffix_block(pool, max(self.suffix_block_size, count - len(pool.values)))
+            return [pool.tag + str(pool.values.popleft()) for i in range(count)]
+
+    def _return_suffix(self, prefix, suffix):
+        # a leased suffix not used because the insert was rejected goes back to the pool
+        if self.is_doi_existing(prefix, suffix, con=self.con):
+            return
+        pool = get_suffix_pool(self.url, prefix, self.suffix_tag)
+        with pool.lock:
+            pool.values.appendleft(int(suffix[len(pool.tag):]))
+
+    def _lease_suffix_block(self, pool, size):
+        """Leases size suffix numbers in a single transaction, first the unused ones of expired leases,
+           then new ones from the prefix sequence
+        """
+        doi_realisation = self.doi_realisation
+        doi_suffix_lease = doi_db_schema.doi_suffix_lease
+
+        lease_id = str(uuid.uuid4())
+        owner = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        now = datetime.datetime.utcnow()
+        expires = now + datetime.timedelta(seconds=self.suffix_block_ttl)
+
+        lease_used = sqlalchemy.exists().where(and_(
+            doi_realisation.c.prefix_id == doi_suffix_lease.c.prefix_id,
+            doi_realisation.c.suffix_id == doi_suffix_lease.c.tag_id + sqlalchemy.cast(doi_suffix_lease.c.value,
+                                                                                        sqlalchemy.Text)))
+        lease_of_pool = and_(doi_suffix_lease.c.prefix_id == pool.prefix, doi_suffix_lease.c.tag_id == pool.tag)
+
+        with self.con.begin() as connection:
+            # forget the previous leases of this process and the used suffixes of expired leases
+            if pool.lease_ids:
+                connection.execute(doi_suffix_lease.delete().where(doi_suffix_lease.c.lease_id.in_(pool.lease_ids)))
+            connection.execute(doi_suffix_lease.delete().where(
+                and_(lease_of_pool, doi_suffix_lease.c.expires < now, lease_used)))
+
+            # reclaim unused suffixes, the expiration is checked again on the locked rows
+            expired = sqlalchemy.select([doi_suffix_lease.c.lease_pk]).where(
+                and_(lease_of_pool, doi_suffix_lease.c.expires < now)).order_by(doi_suffix_lease.c.value).limit(size)
+            reclaimed = connection.execute(doi_suffix_lease.update()
+                                           .where(doi_suffix_lease.c.lease_pk.in_(expired))
+                                           .where(doi_suffix_lease.c.expires < now)
+                                           .values(lease_id=lease_id, owner=owner, expires=expires)).rowcount
+
+            missing = size - reclaimed
+            if missing > 0 and connection.dialect.name == 'postgresql':
+                connection.execute(sqlalchemy.text(
+                    'INSERT INTO doi_suffix_lease (prefix_id, tag_id, value, lease_id, owner, expires) '
+                    'SELECT :prefix, :tag, nextval(get_doi_sequence_name(:prefix)), :lease_id, :owner, :expires '
+                    'FROM generate_series(1, :missing)'),
+                    prefix=pool.prefix, tag=pool.tag, lease_id=lease_id, owner=owner, expires=expires,
+                    missing=missing)
+            elif missing > 0:
+                first_value = self._get_next_suffix_value(connection, pool.prefix, count=missing)
+                connection.execute(doi_suffix_lease.insert(),
+                                   [dict(prefix_id=pool.prefix, tag_id=pool.tag, value=first_value + i,
+                                         lease_id=lease_id, owner=owner, expires=expires) for i in range(missing)])
+
+            values = [row[0] for row in connection.execute(
+                sqlalchemy.select([doi_suffix_lease.c.value]).where(doi_suffix_lease.c.lease_id == lease_id)
+                .order_by(doi_suffix_lease.c.value))]
+
+        log.debug('Leased {0} DOI suffixes for {1}/{2}* ({3} reclaimed), lease {4}'.format(
+            len(values), pool.prefix, pool.tag, reclaimed, lease_id))
+        pool.lease_ids = [lease_id]
+        pool.expires = expires
+        pool.values.extend(values)
+
+    def _is_leased_suffix_taken(self, prefix, suffix, ckan_id, entity_type):
+        # the insert of a leased suffix was rejected because the suffix is used (by another process
+        # that reclaimed it), not because the entity already has a DOI: it can be retried with another one
+        return self.is_doi_existing(prefix, suffix, con=self.con) and \
+            not self.is_dataset_published(ckan_id, entity_type, con=self.con)[0]
+
+    def _get_mint_conflict_error(self, prefix, suffix, ckan_id, entity_type):
+        # only called after a rejected insert, to report the reason
+        if suffix and self.is_doi_existing(prefix, suffix, con=self.con):
+            return "ERROR minting DOI: Already exists"
+        has_doi, existing_doi = self.is_dataset_published(ckan_id, entity_type, con=self.con)
+        if has_doi:
+            return "ERROR minting DOI: Dataset already published, DOI: " + existing_doi
+        return "ERROR minting DOI: Already exists"
 
     def update(self, prefix, pkg=None, *args, **kwargs):
         # metadata
-        pkg_metadata = json.dumps(pkg)
+        pkg_metadata = self.encode_metadata(pkg)
 
         # user
         ckan_user = kwargs.get('user', 'undefined')
         suffix = kwargs.get('suffix', None)
         entity_type = kwargs.get('entity', 'package')
+        datacite_hash = kwargs.get('datacite_hash', None)
 
         return self.update_doi(ckan_id=pkg.get('id', "None"), ckan_user=ckan_user, ckan_name=pkg.get('name', "None"),
-                             prefix=prefix, suffix=suffix, metadata=pkg_metadata, entity_type=entity_type)
+                             prefix=prefix, suffix=suffix, metadata=pkg_metadata, entity_type=entity_type,
+                             datacite_hash=datacite_hash)
+
+    def get_datacite_hash(self, prefix, suffix, con=None, primary=False):
+        """Returns the hash of the last DataCite publication of the DOI, None if unknown. Read from the
+           primary database with primary=True, when it decides whether DataCite is written (a lagging
+           replica would skip a needed update).
+        """
+        doi_realisation = self.doi_realisation
+        if 'datacite_hash' not in doi_realisation.c:
+            return None
+        clause = sqlalchemy.select([doi_realisation.c.datacite_hash]
+                                   ).where(doi_realisation.c.prefix_id == prefix
+                                           ).where(doi_realisation.c.suffix_id == suffix)
+        row = (con or (self.con if primary else self.read_con)).execute(clause).first()
+        if not row:
+            return None
+        return row[0]
+
+    def set_datacite_hash(self, prefix, suffix, datacite_hash):
+        """Records the hash of what was sent to DataCite for a DOI (e.g. its first publication),
+           returns False if the DOI does not exist or the index has no datacite_hash column
+        """
+        doi_realisation = self.doi_realisation
+        if 'datacite_hash' not in doi_realisation.c:
+            return False
+        result = self.con.execute(doi_realisation.update()
+                                  .where(doi_realisation.c.prefix_id == prefix)
+                                  .where(doi_realisation.c.suffix_id == suffix)
+                                  .values(datacite_hash=datacite_hash))
+        return result.rowcount == 1
 
-    def update_doi(self, ckan_id, ckan_user, ckan_name, prefix=None, suffix=None, metadata="{}", entity_type='package'):
+    def update_doi(self, ckan_id, ckan_user, ckan_name, prefix=None, suffix=None, metadata="{}", entity_type='package',
+                   datacite_hash=None):
 
         doi = prefix + "/" + suffix
 
         # check database
-        doi_realisation = self.meta.tables['doi_realisation']
+        doi_realisation = self.doi_realisation
 
         log.debug(
             "update_doi doi = {0}/{1}, ckan_id = {2}, ckan_user= {3}, " +
             "entity_type = {4}, site_id = '{5}'".format(prefix, suffix, ckan_id, ckan_user, entity_type, self.site_id))
 
-        # check if already exists
-        if not self.is_doi_existing(prefix, suffix):
+        # check if already exists, on the primary database (read-your-writes)
+        if not self.is_doi_existing(prefix, suffix, con=self.con):
             error = "ERROR updating DOI: Does not exist"
             log.error(error)
             return None, error
 
         # check if ckan_id registered to that doi
-        has_doi, existing_doi = self.is_dataset_published(ckan_id, entity_type)
+        has_doi, existing_doi = self.is_dataset_published(ckan_id, entity_type, con=self.con)
         if not has_doi:
             error = "ERROR updating DOI: {0} ({1}) not yet published".format(entity_type, ckan_id)
             return None, error
@@ -222,7 +750,10 @@ class DataciteIndexDOI(DatacitePublicationMinter):
                 .where((and_(doi_realisation.c.ckan_id == ckan_id,
                        doi_realisation.c.prefix_id == prefix,
                        doi_realisation.c.suffix_id == suffix)))\
-                .values(ckan_name=ckan_name, ckan_user=ckan_user, metadata=metadata)
+                .values(ckan_name=ckan_name, ckan_user=ckan_user, metadata=metadata,
+                        date_modified=sqlalchemy.func.current_timestamp())
+            if datacite_hash and 'datacite_hash' in doi_realisation.c:
+                mint_update = mint_update.values(datacite_hash=datacite_hash)
 
             # log.debug(mint_update.compile().params)
             result = self.con.execute(mint_update)
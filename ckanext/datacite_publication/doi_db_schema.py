@@ -0,0 +1,307 @@
+import sqlalchemy
+from sqlalchemy import Table, Column, Integer, BigInteger, Text, DateTime, Enum, MetaData, DDL
+from sqlalchemy import UniqueConstraint, Index, ForeignKey, event
+from sqlalchemy.dialects import postgresql
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# Definition of the DOI index database, matching public/create_db_script.sql/doi_envidat_create.sql
+metadata = MetaData()
+
+# default tag of the generated suffixes (tag + sequence number or ulid), also expected by the suffix checks
+DEFAULT_TAG = 'envidat.'
+
+ckan_site = Table(
+    'ckan_site', metadata,
+    Column('site_pk', Integer, primary_key=True),
+    Column('site_id', Text, nullable=False),
+    Column('url', Text),
+    Column('description', Text),
+    UniqueConstraint('site_id', name='unique_ckan_site_id'),
+)
+
+doi_prefix = Table(
+    'doi_prefix', metadata,
+    Column('prefix_pk', Integer, primary_key=True),
+    Column('prefix_id', Text, nullable=False),
+    Column('description', Text),
+    UniqueConstraint('prefix_id', name='unique_ckan_prefix_id'),
+)
+
+doi_realisation = Table(
+    'doi_realisation', metadata,
+    Column('doi_pk', Integer, primary_key=True),
+    Column('prefix_id', Text, ForeignKey('doi_prefix.prefix_id', name='prefix_fk'), nullable=False),
+    Column('suffix_id', Text, nullable=False),
+    Column('ckan_id', Text().with_variant(postgresql.UUID(), 'postgresql'), nullable=False),
+    Column('ckan_name', Text, nullable=False),
+    Column('site_id', Text, ForeignKey('ckan_site.site_id', name='site_id_fk'), nullable=False),
+    Column('tag_id', Text, nullable=False, server_default=DEFAULT_TAG),
+    Column('ckan_user', Text, nullable=False, server_default='admin'),
+    Column('metadata', Text, nullable=False),
+    Column('metadata_format', Text, server_default='ckan'),
+    # sha256 of the url and canonical XML last sent to DataCite
+    Column('datacite_hash', Text),
+    Column('ckan_entity', Enum('package', 'resource', name='ckan_entity_type'), nullable=False,
+           server_default='package'),
+    Column('date_created', DateTime, nullable=False, server_default=sqlalchemy.text('CURRENT_TIMESTAMP')),
+    Column('date_modified', DateTime, nullable=False, server_default=sqlalchemy.text('CURRENT_TIMESTAMP')),
+    # DOI lookups (is_doi_existing, minting conflicts)
+    UniqueConstraint('prefix_id', 'suffix_id', name='unique_doi'),
+    # entity lookups (is_doi_valid, is_dataset_published, minting conflicts)
+    UniqueConstraint('ckan_id', 'site_id', 'ckan_entity', name='unique_ckan_id_site_entity'),
+    # listing of the DOIs of a site
+    Index('doi_realisation_site_entity_created_idx', 'site_id', 'ckan_entity', 'date_created'),
+)
+
+# Suffix numbers leased in blocks by the minting processes (datacite_publication.suffix_block_size),
+# the unused ones are reclaimed by other processes once the lease expires
+doi_suffix_lease = Table(
+    'doi_suffix_lease', metadata,
+    Column('lease_pk', Integer, primary_key=True),
+    Column('prefix_id', Text, nullable=False),
+    Column('tag_id', Text, nullable=False),
+    Column('value', BigInteger, nullable=False),
+    Column('lease_id', Text, nullable=False),
+    Column('owner', Text, nullable=False),
+    Column('expires', DateTime, nullable=False),
+    UniqueConstraint('prefix_id', 'tag_id', 'value', name='unique_doi_suffix_lease'),
+    Index('doi_suffix_lease_lease_id_idx', 'lease_id'),
+    Index('doi_suffix_lease_expires_idx', 'prefix_id', 'tag_id', 'expires'),
+)
+
+# Other databases (SQLite) do not have sequences, the last suffix number per prefix is kept here
+local_metadata = MetaData()
+
+doi_suffix_sequence = Table(
+    'doi_suffix_sequence', local_metadata,
+    Column('prefix_id', Text, primary_key=True),
+    Column('last_value', Integer, nullable=False),
+)
+
+# Indexes the DOI index minter relies on: name -> (columns, unique). Existing databases may
+# have them with other names, they are matched by their columns.
+REQUIRED_INDEXES = {
+    'unique_doi': (('prefix_id', 'suffix_id'), True),
+    'unique_ckan_id_site_entity': (('ckan_id', 'site_id', 'ckan_entity'), True),
+    'doi_realisation_site_entity_created_idx': (('site_id', 'ckan_entity', 'date_created'), False),
+}
+
+# Constraints of older versions of the create script replaced by a required index:
+# name -> (columns, replacement). unique_doi_site allowed the same DOI for several sites.
+OBSOLETE_CONSTRAINTS = {
+    'unique_doi_site': (('prefix_id', 'suffix_id', 'site_id'), 'unique_doi'),
+}
+
+# PostgreSQL generates the suffixes from a sequence per prefix and keeps date_modified up to date
+_postgresql_functions = [
+    '''CREATE OR REPLACE FUNCTION get_doi_sequence_name(prefix text) RETURNS text
+    LANGUAGE sql
+    AS $$
+select'prefix_' || replace(prefix, '.', '_') || '_seq'
+$$''',
+    '''CREATE OR REPLACE FUNCTION create_doi_sequences() RETURNS void
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    r doi_prefix%rowtype;
+    available varchar;
+BEGIN
+    FOR r IN SELECT * FROM doi_prefix
+    LOOP
+    SELECT c.relname INTO available FROM pg_class c WHERE c.relname=get_doi_sequence_name(r.prefix_id);
+    IF AVAILABLE IS NOT NULL THEN
+       CONTINUE;
+    END IF;
+    EXECUTE 'CREATE SEQUENCE ' || get_doi_sequence_name(r.prefix_id);
+    END LOOP;
+END;
+$$''',
+    '''CREATE OR REPLACE FUNCTION get_next_doi_suffix(prefix_id text, tag text) RETURNS text
+    LANGUAGE sql
+    AS $$
+select tag||cast (nextval(get_doi_sequence_name(prefix_id)) as text);
+$$''',
+    '''CREATE OR REPLACE FUNCTION insert_doi_suffix_fn() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    NEW.suffix_id := get_next_doi_suffix(NEW.prefix_id, NEW.tag_id);
+    RETURN NEW;
+END;
+$$''',
+    '''CREATE OR REPLACE FUNCTION update_doi_modified_fn() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    NEW.date_modified := now();
+    RETURN NEW;
+END;
+$$''',
+]
+
+_postgresql_triggers = [
+    'CREATE TRIGGER doi_inserted_tr BEFORE INSERT ON doi_realisation FOR EACH ROW '
+    'WHEN ((new.suffix_id IS NULL)) EXECUTE PROCEDURE insert_doi_suffix_fn()',
+    'CREATE TRIGGER doi_modified_tr BEFORE UPDATE ON doi_realisation FOR EACH ROW '
+    'EXECUTE PROCEDURE update_doi_modified_fn()',
+]
+
+for _statement in _postgresql_functions:
+    event.listen(metadata, 'before_create', DDL(_statement).execute_if(dialect='postgresql'))
+for _statement in _postgresql_triggers:
+    event.listen(doi_realisation, 'after_create', DDL(_statement).execute_if(dialect='postgresql'))
+
+
+def init_db(engine):
+    """Creates the DOI index tables that do not exist yet and the missing required indexes.
+       Returns the list of created indexes.
+    """
+    metadata.create_all(engine, checkfirst=True)
+    if engine.dialect.name != 'postgresql':
+        local_metadata.create_all(engine, checkfirst=True)
+    return create_missing_indexes(engine)
+
+
+def add_prefixes_and_sites(engine, prefixes=(), site_ids=()):
+    """Inserts the missing doi_prefix and ckan_site rows the DOIs refer to and, in PostgreSQL,
+       creates the suffix sequence of each prefix. Returns the prefixes and sites added.
+    """
+    added_prefixes = []
+    added_sites = []
+    with engine.begin() as connection:
+        for prefix in prefixes:
+            if not connection.execute(sqlalchemy.select([doi_prefix.c.prefix_pk])
+                                      .where(doi_prefix.c.prefix_id == prefix)).first():
+                connection.execute(doi_prefix.insert().values(prefix_id=prefix))
+                added_prefixes += [prefix]
+        for site_id in site_ids:
+            if not connection.execute(sqlalchemy.select([ckan_site.c.site_pk])
+                                      .where(ckan_site.c.site_id == site_id)).first():
+                connection.execute(ckan_site.insert().values(site_id=site_id))
+                added_sites += [site_id]
+        if engine.dialect.name == 'postgresql':
+            # one sequence per row of doi_prefix, the existing ones are kept
+            connection.execute(sqlalchemy.select([sqlalchemy.func.create_doi_sequences()]))
+    for prefix in added_prefixes:
+        log.info('Added DOI prefix {0}'.format(prefix))
+    for site_id in added_sites:
+        log.info('Added CKAN site {0}'.format(site_id))
+    return added_prefixes, added_sites
+
+
+def check_db(engine):
+    """Verifies the doi_realisation table in a live database.
+       Returns a list of problems found (missing table, columns or indexes), empty if all is fine.
+    """
+    inspector = sqlalchemy.inspect(engine)
+    if doi_realisation.name not in inspector.get_table_names():
+        return ['Missing table {0}'.format(doi_realisation.name)]
+
+    problems = []
+    existing_columns = [column['name'] for column in inspector.get_columns(doi_realisation.name)]
+    for column in doi_realisation.columns:
+        if column.name not in existing_columns:
+            problems += ['Missing column {0}.{1}'.format(doi_realisation.name, column.name)]
+
+    missing = get_missing_indexes(engine)
+    for name in missing:
+        columns, unique = REQUIRED_INDEXES[name]
+        problems += ['Missing {0}index {1} on {2} ({3})'.format('unique ' if unique else '', name,
+                                                                doi_realisation.name, ', '.join(columns))]
+        duplicates = get_duplicates(engine, columns) if unique else []
+        if duplicates:
+            problems += ['{0} duplicated values of ({1}) in {2}, e.g. {3}, to be fixed before creating {4}'.format(
+                len(duplicates), ', '.join(columns), doi_realisation.name, duplicates[0], name)]
+    for name in get_obsolete_constraints(engine):
+        columns, replacement = OBSOLETE_CONSTRAINTS[name]
+        problems += ['Obsolete unique constraint {0} on {1} ({2}), replaced by {3}'.format(
+            name, doi_realisation.name, ', '.join(columns), replacement)]
+    return problems
+
+
+def get_duplicates(engine, columns):
+    """Returns the values of the columns found in several doi_realisation rows (at most 100)"""
+    table_columns = [sqlalchemy.column(column) for column in columns]
+    query = sqlalchemy.select(table_columns).select_from(sqlalchemy.table(doi_realisation.name))\
+        .group_by(*table_columns).having(sqlalchemy.func.count() > 1).limit(100)
+    return [tuple(row) for row in engine.execute(query)]
+
+
+def get_obsolete_constraints(engine):
+    """Returns the names of the obsolete unique constraints still present in the doi_realisation table"""
+    inspector = sqlalchemy.inspect(engine)
+    existing = set(constraint['name'] for constraint in inspector.get_unique_constraints(doi_realisation.name))
+    existing.update(index['name'] for index in inspector.get_indexes(doi_realisation.name) if index.get('unique'))
+    return sorted(name for name in OBSOLETE_CONSTRAINTS if name in existing)
+
+
+def drop_obsolete_constraints(engine):
+    """Drops the obsolete unique constraints whose replacement exists (PostgreSQL), returns their names"""
+    if engine.dialect.name != 'postgresql':
+        return []
+    missing = get_missing_indexes(engine)
+    dropped = []
+    for name in get_obsolete_constraints(engine):
+        columns, replacement = OBSOLETE_CONSTRAINTS[name]
+        if replacement in missing:
+            continue
+        log.info('Dropping obsolete constraint {0} on {1}'.format(name, doi_realisation.name))
+        with engine.begin() as connection:
+            connection.execute(sqlalchemy.text('ALTER TABLE {0} DROP CONSTRAINT IF EXISTS {1}'.format(
+                doi_realisation.name, name)))
+        dropped += [name]
+    return dropped
+
+
+def get_missing_indexes(engine):
+    """Returns the names of the required indexes not present in the doi_realisation table"""
+    inspector = sqlalchemy.inspect(engine)
+
+    # unique constraints are backed by an index too
+    unique_indexes = set()
+    indexes = set()
+    for index in inspector.get_indexes(doi_realisation.name):
+        if index.get('unique'):
+            unique_indexes.add(tuple(sorted(index['column_names'])))
+        indexes.add(tuple(index['column_names']))
+    for constraint in inspector.get_unique_constraints(doi_realisation.name):
+        unique_indexes.add(tuple(sorted(constraint['column_names'])))
+
+    missing = []
+    for name, (columns, unique) in sorted(REQUIRED_INDEXES.items()):
+        if unique:
+            # any column order serves the equality lookups
+            if tuple(sorted(columns)) not in unique_indexes:
+                missing += [name]
+        elif tuple(columns) not in indexes:
+            missing += [name]
+    return missing
+
+
+def create_missing_indexes(engine):
+    """Creates the required indexes missing in the doi_realisation table, returns their names"""
+    if doi_realisation.name not in sqlalchemy.inspect(engine).get_table_names():
+        return []
+
+    existing_columns = [column['name'] for column in sqlalchemy.inspect(engine).get_columns(doi_realisation.name)]
+
+    created = []
+    for name in get_missing_indexes(engine):
+        columns, unique = REQUIRED_INDEXES[name]
+        if not set(columns).issubset(existing_columns):
+            log.warning('Cannot create index {0}, missing columns in {1}'.format(name, doi_realisation.name))
+            continue
+        if unique and get_duplicates(engine, columns):
+            log.warning('Cannot create unique index {0}, duplicated values of ({1}) in {2}'.format(
+                name, ', '.join(columns), doi_realisation.name))
+            continue
+        # build it on a copy, the index is already part of the table definition
+        table = doi_realisation.tometadata(MetaData())
+        index = Index(name, *[table.c[column] for column in columns], unique=unique)
+        log.info('Creating index {0} on {1} ({2})'.format(name, doi_realisation.name, ', '.join(columns)))
+        index.create(engine)
+        created += [name]
+    return created
@@ -0,0 +1,61 @@
+import csv
+import datetime
+import io
+import json
+import uuid
+
+import logging
+
+log = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ['ndjson', 'csv']
+
+CONTENT_TYPES = {'ndjson': 'application/x-ndjson',
+                 'csv': 'text/csv'}
+
+# columns of the CSV export, in order
+CSV_COLUMNS = ['doi', 'prefix_id', 'suffix_id', 'ckan_id', 'ckan_name', 'ckan_entity', 'ckan_user', 'site_id',
+               'tag_id', 'metadata_format', 'datacite_hash', 'date_created', 'date_modified']
+
+
+def parse_date(value):
+    """Parses an ISO date or datetime, returns None for empty values and raises ValueError if invalid"""
+    if not value:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.fromisoformat(value)
+
+
+def serialize_row(row):
+    """Makes a DOI row JSON serializable"""
+    serialized = {}
+    for key, value in row.items():
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            value = value.isoformat()
+        elif isinstance(value, uuid.UUID):
+            value = str(value)
+        serialized[key] = value
+    return serialized
+
+
+def iter_export(rows, export_format='ndjson'):
+    """Yields the DOI rows serialized as NDJSON lines or CSV lines (with header), one row at a time"""
+    if export_format == 'ndjson':
+        for row in rows:
+            yield json.dumps(serialize_row(row)) + '\n'
+    elif export_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=CSV_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(serialize_row(row))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+        # header only if there are no rows
+        if buffer.tell():
+            yield buffer.getvalue()
+    else:
+        raise ValueError('Unknown export format "{0}", allowed: {1}'.format(export_format,
+                                                                            ', '.join(EXPORT_FORMATS)))
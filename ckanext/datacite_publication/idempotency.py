@@ -0,0 +1,160 @@
+import contextlib
+import datetime
+import hashlib
+import json
+import threading
+
+import sqlalchemy
+from sqlalchemy import MetaData, Table, Column, Text, DateTime, Index
+
+from ckantoolkit import config, asint
+import ckan.model as model
+from ckan.model import meta
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# tables of the extension in the CKAN database, kept out of CKAN's own metadata, created by setup()
+metadata = MetaData()
+
+# results of the publication requests sent with an idempotency key, returned again
+# to the retries with the same key (per user)
+datacite_idempotency = Table(
+    'datacite_idempotency', metadata,
+    Column('key', Text, primary_key=True),
+    Column('user_name', Text, primary_key=True),
+    Column('operation', Text, nullable=False),
+    Column('entity_id', Text, nullable=False),
+    # JSON result of the action
+    Column('result', Text, nullable=False),
+    Column('created', DateTime, nullable=False),
+    # expiry
+    Index('datacite_idempotency_created_idx', 'created'),
+)
+
+
+class LockTimeout(Exception):
+    pass
+
+
+def get_ttl():
+    """Seconds the results of the requests with an idempotency key are kept, 0 disables the keys"""
+    return asint(config.get('datacite_publication.idempotency_ttl', 86400))
+
+
+def is_enabled():
+    return get_ttl() > 0
+
+
+def setup():
+    """Creates the idempotency table in the CKAN database if it does not exist"""
+    if not datacite_idempotency.exists(bind=meta.engine):
+        datacite_idempotency.create(bind=meta.engine)
+        log.info('Created table datacite_idempotency')
+
+
+def get_result(key, user_name, session=None):
+    """Returns the stored request (operation, entity_id and result) of the key and user, None if unknown or expired"""
+    session = session or model.Session
+    expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=get_ttl())
+    row = session.execute(
+        datacite_idempotency.select()
+        .where(datacite_idempotency.c.key == key)
+        .where(datacite_idempotency.c.user_name == user_name)
+        .where(datacite_idempotency.c.created > expired)).first()
+    if row is None:
+        return None
+    return {'operation': row['operation'], 'entity_id': row['entity_id'], 'result': json.loads(row['result'])}
+
+
+def save_result(key, user_name, operation, entity_id, result, session=None):
+    """Stores the result of a request with an idempotency key and commits, dropping the expired ones"""
+    session = session or model.Session
+    now = datetime.datetime.utcnow()
+    expired = now - datetime.timedelta(seconds=get_ttl())
+    session.execute(datacite_idempotency.delete().where(datacite_idempotency.c.created <= expired))
+    session.execute(datacite_idempotency.delete()
+                    .where(datacite_idempotency.c.key == key)
+                    .where(datacite_idempotency.c.user_name == user_name))
+    session.execute(datacite_idempotency.insert().values(
+        key=key, user_name=user_name, operation=operation, entity_id=entity_id, result=json.dumps(result),
+        created=now))
+    session.commit()
+
+
+def _get_lock_timeout():
+    # by default a bit longer than a whole publication
+    return asint(config.get('datacite_publication.lock_timeout',
+                            asint(config.get('datacite_publication.publish_deadline', 120)) + 30))
+
+
+def _get_advisory_key(name):
+    # signed 64 bit key of the PostgreSQL advisory locks
+    return int.from_bytes(hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+
+@contextlib.contextmanager
+def _advisory_lock(name, timeout, session):
+    # transaction level lock taken on the connection of the session, released when the operation
+    # commits its change (or the transaction is rolled back), waiting at most lock_timeout
+    key = _get_advisory_key(name)
+    waited = not session.execute(sqlalchemy.select([sqlalchemy.func.pg_try_advisory_xact_lock(key)])).scalar()
+    if waited:
+        previous = session.execute(sqlalchemy.select([sqlalchemy.func.current_setting('lock_timeout')])).scalar()
+        session.execute(sqlalchemy.select([sqlalchemy.func.set_config(
+            'lock_timeout', '{0}ms'.format(int(timeout * 1000)), True)]))
+        try:
+            session.execute(sqlalchemy.select([sqlalchemy.func.pg_advisory_xact_lock(key)]))
+        except sqlalchemy.exc.OperationalError as e:
+            session.rollback()
+            # lock_not_available
+            if getattr(e.orig, 'pgcode', None) == '55P03':
+                raise LockTimeout('Another request for {0} is still running after {1}s'.format(name, timeout))
+            raise
+        session.execute(sqlalchemy.select([sqlalchemy.func.set_config('lock_timeout', previous, True)]))
+    try:
+        yield waited
+    except Exception:
+        session.rollback()
+        raise
+
+
+# process local locks, when the CKAN database is not PostgreSQL (tests): name -> [lock, holders and waiters]
+_local_locks = {}
+_local_locks_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _local_lock(name, timeout):
+    with _local_locks_lock:
+        entry = _local_locks.setdefault(name, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        lock = entry[0]
+        waited = not lock.acquire(blocking=False)
+        if waited and not lock.acquire(timeout=timeout):
+            raise LockTimeout('Another request for {0} is still running after {1}s'.format(name, timeout))
+        try:
+            yield waited
+        finally:
+            lock.release()
+    finally:
+        with _local_locks_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                _local_locks.pop(name, None)
+
+
+def dataset_lock(package_id, timeout=None, session=None):
+    """Context manager holding the lock of the DataCite operations on a dataset: a PostgreSQL
+       advisory lock of the transaction of the session (default model.Session) shared by all the
+       processes, held until the operation commits its change, a lock of the process with other
+       databases. Yields True if it had to wait for another request. Raises LockTimeout after
+       timeout seconds (datacite_publication.lock_timeout).
+    """
+    name = 'datacite_publication:{0}'.format(package_id)
+    timeout = timeout if timeout is not None else _get_lock_timeout()
+    if meta.engine.dialect.name == 'postgresql':
+        return _advisory_lock(name, timeout, session or model.Session)
+    return _local_lock(name, timeout)
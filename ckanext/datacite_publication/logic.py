@@ -1,4 +1,7 @@
+import datetime
 import sys
+import threading
+import time
 import traceback
 import json
 
@@ -7,24 +10,36 @@ import ckan.authz as authz
 import ckan.lib.mailer as mailer
 from ckan.common import _
 from ckan.common import config
-import importlib
 
 import ckan.model
 import ckanext.datacite_publication.helpers as helpers
+import ckanext.datacite_publication.bulk_publisher as bulk_publisher
+import ckanext.datacite_publication.doi_db_schema as doi_db_schema
+import ckanext.datacite_publication.export as export
+import ckanext.datacite_publication.idempotency as idempotency
+import ckanext.datacite_publication.minter_registry as minter_registry
+import ckanext.datacite_publication.model as outbox
+import ckanext.datacite_publication.suffix_generator as suffix_generator
 
-from ckanext.datacite_publication.datacite_publisher import DatacitePublisher
+from ckanext.datacite_publication.datacite_publisher import DatacitePublisher, Deadline, DeadlineExceeded
+from ckanext.datacite_publication.datacite_publisher import get_circuit_breaker, get_lookup_cache
 
 import logging
 
 log = logging.getLogger(__name__)
 
-DEAFULT_MINTER = 'ckanext.datacite_publication.minter.DatacitePublicationMinter'
-
 REQUEST_MESSAGE = 'requested datacite publication'
 APPROVAL_MESSAGE = 'approved datacite publication'
 FINISH_MESSAGE = 'finished datacite publication'
 UPDATE_MESSAGE = 'updated datacite publication'
 
+# publication state of a dataset once a request is done, a concurrent request for the same
+# dataset that waited for it returns instead of doing it again
+DONE_STATES = {'request': ['pub_pending'], 'approve': ['approved'], 'publish': ['published']}
+
+# operations of the portal admins only
+ADMIN_OPERATIONS = ['approve', 'publish', 'update']
+
 @toolkit.side_effect_free
 def datacite_make_public_package(context, data_dict):
     '''Makes the dataset public (without a DOI request)
@@ -43,11 +58,26 @@ def datacite_publish_package(context, data_dict):
        including the DOI request.
     :param id: the ID of the dataset
     :type id: string
+    :param idempotency_key: key of the request, the retries with the same key get its result (optional)
+    :type idempotency_key: string
     :returns: the package doi
     :rtype: string
     '''
     log.debug("logic: datacite_publish_package: {0}".format(data_dict.get('id')))
-    return (_publish(data_dict, context, type='package'))
+    return _run_once('request', data_dict, context, _publish)
+
+
+@toolkit.side_effect_free
+def datacite_publish_package_bulk(context, data_dict):
+    '''Start the publication process for several datasets
+       reserving all their DOIs at once.
+    :param ids: the IDs of the datasets
+    :type ids: list of strings
+    :returns: the publication result (success, doi, error) per dataset
+    :rtype: dictionary
+    '''
+    log.debug("logic: datacite_publish_package_bulk: {0}".format(data_dict.get('ids')))
+    return (_publish_bulk(data_dict, context, type='package'))
 
 
 @toolkit.side_effect_free
@@ -56,11 +86,13 @@ def datacite_approve_publication_package(context, data_dict):
        by a portal admin.
     :param id: the ID of the dataset
     :type id: string
+    :param idempotency_key: key of the request, the retries with the same key get its result (optional)
+    :type idempotency_key: string
     :returns: the package doi
     :rtype: string
     '''
     log.debug("logic: datacite_approve_publication_package: {0}".format(data_dict.get('id')))
-    return (_approve(data_dict, context, type='package'))
+    return _run_once('approve', data_dict, context, _approve)
 
 
 @toolkit.side_effect_free
@@ -80,28 +112,57 @@ def datacite_manual_finish_publication_package(context, data_dict):
 def datacite_finish_publication_package(context, data_dict):
     '''Finish the publication process for a dataset
        sending it to datacite API
-       by a portal admin.
+       by a portal admin. With datacite_publication.outbox
+       it is sent later and the result is pending.
     :param id: the ID of the dataset
     :type id: string
+    :param idempotency_key: key of the request, the retries with the same key get its result (optional)
+    :type idempotency_key: string
     :returns: the package doi
     :rtype: string
     '''
     log.debug("logic: datacite_finish_publication_package: {0}".format(data_dict.get('id')))
-    return (_publish_to_datacite(data_dict, context, type='package'))
+    return _run_once('publish', data_dict, context, _publish_to_datacite)
 
 
 @toolkit.side_effect_free
 def datacite_update_publication_package(context, data_dict):
     '''Update the metadata for a dataset
        sending it to datacite API
-       by a portal admin.
+       by a portal admin. Skipped if the exported metadata
+       did not change since the last update. With
+       datacite_publication.outbox it is sent later and the
+       result is pending.
     :param id: the ID of the dataset
     :type id: string
+    :param force: send the metadata even if unchanged (optional)
+    :type force: bool
+    :param idempotency_key: key of the request, the retries with the same key get its result (optional)
+    :type idempotency_key: string
     :returns: the package doi
     :rtype: string
     '''
     log.debug("logic: datacite_update_publication_package: {0}".format(data_dict.get('id')))
-    return (_update_in_datacite(data_dict, context, type='package'))
+    return _run_once('update', data_dict, context, _update_in_datacite)
+
+
+@toolkit.side_effect_free
+def datacite_update_publication_package_bulk(context, data_dict):
+    '''Update several published datasets in DataCite concurrently
+       by a portal admin, the unchanged ones are skipped.
+    :param ids: the IDs of the datasets
+    :type ids: list of strings
+    :param force: send also the unchanged datasets (optional, default False)
+    :type force: boolean
+    :param concurrency: maximum number of concurrent requests (optional)
+    :type concurrency: int
+    :param rate: maximum number of requests per second (optional)
+    :type rate: float
+    :returns: the update result (success, doi, error, unchanged) per dataset
+    :rtype: dictionary
+    '''
+    log.debug("logic: datacite_update_publication_package_bulk: {0}".format(data_dict.get('ids')))
+    return (_update_bulk_in_datacite(data_dict, context))
 
 
 @toolkit.side_effect_free
@@ -113,6 +174,179 @@ def datacite_publish_resource(context, data_dict):
     return _publish_resource(data_dict, context)
 
 
+@toolkit.side_effect_free
+def datacite_export_doi_index(context, data_dict):
+    '''List the DOIs of this site registered in the DOI index
+       by a portal admin. Use 'next' as 'after' to get the following page.
+    :param entity_type: package or resource (optional)
+    :type entity_type: string
+    :param date_from: only DOIs created since this ISO date (optional)
+    :type date_from: string
+    :param date_to: only DOIs created before this ISO date (optional)
+    :type date_to: string
+    :param after: only DOIs after this index key (optional)
+    :type after: int
+    :param limit: maximum number of DOIs (optional, default 1000)
+    :type limit: int
+    :returns: the DOI rows and the key of the next page
+    :rtype: dictionary
+    '''
+    log.debug("logic: datacite_export_doi_index: {0}".format(data_dict))
+    max_limit = toolkit.asint(config.get('datacite_publication.export.max_limit', 10000))
+    try:
+        limit = min(toolkit.asint(data_dict.get('limit', 1000)), max_limit)
+    except ValueError:
+        raise toolkit.ValidationError({'limit': 'limit has to be an integer'})
+
+    rows = [export.serialize_row(row) for row in iter_doi_index(dict(data_dict, limit=limit), context)]
+    next_key = None
+    if len(rows) == limit:
+        next_key = rows[-1]['doi_pk']
+    return {'success': True, 'error': None, 'rows': rows, 'next': next_key}
+
+
+@toolkit.side_effect_free
+def datacite_api_status(context, data_dict):
+    '''State of the circuit breaker and of the lookup cache of the DataCite API in this process (admins only)
+    :returns: the circuit breaker state (closed, open or half_open), failures and last failure,
+        the lookup cache size and hits (None if disabled) and the timings of the dataset state changes
+    :rtype: dictionary
+    '''
+    ckan_user = _get_username_from_context(context)
+    if not helpers.datacite_publication_is_admin(ckan_user):
+        raise toolkit.NotAuthorized({
+            'permissions': ['Not authorized to see the DataCite API status (admins only).']})
+
+    datacite_url = config.get('datacite_publication.datacite_url', '')
+    lookup_cache = get_lookup_cache(datacite_url)
+    return {'success': True, 'error': None, 'circuit_breaker': get_circuit_breaker(datacite_url).get_state(),
+            'lookup_cache': lookup_cache.get_state() if lookup_cache else None,
+            'transition_timings': get_transition_timings()}
+
+
+@toolkit.side_effect_free
+def datacite_publication_status(context, data_dict):
+    '''Status of a publication, approval or update recorded in the outbox
+       (datacite_publication.outbox), for the admins and the user who requested it.
+    :param id: the id of the outbox entry (outbox_id of the pending result)
+    :type id: string
+    :returns: the stage (queued, exporting, validating, sending, sent, done or failed),
+        the error, the attempts and the seconds spent in each stage
+    :rtype: dictionary
+    '''
+    try:
+        entry_id = data_dict['id']
+    except KeyError:
+        raise toolkit.ValidationError({'id': 'missing id'})
+    if not outbox.is_enabled():
+        raise toolkit.ValidationError({'id': 'the DataCite outbox is not enabled'})
+
+    entry = outbox.get(entry_id)
+    if not entry:
+        raise toolkit.ObjectNotFound('DataCite outbox entry not found')
+
+    ckan_user = _get_username_from_context(context)
+    if not ckan_user or (ckan_user != entry['user_name'] and not helpers.datacite_publication_is_admin(ckan_user)):
+        raise toolkit.NotAuthorized({
+            'permissions': ['Not authorized to see the publication status (admins and requester only).']})
+
+    return dict(outbox.get_status(entry), success=True)
+
+
+def iter_doi_index(data_dict, context):
+    '''Checks the permissions and the filters and returns a generator
+       over the DOI index rows of the site (see datacite_export_doi_index).
+    '''
+    ckan_user = _get_username_from_context(context)
+    if not helpers.datacite_publication_is_admin(ckan_user):
+        raise toolkit.NotAuthorized({
+            'permissions': ['Not authorized to export the DOI index (admins only).']})
+
+    minter = minter_registry.get_minter(name=data_dict.get('minter'))
+    if not callable(getattr(minter, "iter_dois", None)):
+        raise toolkit.ValidationError({'minter': 'The configured DOI minter has no DOI index to export'})
+
+    entity_type = data_dict.get('entity_type')
+    if entity_type and entity_type not in ['package', 'resource']:
+        raise toolkit.ValidationError({'entity_type': 'entity type should be "package" or "resource"'})
+
+    filters = {}
+    for key in ['date_from', 'date_to']:
+        try:
+            filters[key] = export.parse_date(data_dict.get(key))
+        except ValueError:
+            raise toolkit.ValidationError({key: 'not a valid ISO date'})
+    for key in ['after', 'limit']:
+        try:
+            filters[key] = toolkit.asint(data_dict[key]) if data_dict.get(key) else None
+        except ValueError:
+            raise toolkit.ValidationError({key: '{0} has to be an integer'.format(key)})
+
+    return minter.iter_dois(entity_type=entity_type,
+                            include_metadata=toolkit.asbool(data_dict.get('include_metadata', False)), **filters)
+
+
+def _run_once(operation, data_dict, context, run):
+    '''Runs run(data_dict, context) holding the lock of the dataset, concurrent requests for the
+       same dataset (double clicks, client retries) wait for each other. A request that waited returns
+       when the dataset is already in the state the operation brings it to (see DONE_STATES).
+       With an idempotency_key the result of the first successful (or pending) request with that key
+       is returned again.
+    '''
+    try:
+        id_or_name = data_dict['id']
+    except KeyError:
+        raise toolkit.ValidationError({'id': 'missing id'})
+    package = ckan.model.Package.get(id_or_name)
+    if not package:
+        raise toolkit.ObjectNotFound('Dataset not found')
+    package_id = package.id
+
+    key = data_dict.get('idempotency_key') if idempotency.is_enabled() else None
+    ckan_user = _get_username_from_context(context)
+
+    try:
+        with idempotency.dataset_lock(package_id) as waited:
+            if key:
+                stored = idempotency.get_result(key, ckan_user)
+                if stored:
+                    if stored['operation'] != operation or stored['entity_id'] != package_id:
+                        raise toolkit.ValidationError(
+                            {'idempotency_key': 'key already used for another request'})
+                    if not _is_operation_authorized(operation, package_id, context):
+                        raise toolkit.NotAuthorized({
+                            'permissions': ['Not authorized to {0} the dataset.'.format(operation)]})
+                    log.info("{0} of package {1} already done with key {2}, returning its result".format(
+                        operation, package_id, key))
+                    return dict(stored['result'], replayed=True)
+
+            if waited and operation in DONE_STATES:
+                # done by the request we waited for, read again
+                ckan.model.Session.expire_all()
+                dataset_dict = toolkit.get_action('package_show')(context.copy(), {'id': package_id})
+                if dataset_dict.get('publication_state', '') in DONE_STATES[operation] and \
+                        _is_operation_authorized(operation, package_id, context):
+                    log.info("{0} of package {1} done by a concurrent request".format(operation, package_id))
+                    return {'success': True, 'error': None, 'duplicate': True}
+
+            result = run(data_dict, context)
+            # failures (DataCite errors, open circuit, deadline) are not stored, a retry with the key runs again
+            if key and result.get('success'):
+                idempotency.save_result(key, ckan_user, operation, package_id, result)
+            return result
+    except idempotency.LockTimeout as e:
+        log.error("{0} of package {1}: {2}".format(operation, package_id, e))
+        return {'success': False, 'error': str(e)}
+
+
+def _is_operation_authorized(operation, package_id, context):
+    # the checks of the operation itself, for the results returned without running it
+    if not authz.is_authorized('package_update', context.copy(), {'id': package_id}).get('success', False):
+        return False
+    return operation not in ADMIN_OPERATIONS or \
+        helpers.datacite_publication_is_admin(_get_username_from_context(context) or None)
+
+
 def _make_public(data_dict, context, type='package'):
     try:
         id_or_name = data_dict['id']
@@ -133,9 +367,8 @@ def _make_public(data_dict, context, type='package'):
     if dataset_dict.get('publication_state', False):
         return {'success': False, 'error': 'Dataset publication state is not empty'}
 
-        # set as public
-    dataset_dict['private'] = False
-    toolkit.get_action('package_update')(context=context, data_dict=dataset_dict)
+    # set as public
+    _change_dataset(dataset_dict, context, 'make_public', None, private=False)
 
     log.info("success making public package {0}".format(package_id))
     return {'success': True, 'error': None}
@@ -174,13 +407,8 @@ def _publish(data_dict, context, type='package'):
         return {'success': False, 'error': 'Dataset publication state should be empty to request a new DOI'}
 
         # mint doi mint_doi(self, ckan_id, ckan_user, prefix_id = None, suffix = None, entity='package')
-    minter_name = config.get('datacite_publication.minter', DEAFULT_MINTER)
-    package_name, class_name = minter_name.rsplit('.', 1)
-    module = importlib.import_module(package_name)
-    minter_class = getattr(module, class_name)
-    minter = minter_class()
-
     prefix = config.get('datacite_publication.doi_prefix', '10.xxxxx')
+    minter = minter_registry.get_minter(prefix)
 
     doi, error = minter.mint(prefix, pkg=dataset_dict, user=ckan_user)
 
@@ -188,16 +416,7 @@ def _publish(data_dict, context, type='package'):
 
     if doi:
         # update dataset
-        dataset_dict['doi'] = doi
-        dataset_dict['private'] = False
-        # TODO: check what is the proper state once workflow is complete
-        # dataset_dict['publication_state'] = 'reserved'
-        dataset_dict['publication_state'] = 'pub_pending'
-        context['message'] = REQUEST_MESSAGE + " for dataset {0}".format(package_id)
-        toolkit.get_action('package_update')(context=context, data_dict=dataset_dict)
-
-        # save activity
-        _add_activity(dataset_dict, REQUEST_MESSAGE, context)
+        _set_publication_requested(dataset_dict, doi, package_id, context)
 
         # notify admin and user
         datacite_publication_requested_mail(ckan_user, dataset_dict)
@@ -212,6 +431,79 @@ def _publish(data_dict, context, type='package'):
     return {'success': False, 'error': 'Internal error'}
 
 
+def _publish_bulk(data_dict, context, type='package'):
+    ids = data_dict.get('ids')
+    if not ids:
+        raise toolkit.ValidationError({'ids': 'missing ids'})
+    ids = toolkit.aslist(ids, sep=',')
+
+    max_bulk = toolkit.asint(config.get('datacite_publication.bulk_max', 500))
+    if len(ids) > max_bulk:
+        raise toolkit.ValidationError({'ids': 'too many datasets, maximum is {0}'.format(max_bulk)})
+
+    # get user
+    ckan_user = _get_username_from_context(context)
+
+    # check every dataset, only the ones ready for a new DOI are minted
+    results = []
+    pending = []
+    for id_or_name in ids:
+        try:
+            dataset_dict = toolkit.get_action('package_show')(context.copy(), {'id': id_or_name})
+        except toolkit.ObjectNotFound:
+            results += [{'id': id_or_name, 'success': False, 'doi': None, 'error': 'Dataset not found'}]
+            continue
+
+        package_id = dataset_dict.get('id', id_or_name)
+        result = {'id': package_id, 'success': False, 'doi': None, 'error': None}
+        results += [result]
+
+        if not authz.is_authorized(
+                'package_update', context.copy(),
+                {'id': package_id}).get('success', False):
+            result['error'] = 'Not authorized to publish the dataset.'
+        elif dataset_dict.get('doi'):
+            result['error'] = 'Dataset has already a DOI, custom DOIs have to be published individually'
+        elif dataset_dict.get('publication_state', False):
+            result['error'] = 'Dataset publication state should be empty to request a new DOI'
+        else:
+            pending += [(result, dataset_dict)]
+
+    # reserve all DOIs at once
+    prefix = config.get('datacite_publication.doi_prefix', '10.xxxxx')
+    minter = minter_registry.get_minter(prefix)
+
+    minted = []
+    if pending:
+        minted = minter.mint_many(prefix, [dataset_dict for result, dataset_dict in pending], user=ckan_user)
+
+    # the datasets and their activities are committed at once
+    bulk_context = dict(context, defer_commit=True)
+    requested = []
+    for (result, dataset_dict), (doi, error) in zip(pending, minted):
+        if doi:
+            _set_publication_requested(dataset_dict, doi, result['id'], bulk_context.copy())
+            result['success'] = True
+            result['doi'] = doi
+            requested += [dataset_dict]
+            log.info("success minting DOI for package {0}, doi {1}".format(result['id'], doi))
+        else:
+            result['error'] = error
+            log.error("error minting DOI for package {0}, error{1}".format(result['id'], error))
+    if requested:
+        ckan.model.repo.commit()
+
+    # notify admin once for all datasets
+    if requested:
+        datacite_publication_requested_bulk_mail(ckan_user, requested)
+
+    failed = len([result for result in results if not result['success']])
+    error = None
+    if failed:
+        error = '{0} of {1} datasets could not be published'.format(failed, len(results))
+    return {'success': failed == 0, 'error': error, 'results': results}
+
+
 def _publish_custom_by_admin(dataset_dict, package_id, ckan_user, context, type='package'):
 
     custom_doi = dataset_dict['doi']
@@ -226,14 +518,13 @@ def _publish_custom_by_admin(dataset_dict, package_id, ckan_user, context, type=
     if custom_prefix not in allowed_prefixes:
         return {'success': False, 'error': 'Custom prefix not allowed'}
 
+    if not _is_custom_suffix_valid(custom_suffix):
+        return {'success': False, 'error': 'Custom suffix not valid: wrong check character'}
+
     log.info("publishing CUSTOM DOI by an Admin {0}, allowed: {1}".format(custom_doi, allowed_prefixes))
 
     # mint doi mint_doi(self, ckan_id, ckan_user, prefix_id = None, suffix = None, entity='package')
-    minter_name = config.get('datacite_publication.minter', DEAFULT_MINTER)
-    package_name, class_name = minter_name.rsplit('.', 1)
-    module = importlib.import_module(package_name)
-    minter_class = getattr(module, class_name)
-    minter = minter_class()
+    minter = minter_registry.get_minter(custom_prefix)
 
     doi, error = minter.mint(custom_prefix, pkg=dataset_dict, user=ckan_user, suffix=custom_suffix)
 
@@ -241,16 +532,7 @@ def _publish_custom_by_admin(dataset_dict, package_id, ckan_user, context, type=
 
     if doi:
         # update dataset
-        dataset_dict['doi'] = doi
-        dataset_dict['private'] = False
-        # TODO: check what is the proper state once workflow is complete
-        # dataset_dict['publication_state'] = 'reserved'
-        dataset_dict['publication_state'] = 'pub_pending'
-        context['message'] = REQUEST_MESSAGE + " for dataset {0}".format(package_id)
-        toolkit.get_action('package_update')(context=context, data_dict=dataset_dict)
-
-        # save activity
-        _add_activity(dataset_dict, REQUEST_MESSAGE, context)
+        _set_publication_requested(dataset_dict, doi, package_id, context)
 
         # notify admin and user
         datacite_publication_requested_mail(ckan_user, dataset_dict)
@@ -264,6 +546,13 @@ def _publish_custom_by_admin(dataset_dict, package_id, ckan_user, context, type=
     return {'success': False, 'error': 'Internal error'}
 
 
+def _set_publication_requested(dataset_dict, doi, package_id, context):
+    # TODO: check what is the proper state once workflow is complete
+    # publication_state = 'reserved'
+    _change_dataset(dataset_dict, context, 'request', REQUEST_MESSAGE + " for dataset {0}".format(package_id),
+                    doi=doi, private=False, publication_state='pub_pending', activity=REQUEST_MESSAGE)
+
+
 def _approve(data_dict, context, type='package'):
     log.debug('_approve: Approving "{0}" ({1})'.format(data_dict['id'], data_dict.get('name', '')))
     # a dataset id i s necessary
@@ -296,14 +585,20 @@ def _approve(data_dict, context, type='package'):
         raise toolkit.NotAuthorized({
             'permissions': ['Not authorized to approve the dataset (admin only).']})
 
-    # change publication state
-    dataset_dict['publication_state'] = 'approved'
-    dataset_dict['private'] = False
-    context['message'] = APPROVAL_MESSAGE + " for dataset {0}".format(package_id)
-    toolkit.get_action('package_update')(context=context, data_dict=dataset_dict)
+    # approved and notified later by the outbox sender
+    if outbox.is_enabled():
+        return _add_to_outbox(outbox.APPROVE, dataset_dict, doi, context)
 
-    # save activity
-    _add_activity(dataset_dict, APPROVAL_MESSAGE, context)
+    return _send_approval(dataset_dict, context)
+
+
+def _send_approval(dataset_dict, context):
+    '''Marks a dataset as approved for publication and notifies the users'''
+    package_id = dataset_dict['id']
+
+    # change publication state
+    _change_dataset(dataset_dict, context, 'approve', APPROVAL_MESSAGE + " for dataset {0}".format(package_id),
+                    publication_state='approved', private=False, activity=APPROVAL_MESSAGE)
 
     # notify owner and involved users
     dataset_owner = dataset_dict.get('creator_user_id', '')
@@ -336,13 +631,8 @@ def _finish_manually(data_dict, context, type='package'):
             'permissions': ['Not authorized to finish manually the dataset publication (admin only).']})
 
     # change publication state
-    dataset_dict['publication_state'] = 'published'
-    dataset_dict['private'] = False
-    context['message'] = FINISH_MESSAGE + " for dataset {0}".format(package_id)
-    toolkit.get_action('package_update')(context=context, data_dict=dataset_dict)
-
-    # save activity
-    _add_activity(dataset_dict, FINISH_MESSAGE, context)
+    _change_dataset(dataset_dict, context, 'finish_manually', FINISH_MESSAGE + " for dataset {0}".format(package_id),
+                    publication_state='published', private=False, activity=FINISH_MESSAGE)
 
     # notify owner and involved users
     dataset_owner = dataset_dict.get('creator_user_id', '')
@@ -354,6 +644,9 @@ def _finish_manually(data_dict, context, type='package'):
 def _publish_to_datacite(data_dict, context, type='package'):
     log.debug(
         '_publish_to_datacite: Publishing to datacite "{0}" ({1})'.format(data_dict['id'], data_dict.get('name', '')))
+    # time limit of the whole publication
+    deadline = Deadline()
+
     # a dataset id i s necessary
     try:
         id_or_name = data_dict['id']
@@ -387,10 +680,40 @@ def _publish_to_datacite(data_dict, context, type='package'):
         raise toolkit.NotAuthorized({
             'permissions': ['Not authorized to perform the dataset publication to datacite (admin only).']})
 
+    # sent later by the outbox sender
+    if outbox.is_enabled():
+        return _add_to_outbox(outbox.PUBLISH, dataset_dict, doi, context)
+
+    return _send_publication(dataset_dict, doi, context, deadline)
+
+
+def _send_publication(dataset_dict, doi, context, deadline=None, on_stage=None, retried=False):
+    '''Publishes an approved dataset in DataCite, then marks it as published and notifies the users.
+       retried: an earlier attempt may have registered the DOI before failing, then it is not an error
+    '''
+    package_id = dataset_dict['id']
     datacite_publisher = DatacitePublisher()
+    deadline = deadline or Deadline()
 
     try:
-        doi, error = datacite_publisher.publish(doi, pkg=dataset_dict, context=context)
+        # exported here to record the hash of what is sent, the next updates are skipped until it changes
+        deadline.check('export')
+        if on_stage:
+            on_stage('exporting')
+        xml = datacite_publisher.export_package(dataset_dict, context)
+        publication_hash = datacite_publisher.get_publication_hash(xml, datacite_publisher.get_package_url(dataset_dict))
+        published_doi, error = datacite_publisher.publish(doi, pkg=dataset_dict, context=context, xml=xml,
+                                                          deadline=deadline, on_stage=on_stage)
+        if error and retried and datacite_publisher.is_doi_registered(doi, dataset_dict, deadline=deadline):
+            log.info("DOI {0} of package {1} already registered in DataCite by an earlier attempt".format(
+                doi, package_id))
+            published_doi, error = doi, None
+        doi = published_doi
+    except toolkit.ObjectNotFound:
+        return {'success': False, 'error': 'Dataset not found'}
+    except DeadlineExceeded as e:
+        log.error("timeout publishing package {0} to Datacite: {1}".format(package_id, e))
+        return {'success': False, 'error': str(e), 'deadline_exceeded': True}
     except Exception as e:
         log.error("exception publishing package {0} to Datacite, error {1}".format(package_id, traceback.format_exc()))
         return {'success': False, 'error': 'Exception when publishing to DataCite: {0}'.format(e)}
@@ -401,15 +724,13 @@ def _publish_to_datacite(data_dict, context, type='package'):
     if error:
         log.error("error publishing package {0} to Datacite, error {1}".format(package_id, error))
         return {'success': False, 'error': error}
+    if on_stage:
+        on_stage('sent')
+    _record_publication_hash(doi, publication_hash)
 
     # change publication state
-    dataset_dict['publication_state'] = 'published'
-    dataset_dict['private'] = False
-    context['message'] = FINISH_MESSAGE + " for dataset {0}".format(package_id)
-    toolkit.get_action('package_update')(context=context, data_dict=dataset_dict)
-
-    # save activity
-    _add_activity(dataset_dict, FINISH_MESSAGE, context)
+    _change_dataset(dataset_dict, context, 'publish', FINISH_MESSAGE + " for dataset {0}".format(package_id),
+                    publication_state='published', private=False, activity=FINISH_MESSAGE)
 
     # notify owner and involved users
     dataset_owner = dataset_dict.get('creator_user_id', '')
@@ -418,9 +739,25 @@ def _publish_to_datacite(data_dict, context, type='package'):
     return {'success': True, 'error': None}
 
 
+def _record_publication_hash(doi, publication_hash):
+    # in the minter database when it keeps them (DOI index), a failure only means the next update is sent again
+    doi_prefix, doi_suffix = doi.split('/', 1)
+    try:
+        minter = minter_registry.get_minter(doi_prefix)
+        if not callable(getattr(minter, "set_datacite_hash", None)):
+            return
+        if not minter.set_datacite_hash(doi_prefix, doi_suffix, publication_hash):
+            log.warning("could not record the DataCite hash of {0}, DOI not in the minter database".format(doi))
+    except Exception as e:
+        log.warning("exception recording the DataCite hash of {0}: {1}".format(doi, e))
+
+
 def _update_in_datacite(data_dict, context, type='package'):
     log.debug(
         '_update_in_datacite: Updating in datacite "{0}" ({1})'.format(data_dict['id'], data_dict.get('name', '')))
+    # time limit of the whole update
+    deadline = Deadline()
+
     # a dataset id i s necessary
     try:
         id_or_name = data_dict['id']
@@ -428,6 +765,56 @@ def _update_in_datacite(data_dict, context, type='package'):
         raise toolkit.ValidationError({'id': 'missing id'})
     dataset_dict = toolkit.get_action('package_show')(context, {'id': id_or_name})
 
+    force = toolkit.asbool(data_dict.get('force', False))
+
+    # exported, compared and sent later by the outbox sender
+    if outbox.is_enabled():
+        update, result = _check_update(dataset_dict, id_or_name, context)
+        if result:
+            return result
+        return _add_to_outbox(outbox.UPDATE, dataset_dict, update['doi'], context, data={'force': force})
+
+    datacite_publisher = DatacitePublisher()
+    update, result = _prepare_update(dataset_dict, id_or_name, context, datacite_publisher, force=force)
+    if result:
+        return result
+
+    return _send_update(update, datacite_publisher, context, deadline)
+
+
+def _send_update(update, datacite_publisher, context, deadline=None, on_stage=None):
+    '''Sends a prepared update (see _prepare_update) to DataCite and records it'''
+    dataset_dict = update['dataset_dict']
+    package_id = update['package_id']
+
+    # publish in datacite
+    try:
+        doi, error = datacite_publisher.publish(update['doi'], pkg=dataset_dict, context=context, update=True,
+                                                xml=update['xml'], deadline=deadline, on_stage=on_stage)
+    except DeadlineExceeded as e:
+        log.error("timeout updating package {0} in Datacite: {1}".format(package_id, e))
+        return {'success': False, 'error': str(e), 'deadline_exceeded': True}
+    except Exception as e:
+        log.error("exception updating package {0} in Datacite, error {1}".format(package_id, traceback.format_exc()))
+        return {'success': False, 'error': 'Exception when updating in DataCite: {0}'.format(e)}
+    except:
+        log.error("error updating package {0} in Datacite, error {1}".format(package_id, sys.exc_info()[0]))
+        return {'success': False, 'error': 'Unknown error when updating in DataCite: {0}'.format(sys.exc_info()[0])}
+
+    if error:
+        log.error("error updating package {0} to Datacite, error {1}".format(package_id, error))
+        return {'success': False, 'error': error}
+    if on_stage:
+        on_stage('sent')
+
+    return _record_update(update, context)
+
+
+def _check_update(dataset_dict, id_or_name, context, ckan_user=None):
+    '''Checks that a published dataset can be updated in DataCite.
+       Returns (update, None) with its DOI and minter, or (None, result) if it cannot be sent.
+       Raises ValidationError and NotAuthorized.
+    '''
     # state has to be approved
     state = dataset_dict.get('publication_state', '')
     if state != 'published':
@@ -438,29 +825,25 @@ def _update_in_datacite(data_dict, context, type='package'):
     default_prefix = config.get('datacite_publication.doi_prefix', '10.xxxxx')
     allowed_prefixes = config.get('datacite_publication.custom_prefix', '').split(' ') + [default_prefix]
     doi_prefix = doi.split('/')[0].strip()
-    doi_suffix = doi.split('/')[1].strip()
 
     if (not doi) or (len(doi) <= 0) or (doi_prefix not in allowed_prefixes):
         raise toolkit.ValidationError(
             {'doi': 'dataset has no valid minted DOI [' + ', '.join(allowed_prefixes) + ']/*'})
+    doi_suffix = doi.split('/')[1].strip()
 
     # Check authorization
     package_id = dataset_dict.get('package_id', dataset_dict.get('id', id_or_name))
     if not authz.is_authorized(
             'package_update', context,
-            {'id': package_id}).get('success', False) or not helpers.datacite_publication_is_admin():
+            {'id': package_id}).get('success', False) or not helpers.datacite_publication_is_admin(ckan_user):
         log.error(
             'ERROR updating publication dataset in datacite, current user is not authorized: isAdmin = {0}'.format(
-                helpers.datacite_publication_is_admin()))
+                helpers.datacite_publication_is_admin(ckan_user)))
         raise toolkit.NotAuthorized({
             'permissions': ['Not authorized to perform the dataset update to datacite (admin only).']})
 
     # Get the DOI minter
-    minter_name = config.get('datacite_publication.minter', DEAFULT_MINTER)
-    package_name, class_name = minter_name.rsplit('.', 1)
-    module = importlib.import_module(package_name)
-    minter_class = getattr(module, class_name)
-    minter = minter_class()
+    minter = minter_registry.get_minter(doi_prefix)
 
     # check when possible if the association doi-ckan id is valid:
     log.debug("CHECK DOI in minter")
@@ -468,14 +851,56 @@ def _update_in_datacite(data_dict, context, type='package'):
     if callable(is_doi_valid_op):
         valid_doi = minter.is_doi_valid(doi, package_id)
         if not valid_doi:
-            return {'success': False, 'error': 'DOI and id do not match to the DOI realisation table in the DB'}
+            return None, {'success': False, 'error': 'DOI and id do not match to the DOI realisation table in the DB'}
 
-    # update in the minter database if necessary
+    return {'dataset_dict': dataset_dict, 'package_id': package_id, 'doi': doi, 'doi_prefix': doi_prefix,
+            'doi_suffix': doi_suffix, 'minter': minter}, None
+
+
+def _prepare_update(dataset_dict, id_or_name, context, datacite_publisher, force=False, ckan_user=None):
+    '''Checks a published dataset and exports its DataCite metadata.
+       Returns (update, None) with what is needed to send the update, or (None, result) if there
+       is nothing to send. Raises ValidationError and NotAuthorized.
+    '''
+    update, result = _check_update(dataset_dict, id_or_name, context, ckan_user=ckan_user)
+    if result:
+        return None, result
+    package_id = update['package_id']
+    minter = update['minter']
+
+    # export the metadata and compare it to the last version sent to DataCite
+    try:
+        xml = datacite_publisher.export_package(dataset_dict, context)
+        publication_hash = datacite_publisher.get_publication_hash(xml, datacite_publisher.get_package_url(dataset_dict))
+    except toolkit.ObjectNotFound:
+        return None, {'success': False, 'error': 'Dataset not found'}
+    except Exception as e:
+        log.error("exception exporting package {0} for Datacite, error {1}".format(package_id, traceback.format_exc()))
+        return None, {'success': False, 'error': 'Exception when exporting the DataCite metadata: {0}'.format(e)}
+
+    get_datacite_hash_op = getattr(minter, "get_datacite_hash", None)
+    if callable(get_datacite_hash_op) and not force:
+        # from the primary database, a replica lagging behind the last update would skip this one
+        if minter.get_datacite_hash(update['doi_prefix'], update['doi_suffix'], primary=True) == publication_hash:
+            log.info("package {0} unchanged since last DataCite update, skipping".format(package_id))
+            return None, {'success': True, 'error': None, 'unchanged': True}
+
+    update.update(xml=xml, publication_hash=publication_hash)
+    return update, None
+
+
+def _record_update(update, context):
+    '''Records a DataCite update in the minter database and in the activity stream'''
+    package_id = update['package_id']
+    dataset_dict = update['dataset_dict']
+
+    # update in the minter database if necessary, recording what was sent to DataCite
     # get user
     ckan_user = _get_username_from_context(context)
 
     try:
-        doi, error = minter.update(doi_prefix, pkg=dataset_dict, user=ckan_user, suffix=doi_suffix)
+        doi, error = update['minter'].update(update['doi_prefix'], pkg=dataset_dict, user=ckan_user,
+                                             suffix=update['doi_suffix'], datacite_hash=update['publication_hash'])
         log.debug("minter update got doi={0}, error={1}".format(doi, error))
     except Exception as e:
         log.error("exception updating package {0} in DOI minter, error {1}".format(package_id, traceback.format_exc()))
@@ -488,29 +913,206 @@ def _update_in_datacite(data_dict, context, type='package'):
         log.error("error updating package {0} in DOI minter, error {1}".format(package_id, error))
         return {'success': False, 'error': error}
 
-    # publish in datacite
+    # save activity
+    _add_activity(dataset_dict, UPDATE_MESSAGE, context)
+
+    return {'success': True, 'error': None, 'unchanged': False}
+
+
+def _update_bulk_in_datacite(data_dict, context):
+    ids = data_dict.get('ids')
+    if not ids:
+        raise toolkit.ValidationError({'ids': 'missing ids'})
+    ids = toolkit.aslist(ids, sep=',')
+
+    max_bulk = toolkit.asint(config.get('datacite_publication.bulk_update_max', 10000))
+    if len(ids) > max_bulk:
+        raise toolkit.ValidationError({'ids': 'too many datasets, maximum is {0}'.format(max_bulk)})
+
+    ckan_user = _get_username_from_context(context)
+    if not helpers.datacite_publication_is_admin(ckan_user):
+        raise toolkit.NotAuthorized({
+            'permissions': ['Not authorized to perform the dataset update to datacite (admin only).']})
+
+    force = toolkit.asbool(data_dict.get('force', False))
     datacite_publisher = DatacitePublisher()
 
+    # check and export every dataset, only the changed ones are sent
+    results = []
+    updates = []
+    for id_or_name in ids:
+        result = {'id': id_or_name, 'doi': None, 'success': False, 'error': None, 'unchanged': False}
+        results += [result]
+        try:
+            dataset_dict = toolkit.get_action('package_show')(context.copy(), {'id': id_or_name})
+            result.update(id=dataset_dict.get('id', id_or_name), doi=dataset_dict.get('doi'))
+            update, prepared = _prepare_update(dataset_dict, id_or_name, context.copy(), datacite_publisher, force,
+                                               ckan_user=ckan_user)
+        except toolkit.ObjectNotFound:
+            result['error'] = 'Dataset not found'
+            continue
+        except (toolkit.ValidationError, toolkit.NotAuthorized) as e:
+            result['error'] = str(getattr(e, 'error_dict', e))
+            continue
+        if prepared:
+            result.update(prepared)
+        else:
+            updates += [(result, update)]
+
+    # send the updates concurrently
     try:
-        doi, error = datacite_publisher.publish(doi, pkg=dataset_dict, context=context, update=True)
-    except Exception as e:
-        log.error("exception updating package {0} in Datacite, error {1}".format(package_id, traceback.format_exc()))
-        return {'success': False, 'error': 'Exception when updating in DataCite: {0}'.format(e)}
-    except:
-        log.error("error updating package {0} in Datacite, error {1}".format(package_id, sys.exc_info()[0]))
-        return {'success': False, 'error': 'Unknown error when updating in DataCite: {0}'.format(sys.exc_info()[0])}
+        concurrency = toolkit.asint(data_dict['concurrency']) if data_dict.get('concurrency') else None
+        rate = float(data_dict['rate']) if data_dict.get('rate') else None
+    except ValueError:
+        raise toolkit.ValidationError({'concurrency': 'concurrency and rate have to be numbers'})
+    sent = bulk_publisher.BulkPublisher(datacite_publisher, concurrency=concurrency, rate=rate).publish_many(
+        [{'doi': update['doi'], 'pkg': update['dataset_dict'], 'xml': update['xml'], 'update': True}
+         for result, update in updates])
+
+    for (result, update), sent_result in zip(updates, sent):
+        if sent_result['success']:
+            result.update(_record_update(update, context.copy()))
+        else:
+            result['error'] = sent_result['error']
 
-    if error:
-        log.error("error updating package {0} to Datacite, error {1}".format(package_id, error))
+    failed = len([result for result in results if not result['success']])
+    error = None
+    if failed:
+        error = '{0} of {1} datasets could not be updated'.format(failed, len(results))
+    return {'success': failed == 0, 'error': error, 'results': results}
+
+
+def _add_to_outbox(operation, dataset_dict, doi, context, data=None):
+    '''Records the DataCite operation in the outbox (once per dataset while it is not sent)
+       and hands it to the job queue, returns the pending result
+    '''
+    package_id = dataset_dict['id']
+    entry = outbox.get_pending(package_id, operation)
+    if entry:
+        log.info("{0} of package {1} already in the DataCite outbox ({2})".format(operation, package_id, entry['id']))
+    else:
+        entry = outbox.add(operation, package_id, doi, _get_username_from_context(context), data=data)
+        ckan.model.repo.commit()
+        log.info("{0} of package {1} added to the DataCite outbox ({2})".format(operation, package_id, entry['id']))
+
+        # otherwise (or if the queue is down) sent by the outbox worker
+        if config.get('datacite_publication.outbox.sender', 'jobs') == 'jobs':
+            try:
+                toolkit.enqueue_job(process_outbox_entry, [entry['id']],
+                                    title='DataCite {0} {1}'.format(operation, doi))
+            except Exception as e:
+                log.warning("Could not enqueue DataCite outbox entry {0}, left to the outbox worker: {1}".format(
+                    entry['id'], e))
+
+    return {'success': True, 'error': None, 'pending': True, 'outbox_id': entry['id'], 'state': entry['state']}
+
+
+def _get_outbox_retry_delay(attempts):
+    backoff = toolkit.asint(config.get('datacite_publication.outbox.backoff', 60))
+    backoff_max = toolkit.asint(config.get('datacite_publication.outbox.backoff_max', 3600))
+    return min(backoff_max, backoff * (2 ** (attempts - 1)))
+
+
+def process_outbox_entry(entry_id):
+    '''Sends a DataCite publication or update recorded in the outbox (run by the job queue or the
+       outbox worker). Failures are retried later with backoff, up to datacite_publication.outbox.max_attempts.
+    :returns: the result of the operation, None if the entry is not due (sent or claimed by another sender)
+    '''
+    lease = toolkit.asint(config.get('datacite_publication.outbox.lease', 600))
+    entry = outbox.claim(entry_id, lease=lease)
+    if not entry:
+        log.debug("DataCite outbox entry {0} not due, skipping".format(entry_id))
+        return None
+    package_id = entry['entity_id']
+    log.info("Sending DataCite outbox entry {0}: {1} of package {2}, attempt {3}".format(
+        entry_id, entry['operation'], package_id, entry['attempts']))
+
+    # as the user who requested it, authorized then. The entry is completed in the transaction
+    # of the dataset change and its activity, if there is one
+    context = {'model': ckan.model, 'session': ckan.model.Session, 'user': entry['user_name'],
+               'datacite_outbox_entry': entry_id}
+
+    def on_stage(stage):
+        # sent is recorded with the completion, once the dataset change is persisted
+        if stage == 'sent':
+            context['datacite_outbox_sent'] = datetime.datetime.utcnow()
+        else:
+            outbox.set_stage(entry_id, stage)
+    try:
+        dataset_dict = toolkit.get_action('package_show')(context.copy(), {'id': package_id})
+        state = dataset_dict.get('publication_state', '')
+        if entry['operation'] == outbox.PUBLISH:
+            if state == 'published':
+                result = {'success': True, 'error': None}
+            elif state != 'approved':
+                raise toolkit.ValidationError({'publication_state': 'dataset is no longer in state "approved"'})
+            else:
+                result = _send_publication(dataset_dict, entry['doi'], context, Deadline(), on_stage=on_stage,
+                                           retried=entry['attempts'] > 1)
+        elif entry['operation'] == outbox.APPROVE:
+            if state in ['approved', 'published']:
+                result = {'success': True, 'error': None}
+            else:
+                result = _send_approval(dataset_dict, context)
+        else:
+            datacite_publisher = DatacitePublisher()
+            on_stage('exporting')
+            update, result = _prepare_update(dataset_dict, package_id, context, datacite_publisher,
+                                             force=entry['data'].get('force', False), ckan_user=entry['user_name'])
+            if not result:
+                result = _send_update(update, datacite_publisher, context, Deadline(), on_stage=on_stage)
+    except (toolkit.ObjectNotFound, toolkit.ValidationError, toolkit.NotAuthorized) as e:
+        # will not succeed later either
+        error = str(getattr(e, 'error_dict', e))
+        log.error("DataCite outbox entry {0} failed: {1}".format(entry_id, error))
+        ckan.model.Session.rollback()
+        outbox.fail(entry_id, error)
         return {'success': False, 'error': error}
+    except Exception as e:
+        log.error("exception sending DataCite outbox entry {0}, error {1}".format(entry_id, traceback.format_exc()))
+        ckan.model.Session.rollback()
+        result = {'success': False, 'error': 'Exception when sending to DataCite: {0}'.format(e)}
+
+    if result['success']:
+        # unless completed with the dataset change
+        if context.pop('datacite_outbox_entry', None):
+            outbox.complete(entry_id, sent=context.pop('datacite_outbox_sent', None))
+        return result
+
+    max_attempts = toolkit.asint(config.get('datacite_publication.outbox.max_attempts', 10))
+    if entry['attempts'] >= max_attempts:
+        log.error("DataCite outbox entry {0} failed after {1} attempts: {2}".format(
+            entry_id, entry['attempts'], result['error']))
+        outbox.fail(entry_id, result['error'])
+    else:
+        delay = _get_outbox_retry_delay(entry['attempts'])
+        log.warning("DataCite outbox entry {0} failed ({1}), retry in {2}s".format(entry_id, result['error'], delay))
+        outbox.retry(entry_id, result['error'], delay)
+    return result
 
-    # save activity
-    _add_activity(dataset_dict, UPDATE_MESSAGE, context)
 
-    return {'success': True, 'error': None}
+def process_outbox(limit=100):
+    '''Sends the due DataCite outbox entries, oldest first
+    :returns: the number of entries sent and failed
+    :rtype: tuple
+    '''
+    sent = failed = 0
+    for entry_id in outbox.get_due_ids(limit):
+        result = process_outbox_entry(entry_id)
+        # a new session per entry, the datasets are read again instead of cached from the previous one
+        ckan.model.Session.remove()
+        if result is None:
+            continue
+        if result['success']:
+            sent += 1
+        else:
+            failed += 1
+    return sent, failed
 
 
 def _publish_resource(data_dict, context):
+    # time limit of the whole publication
+    deadline = Deadline()
 
     # validate the id and get the resource data
     try:
@@ -559,6 +1161,10 @@ def _publish_resource(data_dict, context):
         log.error('_publish_resource: resource has an empty DOI suffix')
         return {'success': False, 'error': 'Custom DOI not valid: suffix empty'}
 
+    if not _is_custom_suffix_valid(custom_suffix):
+        log.error('_publish_resource: resource DOI suffix {0} has a wrong check character'.format(custom_suffix))
+        return {'success': False, 'error': 'Custom DOI not valid: wrong check character'}
+
     if update:
         log.info("updating CUSTOM resource DOI by an Admin {0}/{1}, allowed: {2}".format(custom_prefix, custom_suffix,
                                                                                           allowed_prefixes))
@@ -567,11 +1173,7 @@ def _publish_resource(data_dict, context):
                                                                                            allowed_prefixes))
 
     # Get the DOI minter
-    minter_name = config.get('datacite_publication.minter', DEAFULT_MINTER)
-    package_name, class_name = minter_name.rsplit('.', 1)
-    module = importlib.import_module(package_name)
-    minter_class = getattr(module, class_name)
-    minter = minter_class()
+    minter = minter_registry.get_minter(custom_prefix)
 
     if update:
         doi = custom_doi
@@ -598,7 +1200,10 @@ def _publish_resource(data_dict, context):
 
     try:
         doi, error = datacite_publisher.publish_resource(doi, resource=resource_dict, package=package_dict,
-                                                         context=context, update=update)
+                                                         context=context, update=update, deadline=deadline)
+    except DeadlineExceeded as e:
+        log.error("timeout publishing resource {0} to Datacite: {1}".format(id, e))
+        return {'success': False, 'error': str(e), 'deadline_exceeded': True}
     except Exception as e:
         log.error("exception publishing resource {0} to Datacite, error {1}".format(id, traceback.format_exc()))
         return {'success': False, 'error': 'Exception when publishing to DataCite: {0}'.format(e)}
@@ -618,6 +1223,68 @@ def _publish_resource(data_dict, context):
     return {'success': True, 'error': None}
 
 
+def _is_custom_suffix_valid(custom_suffix):
+    # optionally require checksummed suffixes, rejecting mistyped DOIs before looking them up
+    if not toolkit.asbool(config.get('datacite_publication.custom_suffix_checksum', False)):
+        return True
+    return suffix_generator.is_valid_suffix(custom_suffix, config.get('datacite_publication.suffix_tag',
+                                                                    doi_db_schema.DEFAULT_TAG))
+
+
+# per process timings of the dataset state changes: transition -> count, total and max seconds
+_transition_timings = {}
+_transition_timings_lock = threading.Lock()
+
+
+def get_transition_timings():
+    with _transition_timings_lock:
+        return dict((name, dict(timings, mean=timings['total'] / timings['count']))
+                    for name, timings in _transition_timings.items())
+
+
+def _change_dataset(dataset_dict, context, transition, message, activity=None, **fields):
+    '''Changes some fields of a dataset (private, publication_state, doi) for a publication
+       transition, also in dataset_dict. With datacite_publication.minimal_state_update only these
+       fields are sent to package_patch, otherwise the whole dataset_dict to package_update, both
+       validated with the hooks of the other extensions. The change, its activity and the outbox
+       entry being sent (if any) are committed at once, nothing is written if the change is invalid.
+    '''
+    start = time.perf_counter()
+    update_context = dict(context, defer_commit=True)
+    if message:
+        update_context['message'] = message
+    if toolkit.asbool(config.get('datacite_publication.minimal_state_update', False)):
+        updated = toolkit.get_action('package_patch')(update_context, dict(fields, id=dataset_dict['id']))
+    else:
+        updated = toolkit.get_action('package_update')(update_context, dict(dataset_dict, **fields))
+    dataset_dict.update(fields)
+    if isinstance(updated, dict) and updated.get('metadata_modified'):
+        dataset_dict['metadata_modified'] = updated['metadata_modified']
+    if activity:
+        _add_activity(dataset_dict, activity, context, commit=False)
+    _commit(context)
+    elapsed = time.perf_counter() - start
+
+    with _transition_timings_lock:
+        timings = _transition_timings.setdefault(transition, {'count': 0, 'total': 0.0, 'max': 0.0})
+        timings['count'] += 1
+        timings['total'] += elapsed
+        timings['max'] = max(timings['max'], elapsed)
+    log.info("dataset {0} {1}: {2} in {3:.3f}s".format(dataset_dict['id'], transition, ', '.join(
+        '{0}={1}'.format(key, value) for key, value in fields.items()), elapsed))
+
+
+def _commit(context):
+    '''Commits the changes of a transition with the completion of the outbox entry being sent
+       (datacite_outbox_entry in the context), unless the caller commits (defer_commit)
+    '''
+    entry_id = context.pop('datacite_outbox_entry', None)
+    if entry_id:
+        outbox.complete(entry_id, session=context['session'], sent=context.pop('datacite_outbox_sent', None))
+    if not context.get('defer_commit'):
+        ckan.model.repo.commit()
+
+
 def _get_username_from_context(context):
     auth_user_obj = context.get('auth_user_obj', None)
     user_name = ''
@@ -670,6 +1337,38 @@ def datacite_publication_requested_mail(user_id, entity, user_email='', entity_t
                    u'Failed to send mail to admin from "{0}": {1}').format(user_id, e))
 
 
+# send a single email to admin on a bulk publication request
+def datacite_publication_requested_bulk_mail(user_id, entities, entity_type='package'):
+    try:
+        log.debug('datacite_publication_requested_bulk_mail: Notifying request from "{0}" ({1} entities)'.format(
+            user_id, len(entities)))
+
+        # Get admin data
+        admin_name = _('CKAN System Administrator')
+        admin_email = config.get('email_to')
+        if not admin_email:
+            raise mailer.MailerException('Missing "email-to" in config')
+
+        # Get user information
+        user = _get_user_info(user_id)
+        user_email = user['email']
+        user_name = user.get('display_name', user['name'])
+
+        body = u"Notifying publication request to {0} ({1}): \n".format(admin_name, admin_email)
+        body += u"\t - User: {0} ({1})\n".format(user_name, user_email)
+        for entity in entities:
+            body += u"\t - Entity: {0} ({1}), DOI: {2}\n".format(entity['name'], entity_type, entity.get('doi', ''))
+            body += u"\t   URL: {0} \n".format(_get_entity_url(entity, entity_type=entity_type))
+        subject = _('Publication Request for {0} datasets').format(len(entities))
+
+        # Send copy to admin
+        mailer.mail_recipient(admin_name, admin_email, subject, body)
+
+    except Exception as e:
+        log.error((u'datacite_publication_requested_bulk_mail: '
+                   u'Failed to send mail to admin from "{0}": {1}').format(user_id, e))
+
+
 # send email to user on publication approval
 def datacite_approved_mail(user_id, entity, context, user_email='', entity_type='package'):
     try:
@@ -852,7 +1551,7 @@ def _get_user_request(entity_id, context):
     return None
 
 
-def _add_activity(dataset_dict, message, context):
+def _add_activity(dataset_dict, message, context, commit=True):
     ckan_user = _get_username_from_context(context)
     userobj = ckan.model.User.get(ckan_user)
     if userobj:
@@ -869,4 +1568,5 @@ def _add_activity(dataset_dict, message, context):
         )
         session = context['session']
         session.add(request_activity)
-        ckan.model.repo.commit()
+    if commit:
+        _commit(context)
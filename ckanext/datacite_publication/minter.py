@@ -1,6 +1,7 @@
 from ckantoolkit import config
 import ckan.plugins as plugins
-import uuid
+
+import ckanext.datacite_publication.suffix_generator as suffix_generator
 
 import logging
 log = logging.getLogger(__name__)
@@ -10,9 +11,18 @@ class DatacitePublicationMinter(plugins.SingletonPlugin):
 
     def mint(self, prefix, pkg=None, *args, **kwargs):
         error = None
-        doi = prefix + '/' + str(uuid.uuid4())
+        doi = prefix + '/' + self.generate_suffixes(1)[0]
         return (doi, error)
 
+    def mint_many(self, prefix, pkgs, user=None, *args, **kwargs):
+        error = None
+        return [(prefix + '/' + suffix, error) for suffix in self.generate_suffixes(len(pkgs))]
+
+    def generate_suffixes(self, count):
+        # uuid (default) or ulid: compact, time ordered and checksummed
+        generator = config.get('datacite_publication.suffix_generator', 'uuid')
+        return suffix_generator.generate_suffixes(count, generator)
+
     def update(self, prefix, suffix, pkg=None, *args, **kwargs):
         error = None
         doi = prefix + '/' + suffix
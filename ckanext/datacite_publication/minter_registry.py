@@ -0,0 +1,103 @@
+import importlib
+import os
+import threading
+
+from ckantoolkit import config, asbool
+
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MINTER = 'ckanext.datacite_publication.minter.DatacitePublicationMinter'
+DEFAULT_NAME = 'default'
+
+# minter instances by name and minter names by prefix, set up once when the plugin is configured
+_minters = {}
+_prefix_minters = {}
+_configured = False
+_lock = threading.Lock()
+# warm up on the first use in each process (datacite_publication.minter_warm_up): the engines are per
+# process, the ones of the parent are not used by the forked web server workers
+_warm_up = False
+_warmed_up_pid = None
+
+
+def _load_minter(minter_name):
+    package_name, class_name = minter_name.rsplit('.', 1)
+    module = importlib.import_module(package_name)
+    minter_class = getattr(module, class_name)
+    return minter_class()
+
+
+def configure(config_=None):
+    """Resolves and instantiates the configured minters:
+
+        datacite_publication.minter = <class path of the default minter>
+        datacite_publication.minters = <name>:<class path> ...
+        datacite_publication.prefix_minters = <prefix>:<name> ...
+    """
+    global _configured
+    config_ = config_ if config_ is not None else config
+
+    minter_paths = {DEFAULT_NAME: config_.get('datacite_publication.minter', DEFAULT_MINTER)}
+    for entry in config_.get('datacite_publication.minters', '').split():
+        name, minter_path = entry.split(':', 1)
+        minter_paths[name] = minter_path
+
+    prefix_minters = {}
+    for entry in config_.get('datacite_publication.prefix_minters', '').split():
+        prefix, name = entry.split(':', 1)
+        if name not in minter_paths:
+            raise ValueError('Minter "{0}" for prefix {1} is not defined in datacite_publication.minters'.format(
+                name, prefix))
+        prefix_minters[prefix] = name
+
+    minters = dict((name, _load_minter(minter_path)) for name, minter_path in minter_paths.items())
+
+    global _warm_up, _warmed_up_pid
+    with _lock:
+        _minters.clear()
+        _minters.update(minters)
+        _prefix_minters.clear()
+        _prefix_minters.update(prefix_minters)
+        _warm_up = asbool(config_.get('datacite_publication.minter_warm_up', False))
+        _warmed_up_pid = None
+        _configured = True
+    log.info('Configured DOI minters: {0}'.format(', '.join('{0}={1}'.format(name, minter_paths[name])
+                                                            for name in sorted(minter_paths))))
+
+
+def get_minter(prefix=None, name=None):
+    """Returns the minter registered with the given name, or for the given prefix, or the default one"""
+    if not _configured:
+        configure()
+    if _warm_up and _warmed_up_pid != os.getpid():
+        warm_up()
+    if not name:
+        name = _prefix_minters.get(prefix, DEFAULT_NAME)
+    try:
+        return _minters[name]
+    except KeyError:
+        raise ValueError('Unknown DOI minter "{0}"'.format(name))
+
+
+def warm_up():
+    """Prepares the minters that support it (e.g. database connection and table reflection), once per
+       process. Done on the first use of a minter when datacite_publication.minter_warm_up is set, it can
+       also be called from the post fork hook of the web server so that no request pays for it.
+    """
+    global _warmed_up_pid
+    if not _configured:
+        configure()
+    with _lock:
+        if _warmed_up_pid == os.getpid():
+            return
+        _warmed_up_pid = os.getpid()
+    for name, minter in list(_minters.items()):
+        warm_up_op = getattr(minter, 'warm_up', None)
+        if callable(warm_up_op):
+            try:
+                minter.warm_up()
+                log.debug('Warmed up DOI minter {0}'.format(name))
+            except Exception as e:
+                log.error('Could not warm up DOI minter {0}: {1}'.format(name, e))
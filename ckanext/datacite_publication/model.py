@@ -0,0 +1,219 @@
+import contextlib
+import datetime
+import json
+import uuid
+
+import sqlalchemy
+from sqlalchemy import MetaData, Table, Column, Integer, Text, DateTime, Index
+
+from ckantoolkit import config, asbool
+import ckan.model as model
+from ckan.model import meta
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# operations recorded in the outbox
+PUBLISH = 'publish'
+APPROVE = 'approve'
+UPDATE = 'update'
+OPERATIONS = [PUBLISH, APPROVE, UPDATE]
+
+# states of an outbox entry: pending (waiting to be sent, or to be retried), sending (claimed by a
+# sender until next_attempt, then claimable again), done or failed (after the last attempt)
+PENDING = 'pending'
+SENDING = 'sending'
+DONE = 'done'
+FAILED = 'failed'
+
+# progress of an entry reported to the clients, with the time each stage was reached
+STAGES = ['queued', 'exporting', 'validating', 'sending', 'sent', 'done', 'failed']
+FINAL_STAGES = ['done', 'failed']
+
+# tables of the extension in the CKAN database, kept out of CKAN's own metadata (create_all,
+# drop_all and migrations), created by setup()
+metadata = MetaData()
+
+# DataCite publications and updates to send, in the CKAN database so that they are recorded
+# in the same transaction as the action requesting them
+datacite_outbox = Table(
+    'datacite_outbox', metadata,
+    Column('id', Text, primary_key=True),
+    Column('entity_id', Text, nullable=False),
+    Column('entity_type', Text, nullable=False, server_default='package'),
+    Column('operation', Text, nullable=False),
+    Column('doi', Text, nullable=False),
+    Column('user_name', Text),
+    # JSON options of the operation (e.g. force)
+    Column('data', Text),
+    Column('state', Text, nullable=False, server_default=PENDING),
+    Column('attempts', Integer, nullable=False, server_default='0'),
+    Column('error', Text),
+    Column('stage', Text, nullable=False, server_default='queued'),
+    # JSON list of [stage, ISO time]
+    Column('timings', Text),
+    Column('next_attempt', DateTime, nullable=False),
+    Column('created', DateTime, nullable=False),
+    Column('modified', DateTime, nullable=False),
+    # entries due (senders)
+    Index('datacite_outbox_state_next_attempt_idx', 'state', 'next_attempt'),
+    # entries of a dataset
+    Index('datacite_outbox_entity_idx', 'entity_id'),
+)
+
+
+def is_enabled():
+    return asbool(config.get('datacite_publication.outbox', False))
+
+
+def setup():
+    """Creates the outbox table in the CKAN database if it does not exist"""
+    if not datacite_outbox.exists(bind=meta.engine):
+        datacite_outbox.create(bind=meta.engine)
+        log.info('Created table datacite_outbox')
+
+
+def _as_dict(row):
+    if row is None:
+        return None
+    entry = dict(row)
+    entry['data'] = json.loads(entry['data']) if entry['data'] else {}
+    entry['timings'] = json.loads(entry['timings']) if entry['timings'] else []
+    return entry
+
+
+@contextlib.contextmanager
+def _connection(session=None):
+    """The session if given (committed by its owner), otherwise a connection of the CKAN engine in
+       its own transaction, committed on exit whatever is pending in model.Session
+    """
+    if session is not None:
+        yield session
+    else:
+        with meta.engine.begin() as connection:
+            yield connection
+
+
+def add(operation, entity_id, doi, user_name, data=None, entity_type='package', session=None):
+    """Records an operation to send to DataCite in the session of the action requesting it (default
+       model.Session, not committed), returns the entry
+    """
+    session = session or model.Session
+    now = datetime.datetime.utcnow()
+    entry = {'id': str(uuid.uuid4()), 'entity_id': entity_id, 'entity_type': entity_type, 'operation': operation,
+             'doi': doi, 'user_name': user_name, 'data': json.dumps(data or {}), 'state': PENDING, 'attempts': 0,
+             'error': None, 'stage': 'queued', 'timings': json.dumps([['queued', now.isoformat()]]),
+             'next_attempt': now, 'created': now, 'modified': now}
+    session.execute(datacite_outbox.insert().values(**entry))
+    entry['data'] = data or {}
+    entry['timings'] = json.loads(entry['timings'])
+    return entry
+
+
+def get(entry_id, session=None):
+    with _connection(session) as connection:
+        return _as_dict(connection.execute(
+            datacite_outbox.select().where(datacite_outbox.c.id == entry_id)).first())
+
+
+def get_pending(entity_id, operation, session=None):
+    """Returns the entry of the entity and operation not sent yet, None if there is none"""
+    with _connection(session) as connection:
+        return _as_dict(connection.execute(
+            datacite_outbox.select()
+            .where(datacite_outbox.c.entity_id == entity_id)
+            .where(datacite_outbox.c.operation == operation)
+            .where(datacite_outbox.c.state.in_([PENDING, SENDING]))
+            .order_by(datacite_outbox.c.created)).first())
+
+
+def get_due_ids(limit=100, session=None):
+    """Ids of the entries to send now, oldest first, including the ones claimed by a sender that died"""
+    query = sqlalchemy.select([datacite_outbox.c.id])\
+        .where(datacite_outbox.c.state.in_([PENDING, SENDING]))\
+        .where(datacite_outbox.c.next_attempt <= datetime.datetime.utcnow())\
+        .order_by(datacite_outbox.c.created)\
+        .limit(limit)
+    with _connection(session) as connection:
+        return [entry_id for (entry_id,) in connection.execute(query).fetchall()]
+
+
+def claim(entry_id, lease=600, session=None):
+    """Marks a due entry as being sent for lease seconds, returns it or None if it is not due (sent,
+       or claimed by another sender)
+    """
+    now = datetime.datetime.utcnow()
+    with _connection(session) as connection:
+        claimed = connection.execute(
+            datacite_outbox.update()
+            .where(datacite_outbox.c.id == entry_id)
+            .where(datacite_outbox.c.state.in_([PENDING, SENDING]))
+            .where(datacite_outbox.c.next_attempt <= now)
+            .values(state=SENDING, attempts=datacite_outbox.c.attempts + 1,
+                    next_attempt=now + datetime.timedelta(seconds=lease), modified=now)).rowcount
+    if not claimed:
+        return None
+    return get(entry_id, session)
+
+
+def _update_entry(entry_id, session=None, stages=(), **values):
+    # stages: (stage, time reached or None for now), the last one is the current stage
+    now = datetime.datetime.utcnow()
+    with _connection(session) as connection:
+        if stages:
+            timings = connection.execute(sqlalchemy.select([datacite_outbox.c.timings])
+                                         .where(datacite_outbox.c.id == entry_id)).scalar()
+            timings = json.loads(timings) if timings else []
+            timings += [[stage, (reached or now).isoformat()] for stage, reached in stages]
+            values.update(stage=stages[-1][0], timings=json.dumps(timings))
+        connection.execute(datacite_outbox.update().where(datacite_outbox.c.id == entry_id)
+                           .values(modified=now, **values))
+
+
+def set_stage(entry_id, stage, session=None):
+    """Records the stage reached by an entry being sent, committed right away for the clients polling it"""
+    _update_entry(entry_id, session, stages=[(stage, None)])
+
+
+def complete(entry_id, session=None, sent=None):
+    """Marks an entry as done, in the session committing the dataset change it completes or right away.
+       sent: when DataCite accepted it, recorded as the stage sent once the change is persisted
+    """
+    stages = [('sent', sent)] if sent else []
+    _update_entry(entry_id, session, stages=stages + [('done', None)], state=DONE, error=None)
+
+
+def retry(entry_id, error, delay, session=None):
+    _update_entry(entry_id, session, stages=[('queued', None)], state=PENDING, error=error,
+                  next_attempt=datetime.datetime.utcnow() + datetime.timedelta(seconds=delay))
+
+
+def fail(entry_id, error, session=None):
+    _update_entry(entry_id, session, stages=[('failed', None)], state=FAILED, error=error)
+
+
+def get_status(entry):
+    """Status of an entry for the clients: stage, state, error and the seconds spent in each stage"""
+    now = datetime.datetime.utcnow()
+    timings = []
+    for i, (stage, started) in enumerate(entry['timings']):
+        started = datetime.datetime.strptime(started, '%Y-%m-%dT%H:%M:%S.%f') if '.' in started \
+            else datetime.datetime.strptime(started, '%Y-%m-%dT%H:%M:%S')
+        timings.append({'stage': stage, 'started': started})
+        if i > 0:
+            timings[i - 1]['seconds'] = (started - timings[i - 1]['started']).total_seconds()
+    if timings:
+        last = timings[-1]
+        last['seconds'] = 0.0 if last['stage'] in FINAL_STAGES else (now - last['started']).total_seconds()
+        elapsed = (last['started'] - timings[0]['started']).total_seconds() + last['seconds']
+    else:
+        elapsed = None
+    for timing in timings:
+        timing['started'] = timing['started'].isoformat()
+    return {'id': entry['id'], 'entity_id': entry['entity_id'], 'entity_type': entry['entity_type'],
+            'operation': entry['operation'], 'doi': entry['doi'], 'stage': entry['stage'], 'state': entry['state'],
+            'finished': entry['stage'] in FINAL_STAGES, 'attempts': entry['attempts'], 'error': entry['error'],
+            'next_attempt': entry['next_attempt'].isoformat() if entry['state'] == PENDING else None,
+            'created': entry['created'].isoformat(), 'modified': entry['modified'].isoformat(),
+            'timings': timings, 'elapsed': elapsed}
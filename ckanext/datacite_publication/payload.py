@@ -0,0 +1,75 @@
+import binascii
+import json
+import re
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# formatting between tags (runs of whitespace with a line break), text content is left as is
+_FORMATTING_WHITESPACE = re.compile(rb'>[ \t\r]*\n[ \t\r\n]*<')
+
+# replaced by the base64 XML in the serialized JSON
+_XML_PLACEHOLDER = '@xml@'
+
+# the XML is normalized and encoded by chunks of about this size
+CHUNK_SIZE = 1024 * 1024
+
+
+def iter_normalized_xml(xml, chunk_size=CHUNK_SIZE):
+    """Yields the XML (str or bytes) as UTF-8 bytes without the formatting whitespace between tags, by chunks.
+       The chunks are cut just after a '<', so that a whitespace run between tags is never split.
+    """
+    is_str = isinstance(xml, str)
+    tag_start = '<' if is_str else b'<'
+    length = len(xml)
+    start = 0
+    while start < length:
+        end = length
+        if start + chunk_size < length:
+            end = xml.rfind(tag_start, start, start + chunk_size) + 1
+            if end <= start:
+                end = start + chunk_size
+        chunk = xml[start:end]
+        if is_str:
+            chunk = chunk.encode('utf-8')
+        yield b'><'.join(_FORMATTING_WHITESPACE.split(chunk))
+        start = end
+
+
+def normalize_xml(xml):
+    """Returns the XML as UTF-8 bytes without the formatting whitespace between tags"""
+    return b''.join(iter_normalized_xml(xml))
+
+
+def iter_base64(chunks):
+    """Yields the base64 encoding of the concatenated chunks, by chunks"""
+    remainder = b''
+    for chunk in chunks:
+        if remainder:
+            chunk = remainder + chunk
+        # base64 of whole 3 byte groups can be concatenated
+        cut = len(chunk) - len(chunk) % 3
+        remainder = chunk[cut:]
+        yield binascii.b2a_base64(chunk[:cut], newline=False)
+    yield binascii.b2a_base64(remainder, newline=False)
+
+
+def build_payload(doi, url, xml, update=False):
+    """Returns the JSON body (bytes) of the DataCite REST API request publishing (POST) or updating (PUT)
+       a DOI. The XML is normalized and base64 encoded by chunks, joined once to the serialized
+       attributes as bytes, without going through str or json.dumps.
+    """
+    attributes = {
+        # TODO check for update if this state is correct
+        'event': '' if update else 'publish',
+        'doi': doi,
+        'url': url,
+        'xml': _XML_PLACEHOLDER
+    }
+    head, tail = json.dumps({'data': {'id': doi.strip(), 'type': 'dois', 'attributes': attributes}})\
+        .rsplit(json.dumps(_XML_PLACEHOLDER), 1)
+
+    # base64 only has JSON safe characters
+    return b''.join([head.encode('utf-8'), b'"'] + list(iter_base64(iter_normalized_xml(xml))) +
+                    [b'"', tail.encode('utf-8')])
@@ -4,14 +4,20 @@ import ckan.plugins.toolkit as toolkit
 import ckanext.datacite_publication.logic
 import ckanext.datacite_publication.helpers as helpers
 import ckanext.datacite_publication.blueprints as blueprints
+import ckanext.datacite_publication.cli as cli
+import ckanext.datacite_publication.idempotency as idempotency
+import ckanext.datacite_publication.minter_registry as minter_registry
+import ckanext.datacite_publication.model as outbox
 
 
 class Datacite_PublicationPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IActions)
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.IRoutes, inherit=True)
     plugins.implements(plugins.IBlueprint, inherit=True)
+    plugins.implements(plugins.IClick)
 
     # IConfigurer
     def update_config(self, config_):
@@ -19,6 +25,14 @@ class Datacite_PublicationPlugin(plugins.SingletonPlugin):
         toolkit.add_public_directory(config_, 'public')
         # toolkit.add_resource('fanstatic', 'datacite_publication')
 
+    # IConfigurable
+    def configure(self, config_):
+        minter_registry.configure(config_)
+        if outbox.is_enabled():
+            outbox.setup()
+        if idempotency.is_enabled():
+            idempotency.setup()
+
     # ITemplateHelpers
     def get_helpers(self):
         return {'datacite_publication_is_admin': helpers.datacite_publication_is_admin,
@@ -77,6 +91,8 @@ class Datacite_PublicationPlugin(plugins.SingletonPlugin):
                 ckanext.datacite_publication.logic.datacite_make_public_package,
             'datacite_publish_package':
                 ckanext.datacite_publication.logic.datacite_publish_package,
+            'datacite_publish_package_bulk':
+                ckanext.datacite_publication.logic.datacite_publish_package_bulk,
             'datacite_approve_publication_package':
                 ckanext.datacite_publication.logic.datacite_approve_publication_package,
             'datacite_manual_finish_publication_package':
@@ -85,10 +101,21 @@ class Datacite_PublicationPlugin(plugins.SingletonPlugin):
                 ckanext.datacite_publication.logic.datacite_finish_publication_package,
             'datacite_update_publication_package':
                 ckanext.datacite_publication.logic.datacite_update_publication_package,
+            'datacite_update_publication_package_bulk':
+                ckanext.datacite_publication.logic.datacite_update_publication_package_bulk,
             'datacite_publish_resource':
-                ckanext.datacite_publication.logic.datacite_publish_resource
+                ckanext.datacite_publication.logic.datacite_publish_resource,
+            'datacite_export_doi_index':
+                ckanext.datacite_publication.logic.datacite_export_doi_index,
+            'datacite_api_status':
+                ckanext.datacite_publication.logic.datacite_api_status,
+            'datacite_publication_status':
+                ckanext.datacite_publication.logic.datacite_publication_status
         }
 
     def get_blueprint(self):
         return blueprints.get_blueprints(self.name, self.__module__)
 
+    # IClick
+    def get_commands(self):
+        return cli.get_commands()
@@ -125,6 +125,7 @@ CREATE TABLE public.doi_realisation (
     ckan_user text DEFAULT 'admin' NOT NULL,
     metadata text NOT NULL,
     metadata_format text DEFAULT 'ckan'::text,
+    datacite_hash text,
     ckan_entity public.ckan_entity_type DEFAULT 'package'::public.ckan_entity_type NOT NULL,
     date_created timestamp without time zone DEFAULT now() NOT NULL,
     date_modified timestamp without time zone DEFAULT now() NOT NULL
@@ -136,7 +137,9 @@ ALTER TABLE ONLY public.doi_realisation
     ADD CONSTRAINT unique_ckan_id_site_entity UNIQUE (ckan_id, site_id, ckan_entity);
 
 ALTER TABLE ONLY public.doi_realisation
-    ADD CONSTRAINT unique_doi_site UNIQUE (prefix_id, suffix_id, site_id);
+    ADD CONSTRAINT unique_doi UNIQUE (prefix_id, suffix_id);
+
+CREATE INDEX doi_realisation_site_entity_created_idx ON public.doi_realisation USING btree (site_id, ckan_entity, date_created);
 
 CREATE TRIGGER doi_inserted_tr BEFORE INSERT ON public.doi_realisation FOR EACH ROW WHEN ((new.suffix_id IS NULL)) EXECUTE PROCEDURE public.insert_doi_suffix_fn();
 CREATE TRIGGER doi_modified_tr BEFORE UPDATE ON public.doi_realisation FOR EACH ROW EXECUTE PROCEDURE public.update_doi_modified_fn();
@@ -147,6 +150,27 @@ ALTER TABLE ONLY public.doi_realisation
 ALTER TABLE ONLY public.doi_realisation
     ADD CONSTRAINT site_id_fk FOREIGN KEY (site_id) REFERENCES public.ckan_site(site_id);
 
+-- TABLE doi_suffix_lease
+-- Suffix numbers leased in blocks by the minting processes (datacite_publication.suffix_block_size)
+
+CREATE TABLE public.doi_suffix_lease (
+    lease_pk SERIAL PRIMARY KEY,
+    prefix_id text NOT NULL,
+    tag_id text NOT NULL,
+    value bigint NOT NULL,
+    lease_id text NOT NULL,
+    owner text NOT NULL,
+    expires timestamp without time zone NOT NULL
+);
+
+ALTER TABLE public.doi_suffix_lease OWNER TO postgres;
+
+ALTER TABLE ONLY public.doi_suffix_lease
+    ADD CONSTRAINT unique_doi_suffix_lease UNIQUE (prefix_id, tag_id, value);
+
+CREATE INDEX doi_suffix_lease_lease_id_idx ON public.doi_suffix_lease USING btree (lease_id);
+CREATE INDEX doi_suffix_lease_expires_idx ON public.doi_suffix_lease USING btree (prefix_id, tag_id, expires);
+
 -- access rights
 REVOKE ALL ON SCHEMA public FROM PUBLIC;
 REVOKE ALL ON SCHEMA public FROM postgres;
@@ -158,6 +182,8 @@ REVOKE ALL ON TABLE public.doi_realisation FROM postgres;
 GRANT ALL ON TABLE public.doi_realisation TO postgres;
 GRANT SELECT ON TABLE public.doi_realisation TO ckan_default;
 GRANT INSERT, UPDATE ON TABLE public.doi_realisation TO ckan_default;
+REVOKE ALL ON TABLE public.doi_suffix_lease FROM PUBLIC;
+GRANT SELECT, INSERT, UPDATE, DELETE ON TABLE public.doi_suffix_lease TO ckan_default;
 GRANT USAGE, SELECT ON ALL SEQUENCES IN SCHEMA public TO ckan_default;
 
 -- Edit the lines below to add prefixes and create the sequences
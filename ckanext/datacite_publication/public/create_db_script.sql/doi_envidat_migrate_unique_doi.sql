@@ -0,0 +1,33 @@
+-- MIGRATION unique_doi_site (prefix_id, suffix_id, site_id) -> unique_doi (prefix_id, suffix_id)
+-- For databases created with an older doi_envidat_create.sql: a DOI is unique whatever the site.
+-- Fails without changing anything if a DOI is registered for several sites, fix them first:
+--   SELECT prefix_id, suffix_id, count(*) FROM public.doi_realisation GROUP BY prefix_id, suffix_id HAVING count(*) > 1;
+
+BEGIN;
+
+DO $$
+DECLARE
+    duplicates integer;
+BEGIN
+    SELECT count(*) INTO duplicates FROM (
+        SELECT prefix_id, suffix_id FROM public.doi_realisation GROUP BY prefix_id, suffix_id HAVING count(*) > 1
+    ) AS duplicated;
+    IF duplicates > 0 THEN
+        RAISE EXCEPTION '% DOIs are registered more than once in doi_realisation, fix them before migrating', duplicates;
+    END IF;
+END;
+$$;
+
+ALTER TABLE ONLY public.doi_realisation
+    DROP CONSTRAINT IF EXISTS unique_doi_site;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'unique_doi') THEN
+        ALTER TABLE ONLY public.doi_realisation
+            ADD CONSTRAINT unique_doi UNIQUE (prefix_id, suffix_id);
+    END IF;
+END;
+$$;
+
+COMMIT;
@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+import uuid
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# Compact time ordered suffixes (ULID like): milliseconds since the epoch (10 characters) followed by
+# random characters, in Crockford's base32, and a check character (Damm algorithm over GF(32)) that
+# detects any single mistyped character and any swap of two adjacent characters.
+SUFFIX_GENERATORS = ['uuid', 'ulid']
+
+ALPHABET = '0123456789abcdefghjkmnpqrstvwxyz'
+# Crockford's base32 is case insensitive and reads i, l as 1 and o as 0
+_DECODING = dict([(char, value) for value, char in enumerate(ALPHABET)] +
+                 [(char.upper(), value) for value, char in enumerate(ALPHABET)] +
+                 [('i', 1), ('I', 1), ('l', 1), ('L', 1), ('o', 0), ('O', 0)])
+
+TIME_LENGTH = 10
+RANDOM_LENGTH = 8
+
+_RANDOM_MAX = 32 ** RANDOM_LENGTH
+
+# last generated value, incremented within the same millisecond to keep the order
+_last = {'timestamp': 0, 'random': 0}
+_lock = threading.Lock()
+
+
+def _encode(value, length):
+    chars = []
+    for i in range(length):
+        chars.append(ALPHABET[value & 31])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+
+def _double(value):
+    # multiplication by x in GF(32) = GF(2)[x]/(x^5 + x^2 + 1)
+    value <<= 1
+    if value & 32:
+        value ^= 0b100101
+    return value
+
+
+def _damm(values):
+    # quasigroup a * b = 2a + b, totally anti-symmetric
+    interim = 0
+    for value in values:
+        interim = _double(interim) ^ value
+    return interim
+
+
+def checksum(suffix):
+    """Returns the check character of a base32 string"""
+    return ALPHABET[_double(_damm(_decode(suffix)))]
+
+
+def _decode(suffix):
+    try:
+        return [_DECODING[char] for char in suffix]
+    except KeyError as e:
+        raise ValueError('Invalid character {0} in suffix "{1}"'.format(e, suffix))
+
+
+def is_valid_suffix(suffix, tag=''):
+    """Checks a checksummed suffix (after the optional tag), e.g. a custom DOI typed by an admin"""
+    if tag and suffix.startswith(tag):
+        suffix = suffix[len(tag):]
+    if len(suffix) < 2:
+        return False
+    try:
+        return _damm(_decode(suffix)) == 0
+    except ValueError:
+        return False
+
+
+def get_timestamp(suffix, tag=''):
+    """Returns the creation time (seconds since the epoch) of a generated suffix"""
+    if tag and suffix.startswith(tag):
+        suffix = suffix[len(tag):]
+    timestamp = 0
+    for value in _decode(suffix[:TIME_LENGTH]):
+        timestamp = timestamp * 32 + value
+    return timestamp / 1000.0
+
+
+def generate_ulids(count=1):
+    """Returns count new checksummed suffixes, in increasing order"""
+    suffixes = []
+    with _lock:
+        timestamp = int(time.time() * 1000)
+        if timestamp <= _last['timestamp']:
+            timestamp = _last['timestamp']
+            random = _last['random'] + 1
+        else:
+            random = int.from_bytes(os.urandom(5), 'big') % _RANDOM_MAX
+        for i in range(count):
+            if random >= _RANDOM_MAX:
+                # random part exhausted in this millisecond, borrow the next one
+                timestamp += 1
+                random = int.from_bytes(os.urandom(5), 'big') % _RANDOM_MAX
+            suffixes.append(_encode(timestamp, TIME_LENGTH) + _encode(random, RANDOM_LENGTH))
+            random += 1
+        _last['timestamp'] = timestamp
+        _last['random'] = random - 1
+    return [suffix + checksum(suffix) for suffix in suffixes]
+
+
+def generate_suffixes(count=1, generator='uuid'):
+    """Returns count new suffixes of the given generator (uuid or ulid)"""
+    if generator == 'uuid':
+        return [str(uuid.uuid4()) for i in range(count)]
+    elif generator == 'ulid':
+        return generate_ulids(count)
+    raise ValueError('Unknown suffix generator "{0}", allowed: {1}'.format(generator,
+                                                                          ', '.join(SUFFIX_GENERATORS)))
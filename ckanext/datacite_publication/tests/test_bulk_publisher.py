@@ -0,0 +1,86 @@
+"""Tests for bulk_publisher.py."""
+import threading
+import time
+
+import pytest
+
+from ckanext.datacite_publication.bulk_publisher import BulkPublisher
+
+
+class Publisher(object):
+    """DatacitePublisher sending nowhere, recording the threads it runs in"""
+
+    def __init__(self, validation_time=0.0, errors=None):
+        self.validation_time = validation_time
+        self.errors = errors or {}
+        self.threads = []
+        self.sent = []
+
+    def export_package(self, pkg, context={}):
+        if pkg['id'] == 'missing':
+            raise ValueError('Dataset not found')
+        return '<resource>{0}</resource>'.format(pkg['id'])
+
+    def validate_xml(self, xml):
+        self.threads.append(threading.current_thread())
+        time.sleep(self.validation_time)
+        return 'invalid' not in xml
+
+    def get_package_url(self, pkg):
+        return 'https://envidat.ch/dataset/' + pkg['id']
+
+    def build_payload(self, doi, url, xml, update=False):
+        return xml.encode('utf-8')
+
+    def check_package_identifiers(self, doi, pkg, deadline=None):
+        return None
+
+    def send_payload(self, doi, payload, update=False, deadline=None):
+        self.sent.append(doi)
+        error = self.errors.get(doi)
+        return (None, error) if error else (doi, None)
+
+
+def _item(name, **kwargs):
+    return dict({'doi': '10.5072/' + name, 'pkg': {'id': name}}, **kwargs)
+
+
+@pytest.fixture
+def deadline_config(ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, 'datacite_publication.publish_deadline', '0')
+
+
+@pytest.mark.usefixtures('deadline_config')
+class TestBulkPublisher(object):
+
+    def test_results_in_order(self):
+        publisher = Publisher(errors={'10.5072/failed': 'HTTP Code: 500'})
+        items = [_item('first'), _item('invalid'), _item('missing'), _item('failed'), _item('last', update=True)]
+        results = BulkPublisher(publisher, concurrency=2, rate=0, burst=0).publish_many(items)
+
+        assert [result['doi'] for result in results] == [item['doi'] for item in items]
+        assert [result['success'] for result in results] == [True, False, False, False, True]
+        assert results[1]['error'] == 'Dataset XML validation failed'
+        assert 'Dataset not found' in results[2]['error']
+        assert results[3]['error'] == 'HTTP Code: 500'
+        assert sorted(publisher.sent) == ['10.5072/failed', '10.5072/first', '10.5072/last']
+
+    def test_preparation_off_the_event_loop(self):
+        publisher = Publisher(validation_time=0.2)
+        start = time.monotonic()
+        results = BulkPublisher(publisher, concurrency=4, rate=0, burst=0).publish_many(
+            [_item('dataset{0}'.format(i)) for i in range(4)])
+        assert all(result['success'] for result in results)
+        # validated in the thread pool, concurrently
+        assert threading.main_thread() not in publisher.threads
+        assert time.monotonic() - start < 0.6
+
+    def test_rate(self):
+        publisher = Publisher()
+        start = time.monotonic()
+        BulkPublisher(publisher, concurrency=4, rate=20, burst=1).publish_many(
+            [_item('dataset{0}'.format(i)) for i in range(5)])
+        assert time.monotonic() - start >= 0.15
+
+    def test_nothing_to_send(self):
+        assert BulkPublisher(Publisher(), concurrency=2, rate=0, burst=0).publish_many([]) == []
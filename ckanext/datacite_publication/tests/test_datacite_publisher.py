@@ -0,0 +1,232 @@
+"""Tests for the circuit breaker of datacite_publisher.py."""
+import json
+
+import pytest
+import requests
+
+import ckanext.datacite_publication.datacite_publisher as datacite_publisher
+from ckanext.datacite_publication.datacite_publisher import CircuitBreaker, CircuitOpenError, LookupCache
+
+
+def _open(circuit_breaker):
+    for i in range(circuit_breaker.failure_threshold):
+        circuit_breaker.before_request()
+        circuit_breaker.record_failure('HTTP 503')
+
+
+class TestCircuitBreaker(object):
+
+    def test_opens_after_consecutive_failures(self):
+        circuit_breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=60)
+        circuit_breaker.record_failure('HTTP 500')
+        circuit_breaker.record_failure('HTTP 500')
+        circuit_breaker.record_success()
+        assert circuit_breaker.state == CircuitBreaker.CLOSED
+
+        _open(circuit_breaker)
+        assert circuit_breaker.is_open()
+        with pytest.raises(CircuitOpenError):
+            circuit_breaker.before_request()
+        state = circuit_breaker.get_state()
+        assert state['state'] == CircuitBreaker.OPEN
+        assert state['rejected'] == 1
+        assert state['last_failure'] == 'HTTP 503'
+        assert 0 < state['retry_in'] <= 60
+
+    def test_half_open_single_trial(self):
+        circuit_breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0)
+        _open(circuit_breaker)
+        circuit_breaker.before_request()
+        assert circuit_breaker.state == CircuitBreaker.HALF_OPEN
+        # only one trial request at a time
+        with pytest.raises(CircuitOpenError):
+            circuit_breaker.before_request()
+
+    def test_half_open_closes_on_success(self):
+        circuit_breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0)
+        _open(circuit_breaker)
+        circuit_breaker.before_request()
+        circuit_breaker.record_success()
+        assert circuit_breaker.state == CircuitBreaker.CLOSED
+        assert circuit_breaker.failures == 0
+        circuit_breaker.before_request()
+
+    def test_half_open_opens_again_on_failure(self):
+        circuit_breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=0)
+        _open(circuit_breaker)
+        circuit_breaker.before_request()
+        # a single failed trial is enough
+        circuit_breaker.record_failure('timeout')
+        assert circuit_breaker.is_open()
+
+    def test_rate_limited_is_neutral(self):
+        circuit_breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0)
+        circuit_breaker.record_failure('HTTP 503')
+        circuit_breaker.before_request()
+        circuit_breaker.record_neutral()
+        # the failures are not reset
+        assert circuit_breaker.failures == 1
+        circuit_breaker.record_failure('HTTP 503')
+        assert circuit_breaker.is_open()
+
+        # a rate limited trial ends the trial without closing the circuit
+        circuit_breaker.before_request()
+        circuit_breaker.record_neutral()
+        assert circuit_breaker.state == CircuitBreaker.HALF_OPEN
+        circuit_breaker.before_request()
+
+
+class TestLookupCache(object):
+
+    def test_fresh_then_revalidated(self):
+        lookup_cache = LookupCache(ttl=60)
+        assert lookup_cache.get('10.5072/envidat.1') == (None, None, False)
+        lookup_cache.put('10.5072/envidat.1', ['dataset-id'], etag='"v1"')
+        assert lookup_cache.get('10.5072/envidat.1') == (['dataset-id'], '"v1"', True)
+
+        # expired, kept with its ETag for a conditional request
+        lookup_cache.ttl = 0
+        lookup_cache.put('10.5072/envidat.1', ['dataset-id'], etag='"v1"')
+        assert lookup_cache.get('10.5072/envidat.1') == (['dataset-id'], '"v1"', False)
+        lookup_cache.ttl = 60
+        lookup_cache.refresh('10.5072/envidat.1')
+        assert lookup_cache.get('10.5072/envidat.1')[2]
+        assert lookup_cache.get_state()['hits'] == 2
+        assert lookup_cache.get_state()['revalidated'] == 1
+
+    def test_least_recently_used_dropped(self):
+        lookup_cache = LookupCache(ttl=60, max_size=2)
+        lookup_cache.put('10.5072/envidat.1', ['first'])
+        lookup_cache.put('10.5072/envidat.2', ['second'])
+        lookup_cache.get('10.5072/envidat.1')
+        lookup_cache.put('10.5072/envidat.3', ['third'])
+        assert lookup_cache.get('10.5072/envidat.2') == (None, None, False)
+        assert lookup_cache.get('10.5072/envidat.1')[0] == ['first']
+
+    def test_invalidate(self):
+        lookup_cache = LookupCache(ttl=60)
+        lookup_cache.put('10.5072/envidat.1', ['first'])
+        lookup_cache.put('10.5072/envidat.2', ['second'])
+        lookup_cache.invalidate('10.5072/envidat.1')
+        assert lookup_cache.get('10.5072/envidat.1') == (None, None, False)
+        lookup_cache.invalidate()
+        assert lookup_cache.get_state()['size'] == 0
+
+
+class Response(object):
+
+    def __init__(self, status_code, data=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._data = data or {}
+
+    @property
+    def content(self):
+        return json.dumps(self._data).encode('utf-8')
+
+    def json(self):
+        return self._data
+
+
+def _doi_data(*ids):
+    return {'data': {'id': '10.5072/envidat.1', 'attributes': {'alternateIdentifiers': [
+        {'alternateIdentifierType': 'URL', 'alternateIdentifier': 'https://envidat.ch/dataset/' + package_id}
+        for package_id in ids]}}}
+
+
+class TestRequest(object):
+
+    @pytest.fixture
+    def publisher(self, ckan_config, monkeypatch):
+        monkeypatch.setitem(ckan_config, 'datacite_publication.datacite_url', 'https://api.test.datacite.org/dois')
+        monkeypatch.setitem(ckan_config, 'datacite_publication.http.retries', '0')
+        return datacite_publisher.DatacitePublisher()
+
+    def _stub(self, monkeypatch, circuit_breaker, errors, lookup_cache=None, sent=None):
+        # errors raised or responses returned in turn, the requests recorded in sent
+        class Session(object):
+            def request(self, method, url, **kwargs):
+                if sent is not None:
+                    sent.append((method, kwargs.get('headers') or {}))
+                error = errors.pop(0)
+                if isinstance(error, Exception):
+                    raise error
+                return error
+
+        monkeypatch.setattr(datacite_publisher.DatacitePublisher, 'session', property(lambda self: Session()))
+        monkeypatch.setattr(datacite_publisher.DatacitePublisher, 'circuit_breaker',
+                            property(lambda self: circuit_breaker))
+        monkeypatch.setattr(datacite_publisher.DatacitePublisher, 'lookup_cache',
+                            property(lambda self: lookup_cache))
+
+    @pytest.mark.parametrize('error', [requests.exceptions.ChunkedEncodingError('truncated'),
+                                       requests.exceptions.ContentDecodingError('gzip'),
+                                       requests.exceptions.TooManyRedirects('loop'),
+                                       ValueError('other')])
+    def test_any_error_ends_the_trial(self, publisher, monkeypatch, error):
+        circuit_breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0)
+        self._stub(monkeypatch, circuit_breaker, [requests.exceptions.ConnectTimeout('down'), error])
+
+        with pytest.raises(requests.exceptions.ConnectTimeout):
+            publisher.request('GET', 'lookup', publisher.datacite_url)
+        assert circuit_breaker.is_open()
+
+        # half open trial failing with another error
+        with pytest.raises(type(error)):
+            publisher.request('GET', 'lookup', publisher.datacite_url)
+        assert circuit_breaker.is_open()
+        assert circuit_breaker.get_state()['last_failure'] == str(error)
+
+        # a new trial is let through after reset_timeout
+        circuit_breaker.before_request()
+        assert circuit_breaker.state == CircuitBreaker.HALF_OPEN
+
+    def test_rate_limited_does_not_reset_failures(self, publisher, monkeypatch):
+        circuit_breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=60)
+        self._stub(monkeypatch, circuit_breaker, [Response(503), Response(429), Response(503)])
+        for i in range(3):
+            publisher.request('GET', 'lookup', publisher.datacite_url)
+        assert circuit_breaker.is_open()
+
+    @pytest.mark.parametrize('error', [requests.exceptions.ConnectionError('refused'),
+                                       requests.exceptions.ChunkedEncodingError('truncated'),
+                                       requests.exceptions.Timeout('slow')])
+    def test_send_payload_errors(self, publisher, monkeypatch, error):
+        circuit_breaker = CircuitBreaker('test', failure_threshold=5, reset_timeout=60)
+        self._stub(monkeypatch, circuit_breaker, [error])
+        doi, message = publisher.send_payload('10.5072/envidat.1', b'{}', update=True)
+        assert doi is None
+        assert str(error) in message
+
+    def test_send_payload(self, publisher, monkeypatch):
+        circuit_breaker = CircuitBreaker('test', failure_threshold=5, reset_timeout=60)
+        self._stub(monkeypatch, circuit_breaker, [Response(201, {'data': {'id': '10.5072/envidat.1'}})])
+        assert publisher.send_payload('10.5072/envidat.1', b'{}') == ('10.5072/envidat.1', None)
+
+    def test_lookup_revalidated_with_etag(self, publisher, monkeypatch):
+        circuit_breaker = CircuitBreaker('test', failure_threshold=5, reset_timeout=60)
+        lookup_cache = LookupCache(ttl=60)
+        sent = []
+        self._stub(monkeypatch, circuit_breaker, [Response(200, _doi_data('dataset-id'), {'ETag': '"v1"'}),
+                                                  Response(304),
+                                                  Response(200, _doi_data('other-id'), {'ETag': '"v2"'})],
+                   lookup_cache=lookup_cache, sent=sent)
+
+        assert publisher.get_doi_identifiers('10.5072/envidat.1') == ['dataset-id']
+        # fresh, no request
+        assert publisher.get_doi_identifiers('10.5072/envidat.1') == ['dataset-id']
+        assert len(sent) == 1
+
+        # expired, not modified
+        lookup_cache.ttl = 0
+        lookup_cache.put('10.5072/envidat.1', ['dataset-id'], etag='"v1"')
+        lookup_cache.ttl = 60
+        assert publisher.get_doi_identifiers('10.5072/envidat.1') == ['dataset-id']
+        assert sent[1][1] == {'If-None-Match': '"v1"'}
+        assert lookup_cache.get_state()['revalidated'] == 1
+
+        # dropped after our own update, read again
+        publisher.invalidate_doi('10.5072/envidat.1')
+        assert publisher.get_doi_identifiers('10.5072/envidat.1') == ['other-id']
+        assert sent[2][1] == {}
+        assert lookup_cache.get('10.5072/envidat.1')[1] == '"v2"'
@@ -0,0 +1,243 @@
+"""Tests for doi_db_index.py, on the DOI index embedded in SQLite."""
+import datetime
+
+import pytest
+import sqlalchemy
+
+import ckanext.datacite_publication.doi_db_index as doi_db_index
+import ckanext.datacite_publication.doi_db_schema as doi_db_schema
+
+PREFIX = '10.5072'
+
+
+@pytest.fixture
+def index_config(ckan_config, monkeypatch):
+    # every test gets its own in-memory database
+    monkeypatch.setattr(doi_db_index, '_engines', {})
+    monkeypatch.setattr(doi_db_index, '_tables', {})
+    monkeypatch.setattr(doi_db_index, '_suffix_pools', {})
+    for key, value in [('datacite_publication.doi_prefix', PREFIX),
+                       ('datacite_publication.sqlalchemy.url', 'sqlite://'),
+                       ('datacite_publication.site_id', 'envidat')]:
+        monkeypatch.setitem(ckan_config, key, value)
+    return ckan_config
+
+
+@pytest.fixture
+def minter(index_config):
+    return doi_db_index.DataciteIndexDOI()
+
+
+@pytest.fixture
+def leasing_minter(index_config, monkeypatch):
+    monkeypatch.setitem(index_config, 'datacite_publication.suffix_block_size', '5')
+    return doi_db_index.DataciteIndexDOI()
+
+
+def _pkg(name):
+    return {'id': 'id-' + name, 'name': name, 'title': name.title()}
+
+
+def _expire_leases(minter):
+    past = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    minter.con.execute(doi_db_schema.doi_suffix_lease.update().values(expires=past))
+    for pool in doi_db_index._suffix_pools.values():
+        pool.expires = past
+
+
+class TestMint(object):
+
+    def test_mint(self, minter):
+        assert minter.mint(PREFIX, pkg=_pkg('first'), user='admin') == (PREFIX + '/envidat.1', None)
+        assert minter.mint(PREFIX, pkg=_pkg('second'), user='admin') == (PREFIX + '/envidat.2', None)
+        assert minter.is_doi_valid(PREFIX + '/envidat.1', 'id-first')
+        assert not minter.is_doi_valid(PREFIX + '/envidat.2', 'id-first')
+
+    def test_mint_custom_suffix(self, minter):
+        assert minter.mint(PREFIX, pkg=_pkg('first'), suffix='custom') == (PREFIX + '/custom', None)
+        assert minter.is_doi_existing(PREFIX, 'custom')
+
+    def test_mint_already_published(self, minter):
+        doi, error = minter.mint(PREFIX, pkg=_pkg('first'))
+        assert minter.mint(PREFIX, pkg=_pkg('first')) == \
+            (None, 'ERROR minting DOI: Dataset already published, DOI: ' + doi)
+
+    def test_mint_existing_suffix(self, minter):
+        minter.mint(PREFIX, pkg=_pkg('first'), suffix='custom')
+        assert minter.mint(PREFIX, pkg=_pkg('second'), suffix='custom') == (None, 'ERROR minting DOI: Already exists')
+        assert minter.is_dataset_published('id-second', 'package') == (False, '')
+
+    def test_mint_entities(self, minter):
+        assert minter.mint(PREFIX, pkg=_pkg('first'))[1] is None
+        # the same id as another entity type
+        assert minter.mint(PREFIX, pkg=_pkg('first'), entity='resource')[1] is None
+
+    def test_mint_many(self, minter):
+        minter.mint(PREFIX, pkg=_pkg('published'))
+        results = minter.mint_many(PREFIX, [_pkg('first'), _pkg('published'), _pkg('second')], user='admin')
+        assert results[0] == (PREFIX + '/envidat.2', None)
+        assert results[1] == (None, 'ERROR minting DOI: Dataset already published, DOI: ' + PREFIX + '/envidat.1')
+        assert results[2][1] is None
+        assert minter.mint_many(PREFIX, []) == []
+
+    def test_metadata(self, minter):
+        pkg = dict(_pkg('first'), notes='été')
+        doi, error = minter.mint(PREFIX, pkg=pkg)
+        assert minter.get_doi_metadata(*doi.split('/', 1)) == pkg
+        assert minter.get_doi_metadata(PREFIX, 'unknown') is None
+
+    def test_metadata_encodings(self, index_config, monkeypatch):
+        monkeypatch.setitem(index_config, 'datacite_publication.metadata.encoding', 'zlib')
+        monkeypatch.setitem(index_config, 'datacite_publication.metadata.fields', 'id name')
+        minter = doi_db_index.DataciteIndexDOI()
+        doi, error = minter.mint(PREFIX, pkg=_pkg('first'))
+        assert minter.get_doi_metadata(*doi.split('/', 1)) == {'id': 'id-first', 'name': 'first'}
+
+
+class TestUpdate(object):
+
+    def test_update_datacite_hash(self, minter):
+        doi, error = minter.mint(PREFIX, pkg=_pkg('first'))
+        prefix, suffix = doi.split('/', 1)
+        assert minter.get_datacite_hash(prefix, suffix) is None
+
+        pkg = dict(_pkg('first'), title='New title')
+        assert minter.update(prefix, pkg=pkg, user='editor', suffix=suffix, datacite_hash='abc') == (doi, None)
+        assert minter.get_datacite_hash(prefix, suffix) == 'abc'
+        assert minter.get_doi_metadata(prefix, suffix)['title'] == 'New title'
+
+        # the hash is kept when an update does not send one
+        minter.update(prefix, pkg=pkg, suffix=suffix)
+        assert minter.get_datacite_hash(prefix, suffix) == 'abc'
+
+    def test_set_datacite_hash(self, minter):
+        doi, error = minter.mint(PREFIX, pkg=_pkg('first'))
+        prefix, suffix = doi.split('/', 1)
+        assert minter.set_datacite_hash(prefix, suffix, 'abc')
+        assert minter.get_datacite_hash(prefix, suffix) == 'abc'
+        assert not minter.set_datacite_hash(prefix, 'unknown', 'abc')
+
+    def test_datacite_hash_from_primary(self, index_config, monkeypatch, tmp_path):
+        # replica not up to date
+        read_url = 'sqlite:///' + str(tmp_path / 'replica.db')
+        doi_db_schema.init_db(doi_db_index.get_engine(read_url))
+        monkeypatch.setitem(index_config, 'datacite_publication.sqlalchemy.read_url', read_url)
+        minter = doi_db_index.DataciteIndexDOI()
+        doi, error = minter.mint(PREFIX, pkg=_pkg('first'))
+        prefix, suffix = doi.split('/', 1)
+        minter.set_datacite_hash(prefix, suffix, 'abc')
+        assert minter.get_datacite_hash(prefix, suffix) is None
+        assert minter.get_datacite_hash(prefix, suffix, primary=True) == 'abc'
+
+    def test_update_errors(self, minter):
+        doi, error = minter.mint(PREFIX, pkg=_pkg('first'))
+        prefix, suffix = doi.split('/', 1)
+        minter.mint(PREFIX, pkg=_pkg('second'))
+        assert minter.update(prefix, pkg=_pkg('first'), suffix='unknown') == \
+            (None, 'ERROR updating DOI: Does not exist')
+        assert minter.update(prefix, pkg=_pkg('third'), suffix=suffix) == \
+            (None, 'ERROR updating DOI: package (id-third) not yet published')
+        assert minter.update(prefix, pkg=_pkg('second'), suffix=suffix) == \
+            (None, 'ERROR updating DOI: package (id-second) published with different DOI ' + PREFIX + '/envidat.2')
+
+
+class TestIterDois(object):
+
+    @pytest.fixture
+    def dois(self, minter):
+        dates = [datetime.datetime(2020, 1, 1), datetime.datetime(2021, 1, 1), datetime.datetime(2022, 1, 1)]
+        for i, date_created in enumerate(dates):
+            doi, error = minter.mint(PREFIX, pkg=_pkg('dataset{0}'.format(i)))
+            minter.mint(PREFIX, pkg=_pkg('resource{0}'.format(i)), entity='resource')
+            doi_realisation = minter.doi_realisation
+            minter.con.execute(doi_realisation.update()
+                               .where(doi_realisation.c.suffix_id == doi.split('/', 1)[1])
+                               .values(date_created=date_created))
+        return minter
+
+    def test_all(self, dois):
+        rows = list(dois.iter_dois())
+        assert len(rows) == 6
+        assert [row['doi_pk'] for row in rows] == sorted(row['doi_pk'] for row in rows)
+        assert rows[0]['doi'] == PREFIX + '/envidat.1'
+        assert 'metadata' not in rows[0]
+
+    def test_entity_type(self, dois):
+        assert [row['ckan_name'] for row in dois.iter_dois(entity_type='resource')] == \
+            ['resource0', 'resource1', 'resource2']
+
+    def test_dates(self, dois):
+        rows = dois.iter_dois(entity_type='package', date_from=datetime.datetime(2021, 1, 1),
+                              date_to=datetime.datetime(2022, 1, 1))
+        assert [row['ckan_name'] for row in rows] == ['dataset1']
+
+    def test_after_and_limit(self, dois):
+        rows = list(dois.iter_dois(limit=2, batch_size=1))
+        assert len(rows) == 2
+        rows = list(dois.iter_dois(after=rows[-1]['doi_pk']))
+        assert len(rows) == 4
+
+    def test_metadata(self, dois):
+        row = next(dois.iter_dois(include_metadata=True))
+        assert row['metadata'] == _pkg('dataset0')
+
+    def test_other_site(self, dois, index_config, monkeypatch):
+        monkeypatch.setitem(index_config, 'datacite_publication.site_id', 'other')
+        assert list(doi_db_index.DataciteIndexDOI().iter_dois()) == []
+
+
+class TestSuffixLeases(object):
+
+    def test_leased_suffixes(self, leasing_minter):
+        dois = [leasing_minter.mint(PREFIX, pkg=_pkg('dataset{0}'.format(i)))[0] for i in range(7)]
+        assert dois == [PREFIX + '/envidat.{0}'.format(i) for i in range(1, 8)]
+
+    def test_unused_suffix_returned(self, leasing_minter):
+        leasing_minter.mint(PREFIX, pkg=_pkg('first'))
+        assert leasing_minter.mint(PREFIX, pkg=_pkg('first'))[0] is None
+        assert leasing_minter.mint(PREFIX, pkg=_pkg('second'))[0] == PREFIX + '/envidat.2'
+
+    def test_expired_lease_reclaimed(self, leasing_minter):
+        assert leasing_minter.mint(PREFIX, pkg=_pkg('first'))[0] == PREFIX + '/envidat.1'
+        _expire_leases(leasing_minter)
+
+        # another process reclaims the unused suffixes of the expired lease
+        other_pool = doi_db_index.SuffixPool(leasing_minter.url, PREFIX, leasing_minter.suffix_tag)
+        leasing_minter._lease_suffix_block(other_pool, 5)
+        assert list(other_pool.values) == [2, 3, 4, 5, 6]
+
+        # this process does not hand them out anymore
+        assert leasing_minter.mint(PREFIX, pkg=_pkg('second')) == (PREFIX + '/envidat.7', None)
+
+    def test_expiring_lease_not_handed_out(self, index_config, monkeypatch):
+        monkeypatch.setitem(index_config, 'datacite_publication.suffix_block_size', '5')
+        monkeypatch.setitem(index_config, 'datacite_publication.suffix_block_ttl', '100')
+        minter = doi_db_index.DataciteIndexDOI()
+        minter.mint(PREFIX, pkg=_pkg('first'))
+        # within the safety margin (a tenth of the TTL) of the end of the lease
+        pool = doi_db_index.get_suffix_pool(minter.url, PREFIX, minter.suffix_tag)
+        pool.expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=5)
+        assert minter.mint(PREFIX, pkg=_pkg('second'))[0] == PREFIX + '/envidat.6'
+
+    def test_taken_suffix_retried(self, leasing_minter):
+        leasing_minter.mint(PREFIX, pkg=_pkg('first'))
+        # the next leased suffixes used meanwhile by another process
+        leasing_minter.mint(PREFIX, pkg=_pkg('other1'), suffix='envidat.2')
+        leasing_minter.mint(PREFIX, pkg=_pkg('other2'), suffix='envidat.3')
+        assert leasing_minter.mint(PREFIX, pkg=_pkg('second')) == (PREFIX + '/envidat.4', None)
+
+    def test_taken_suffix_retried_many(self, leasing_minter):
+        leasing_minter.mint(PREFIX, pkg=_pkg('first'))
+        leasing_minter.mint(PREFIX, pkg=_pkg('other'), suffix='envidat.3')
+        results = leasing_minter.mint_many(PREFIX, [_pkg('second'), _pkg('third')])
+        assert [error for doi, error in results] == [None, None]
+        assert results[0][0] == PREFIX + '/envidat.2'
+        assert results[1][0] != PREFIX + '/envidat.3'
+
+    def test_release_leases(self, leasing_minter):
+        leasing_minter.mint(PREFIX, pkg=_pkg('first'))
+        doi_db_index.release_suffix_leases()
+        doi_suffix_lease = doi_db_schema.doi_suffix_lease
+        expires = leasing_minter.con.execute(sqlalchemy.select([sqlalchemy.func.max(doi_suffix_lease.c.expires)]))\
+            .scalar()
+        assert expires <= datetime.datetime.utcnow()
@@ -0,0 +1,68 @@
+"""Tests for doi_db_schema.py."""
+import pytest
+import sqlalchemy
+
+import ckanext.datacite_publication.doi_db_schema as doi_db_schema
+
+
+def _create_old_database(engine):
+    # doi_realisation of the older create script, DOIs unique per site only
+    metadata = sqlalchemy.MetaData()
+    doi_db_schema.ckan_site.tometadata(metadata)
+    doi_db_schema.doi_prefix.tometadata(metadata)
+    table = doi_db_schema.doi_realisation.tometadata(metadata)
+    for constraint in list(table.constraints):
+        if constraint.name == 'unique_doi':
+            table.constraints.remove(constraint)
+    table.append_constraint(sqlalchemy.UniqueConstraint('prefix_id', 'suffix_id', 'site_id', name='unique_doi_site'))
+    metadata.create_all(engine)
+    return table
+
+
+def _insert(engine, table, suffix, site_id, ckan_id):
+    engine.execute(table.insert().values(prefix_id='10.5072', suffix_id=suffix, site_id=site_id, ckan_id=ckan_id,
+                                         ckan_name=ckan_id, metadata='{}'))
+
+
+@pytest.fixture
+def engine():
+    return sqlalchemy.create_engine('sqlite://')
+
+
+def test_init_db(engine):
+    doi_db_schema.init_db(engine)
+    assert doi_db_schema.check_db(engine) == []
+
+
+def test_add_prefixes_and_sites(engine):
+    doi_db_schema.init_db(engine)
+    assert doi_db_schema.add_prefixes_and_sites(engine, ['10.5072'], ['envidat']) == (['10.5072'], ['envidat'])
+    assert doi_db_schema.add_prefixes_and_sites(engine, ['10.5072', '10.1234'], ['envidat']) == (['10.1234'], [])
+
+
+def test_obsolete_constraint_reported(engine):
+    _create_old_database(engine)
+    problems = doi_db_schema.check_db(engine)
+    assert 'Missing unique index unique_doi on doi_realisation (prefix_id, suffix_id)' in problems
+    assert 'Obsolete unique constraint unique_doi_site on doi_realisation (prefix_id, suffix_id, site_id), ' \
+           'replaced by unique_doi' in problems
+
+
+def test_unique_doi_created(engine):
+    table = _create_old_database(engine)
+    _insert(engine, table, 'envidat.1', 'envidat', 'first')
+    assert 'unique_doi' in doi_db_schema.create_missing_indexes(engine)
+    assert doi_db_schema.get_missing_indexes(engine) == []
+    with pytest.raises(sqlalchemy.exc.IntegrityError):
+        _insert(engine, table, 'envidat.1', 'other', 'second')
+
+
+def test_duplicates_reported(engine):
+    table = _create_old_database(engine)
+    _insert(engine, table, 'envidat.1', 'envidat', 'first')
+    _insert(engine, table, 'envidat.1', 'other', 'second')
+    assert doi_db_schema.get_duplicates(engine, ['prefix_id', 'suffix_id']) == [('10.5072', 'envidat.1')]
+    # not created until the duplicates are fixed
+    assert 'unique_doi' not in doi_db_schema.create_missing_indexes(engine)
+    problems = doi_db_schema.check_db(engine)
+    assert any(problem.startswith('1 duplicated values of (prefix_id, suffix_id)') for problem in problems)
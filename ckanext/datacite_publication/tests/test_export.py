@@ -0,0 +1,71 @@
+"""Tests for export.py."""
+import csv
+import datetime
+import io
+import json
+import uuid
+
+import pytest
+
+import ckanext.datacite_publication.export as export
+
+ROWS = [
+    {'doi': '10.5072/envidat.1', 'prefix_id': '10.5072', 'suffix_id': 'envidat.1',
+     'ckan_id': uuid.UUID('c3a8a5e0-7a4b-4a9e-9f3c-2f1d8c6b5a41'), 'ckan_name': 'snow-depth', 'ckan_entity': 'package',
+     'ckan_user': 'admin', 'site_id': 'envidat', 'tag_id': 'envidat.', 'metadata_format': 'ckan',
+     'datacite_hash': None, 'date_created': datetime.datetime(2020, 1, 2, 3, 4, 5),
+     'date_modified': datetime.datetime(2020, 1, 3), 'doi_pk': 1},
+    {'doi': '10.5072/envidat.2', 'prefix_id': '10.5072', 'suffix_id': 'envidat.2',
+     'ckan_id': 'f0e1d2c3-b4a5-4697-8877-665544332211', 'ckan_name': 'name, with "quotes"',
+     'ckan_entity': 'resource', 'ckan_user': 'admin', 'site_id': 'envidat', 'tag_id': 'envidat.',
+     'metadata_format': 'ckan', 'datacite_hash': 'abc', 'date_created': datetime.datetime(2021, 5, 6),
+     'date_modified': datetime.datetime(2021, 5, 6), 'doi_pk': 2},
+]
+
+
+def test_ndjson():
+    lines = list(export.iter_export(ROWS, 'ndjson'))
+    assert len(lines) == 2
+    assert all(line.endswith('\n') for line in lines)
+    first = json.loads(lines[0])
+    assert first['doi'] == '10.5072/envidat.1'
+    assert first['ckan_id'] == 'c3a8a5e0-7a4b-4a9e-9f3c-2f1d8c6b5a41'
+    assert first['date_created'] == '2020-01-02T03:04:05'
+    assert first['doi_pk'] == 1
+
+
+def test_csv():
+    chunks = list(export.iter_export(ROWS, 'csv'))
+    # header with the first row, then one row at a time
+    assert len(chunks) == 2
+    rows = list(csv.DictReader(io.StringIO(''.join(chunks))))
+    assert list(rows[0].keys()) == export.CSV_COLUMNS
+    assert rows[0]['date_created'] == '2020-01-02T03:04:05'
+    assert rows[0]['datacite_hash'] == ''
+    assert rows[1]['ckan_name'] == 'name, with "quotes"'
+    assert rows[1]['ckan_entity'] == 'resource'
+
+
+def test_csv_without_rows():
+    assert list(export.iter_export([], 'csv')) == [','.join(export.CSV_COLUMNS) + '\r\n']
+
+
+def test_export_is_lazy():
+    def rows():
+        yield ROWS[0]
+        raise AssertionError('read too far')
+    assert json.loads(next(export.iter_export(rows(), 'ndjson')))['suffix_id'] == 'envidat.1'
+    assert 'envidat.1' in next(export.iter_export(rows(), 'csv'))
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        list(export.iter_export(ROWS, 'xml'))
+
+
+def test_parse_date():
+    assert export.parse_date('') is None
+    assert export.parse_date('2020-01-02') == datetime.datetime(2020, 1, 2)
+    assert export.parse_date('2020-01-02T03:04:05') == datetime.datetime(2020, 1, 2, 3, 4, 5)
+    with pytest.raises(ValueError):
+        export.parse_date('yesterday')
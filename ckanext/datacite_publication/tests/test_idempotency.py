@@ -0,0 +1,183 @@
+"""Tests for idempotency.py and the requests run once per dataset in logic.py."""
+import contextlib
+import datetime
+import threading
+
+import pytest
+import sqlalchemy
+import sqlalchemy.orm
+
+import ckanext.datacite_publication.idempotency as idempotency
+import ckanext.datacite_publication.logic as logic
+
+
+@pytest.fixture
+def session():
+    engine = sqlalchemy.create_engine('sqlite://')
+    idempotency.metadata.create_all(engine)
+    session = sqlalchemy.orm.Session(bind=engine)
+    yield session
+    session.close()
+
+
+class TestResults(object):
+
+    def test_saved_per_user(self, session):
+        result = {'success': True, 'error': None, 'pending': True, 'outbox_id': 'entry-id'}
+        idempotency.save_result('key', 'editor', 'publish', 'dataset-id', result, session=session)
+        assert idempotency.get_result('key', 'editor', session=session) == {
+            'operation': 'publish', 'entity_id': 'dataset-id', 'result': result}
+        assert idempotency.get_result('key', 'other', session=session) is None
+
+    def test_expired(self, session, ckan_config, monkeypatch):
+        monkeypatch.setitem(ckan_config, 'datacite_publication.idempotency_ttl', '60')
+        idempotency.save_result('key', 'editor', 'publish', 'dataset-id', {'success': True}, session=session)
+        session.execute(idempotency.datacite_idempotency.update().values(
+            created=datetime.datetime.utcnow() - datetime.timedelta(seconds=61)))
+        assert idempotency.get_result('key', 'editor', session=session) is None
+
+
+class TestLocks(object):
+
+    def test_local_lock(self):
+        held = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with idempotency._local_lock('dataset', timeout=5) as waited:
+                assert not waited
+                held.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        held.wait(5)
+        with pytest.raises(idempotency.LockTimeout):
+            with idempotency._local_lock('dataset', timeout=0.1):
+                pass
+        threading.Timer(0.1, release.set).start()
+        with idempotency._local_lock('dataset', timeout=5) as waited:
+            assert waited
+        thread.join()
+        assert idempotency._local_locks == {}
+
+    def test_advisory_lock_timeout(self):
+        class Error(Exception):
+            pgcode = '55P03'
+
+        class Session(object):
+            rolled_back = False
+
+            def execute(self, statement):
+                sql = str(statement)
+                if 'pg_advisory_xact_lock' in sql and 'try' not in sql:
+                    raise sqlalchemy.exc.OperationalError(sql, {}, Error('lock timeout'))
+                return self
+
+            def scalar(self):
+                # held by another transaction
+                return False
+
+            def rollback(self):
+                self.rolled_back = True
+
+        session = Session()
+        with pytest.raises(idempotency.LockTimeout):
+            with idempotency._advisory_lock('dataset', 1, session):
+                pass
+        assert session.rolled_back
+
+
+class Package(object):
+    id = 'dataset-id'
+
+    @classmethod
+    def get(cls, id_or_name):
+        return cls if id_or_name in [cls.id, 'dataset'] else None
+
+
+class TestRunOnce(object):
+
+    @pytest.fixture
+    def results(self, monkeypatch):
+        results = {}
+        monkeypatch.setattr(logic.ckan.model, 'Package', Package)
+        monkeypatch.setattr(logic, '_get_username_from_context', lambda context: context.get('user', ''))
+        monkeypatch.setattr(idempotency, 'get_result', lambda key, user_name: results.get((key, user_name)))
+        monkeypatch.setattr(idempotency, 'save_result', lambda key, user_name, operation, entity_id, result:
+                            results.__setitem__((key, user_name), {'operation': operation, 'entity_id': entity_id,
+                                                                   'result': result}))
+        monkeypatch.setattr(idempotency, 'dataset_lock', lambda package_id: idempotency._local_lock(package_id, 1))
+        return results
+
+    @pytest.fixture
+    def admins(self, monkeypatch):
+        admins = ['admin']
+        monkeypatch.setattr(logic.authz, 'is_authorized',
+                            lambda action, context, data_dict=None: {'success': context.get('user') in
+                                                                     ['admin', 'editor']})
+        monkeypatch.setattr(logic.helpers, 'datacite_publication_is_admin', lambda name=None: name in admins)
+        return admins
+
+    def test_replayed(self, results, admins):
+        runs = []
+
+        def run(data_dict, context):
+            runs.append(data_dict['id'])
+            return {'success': True, 'error': None}
+
+        data_dict = {'id': 'dataset', 'idempotency_key': 'key'}
+        assert logic._run_once('publish', data_dict, {'user': 'admin'}, run) == {'success': True, 'error': None}
+        assert logic._run_once('publish', data_dict, {'user': 'admin'}, run)['replayed']
+        assert runs == ['dataset']
+
+        # the key of another request
+        with pytest.raises(logic.toolkit.ValidationError):
+            logic._run_once('update', data_dict, {'user': 'admin'}, run)
+
+    def test_failures_run_again(self, results, admins):
+        runs = []
+
+        def run(data_dict, context):
+            runs.append(data_dict['id'])
+            return {'success': False, 'error': 'HTTP 503'}
+
+        data_dict = {'id': 'dataset', 'idempotency_key': 'key'}
+        logic._run_once('publish', data_dict, {'user': 'admin'}, run)
+        logic._run_once('publish', data_dict, {'user': 'admin'}, run)
+        assert runs == ['dataset', 'dataset']
+
+    def test_replay_authorized_as_the_operation(self, results, admins):
+        def run(data_dict, context):
+            return {'success': True, 'error': None}
+
+        data_dict = {'id': 'dataset', 'idempotency_key': 'key'}
+        logic._run_once('approve', data_dict, {'user': 'editor'}, run)
+        # no longer an admin, package_update is not enough
+        admins.remove('admin')
+        admins.append('editor')
+        assert logic._run_once('approve', data_dict, {'user': 'editor'}, run)['replayed']
+        admins.remove('editor')
+        with pytest.raises(logic.toolkit.NotAuthorized):
+            logic._run_once('approve', data_dict, {'user': 'editor'}, run)
+
+    def test_duplicate_authorized_as_the_operation(self, results, admins, monkeypatch):
+        @contextlib.contextmanager
+        def waited_lock(package_id):
+            yield True
+
+        monkeypatch.setattr(idempotency, 'dataset_lock', waited_lock)
+        monkeypatch.setattr(logic.ckan.model.Session, 'expire_all', lambda: None, raising=False)
+        monkeypatch.setattr(logic.toolkit, 'get_action', lambda name: lambda context, data_dict: {
+            'id': 'dataset-id', 'publication_state': 'approved'})
+        runs = []
+
+        def run(data_dict, context):
+            runs.append(context['user'])
+            raise logic.toolkit.NotAuthorized({'permissions': ['admin only']})
+
+        assert logic._run_once('approve', {'id': 'dataset'}, {'user': 'admin'}, run)['duplicate']
+        # run, and refused, for the editor
+        with pytest.raises(logic.toolkit.NotAuthorized):
+            logic._run_once('approve', {'id': 'dataset'}, {'user': 'editor'}, run)
+        assert runs == ['editor']
@@ -0,0 +1,63 @@
+"""Tests for the publication state changes of logic.py."""
+import pytest
+
+import ckanext.datacite_publication.logic as logic
+
+
+class TestChangeDataset(object):
+
+    @pytest.fixture
+    def actions(self, monkeypatch):
+        # calls of the actions and commits, package_update refuses the unknown states like a schema would
+        calls = []
+
+        def package_update(context, data_dict):
+            calls.append(('package_update', data_dict))
+            if data_dict.get('publication_state') not in ['', 'pub_pending', 'approved', 'published']:
+                raise logic.toolkit.ValidationError({'publication_state': ['Value must be one of the states']})
+            return dict(data_dict, metadata_modified='2026-10-18T12:00:00')
+
+        def package_patch(context, data_dict):
+            calls.append(('package_patch', data_dict))
+            return package_update(context, dict({'id': data_dict['id'], 'name': 'dataset'}, **data_dict))
+
+        actions = {'package_update': package_update, 'package_patch': package_patch}
+        monkeypatch.setattr(logic.toolkit, 'get_action', lambda name: actions[name])
+        monkeypatch.setattr(logic, '_add_activity', lambda dataset_dict, message, context, commit=True:
+                            calls.append(('activity', message)))
+        monkeypatch.setattr(logic.ckan.model.repo, 'commit', lambda: calls.append(('commit', None)))
+        monkeypatch.setattr(logic.outbox, 'complete', lambda entry_id, session=None, sent=None:
+                            calls.append(('complete', entry_id)))
+        return calls
+
+    def test_package_update_by_default(self, actions):
+        dataset_dict = {'id': 'dataset-id', 'name': 'dataset', 'notes': 'notes', 'publication_state': ''}
+        logic._change_dataset(dataset_dict, {'session': None}, 'approve', 'approved', activity='approved',
+                              publication_state='approved', private=False)
+        assert actions[0] == ('package_update', {'id': 'dataset-id', 'name': 'dataset', 'notes': 'notes',
+                                                 'publication_state': 'approved', 'private': False})
+        assert [name for name, args in actions[1:]] == ['activity', 'commit']
+        assert dataset_dict['publication_state'] == 'approved'
+        assert dataset_dict['metadata_modified'] == '2026-10-18T12:00:00'
+
+    def test_minimal_state_update(self, actions, ckan_config, monkeypatch):
+        monkeypatch.setitem(ckan_config, 'datacite_publication.minimal_state_update', 'true')
+        dataset_dict = {'id': 'dataset-id', 'name': 'dataset', 'notes': 'notes', 'publication_state': ''}
+        logic._change_dataset(dataset_dict, {'session': None}, 'approve', 'approved',
+                              publication_state='approved', private=False)
+        assert actions[0] == ('package_patch', {'id': 'dataset-id', 'publication_state': 'approved',
+                                                'private': False})
+        assert actions[-1] == ('commit', None)
+
+    @pytest.mark.parametrize('minimal', ['false', 'true'])
+    def test_invalid_state_not_persisted(self, actions, ckan_config, monkeypatch, minimal):
+        monkeypatch.setitem(ckan_config, 'datacite_publication.minimal_state_update', minimal)
+        dataset_dict = {'id': 'dataset-id', 'name': 'dataset', 'publication_state': 'approved'}
+        context = {'session': None, 'datacite_outbox_entry': 'entry-id'}
+        with pytest.raises(logic.toolkit.ValidationError):
+            logic._change_dataset(dataset_dict, context, 'publish', 'published', activity='published',
+                                  publication_state='unknown')
+        # no activity, no commit, the outbox entry is not completed
+        assert [name for name, args in actions if name not in ['package_update', 'package_patch']] == []
+        assert dataset_dict['publication_state'] == 'approved'
+        assert context['datacite_outbox_entry'] == 'entry-id'
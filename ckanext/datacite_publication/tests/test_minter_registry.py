@@ -0,0 +1,82 @@
+"""Tests for minter_registry.py."""
+import pytest
+
+import ckanext.datacite_publication.minter_registry as minter_registry
+from ckanext.datacite_publication.minter import DatacitePublicationMinter
+
+MODULE = 'ckanext.datacite_publication.tests.test_minter_registry'
+
+
+class WarmMinter(DatacitePublicationMinter):
+    warm_ups = []
+
+    def warm_up(self):
+        self.warm_ups.append(self)
+
+
+class OtherMinter(DatacitePublicationMinter):
+    pass
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    monkeypatch.setattr(minter_registry, '_minters', {})
+    monkeypatch.setattr(minter_registry, '_prefix_minters', {})
+    monkeypatch.setattr(minter_registry, '_configured', False)
+    monkeypatch.setattr(minter_registry, '_warm_up', False)
+    monkeypatch.setattr(minter_registry, '_warmed_up_pid', None)
+    WarmMinter.warm_ups = []
+
+
+def test_default_minter():
+    minter_registry.configure({})
+    minter = minter_registry.get_minter('10.5072')
+    assert type(minter) is DatacitePublicationMinter
+    # instantiated once
+    assert minter_registry.get_minter() is minter
+
+
+def test_prefix_minters():
+    minter_registry.configure({'datacite_publication.minter': MODULE + '.WarmMinter',
+                               'datacite_publication.minters': 'other:' + MODULE + '.OtherMinter',
+                               'datacite_publication.prefix_minters': '10.12345:other'})
+    assert isinstance(minter_registry.get_minter('10.5072'), WarmMinter)
+    assert isinstance(minter_registry.get_minter('10.12345'), OtherMinter)
+    assert isinstance(minter_registry.get_minter(name='other'), OtherMinter)
+    with pytest.raises(ValueError):
+        minter_registry.get_minter(name='unknown')
+
+
+def test_undefined_prefix_minter():
+    with pytest.raises(ValueError):
+        minter_registry.configure({'datacite_publication.prefix_minters': '10.12345:other'})
+
+
+def test_no_warm_up_by_default():
+    minter_registry.configure({'datacite_publication.minter': MODULE + '.WarmMinter'})
+    minter_registry.get_minter()
+    assert WarmMinter.warm_ups == []
+
+
+def test_warm_up_on_first_use_per_process(monkeypatch):
+    minter_registry.configure({'datacite_publication.minter': MODULE + '.WarmMinter',
+                               'datacite_publication.minter_warm_up': 'true'})
+    # not when configured, before the web server forks
+    assert WarmMinter.warm_ups == []
+
+    minter = minter_registry.get_minter()
+    minter_registry.get_minter()
+    assert WarmMinter.warm_ups == [minter]
+
+    # forked worker
+    monkeypatch.setattr(minter_registry.os, 'getpid', lambda: -1)
+    minter_registry.get_minter()
+    assert WarmMinter.warm_ups == [minter, minter]
+
+
+def test_warm_up_from_post_fork_hook():
+    minter_registry.configure({'datacite_publication.minter': MODULE + '.WarmMinter',
+                               'datacite_publication.minter_warm_up': 'true'})
+    minter_registry.warm_up()
+    minter_registry.get_minter()
+    assert len(WarmMinter.warm_ups) == 1
@@ -0,0 +1,204 @@
+"""Tests for the DataCite outbox (model.py) and its sender in logic.py."""
+import datetime
+
+import pytest
+import sqlalchemy
+import sqlalchemy.orm
+
+import ckanext.datacite_publication.logic as logic
+import ckanext.datacite_publication.model as outbox
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    # a file, the outbox has its own connections
+    engine = sqlalchemy.create_engine('sqlite:///' + str(tmp_path / 'ckan.db'))
+    outbox.metadata.create_all(engine)
+    monkeypatch.setattr(outbox.meta, 'engine', engine)
+    return engine
+
+
+@pytest.fixture
+def session(engine):
+    session = sqlalchemy.orm.Session(bind=engine)
+    yield session
+    session.close()
+
+
+def _add(session, operation=outbox.PUBLISH):
+    entry = outbox.add(operation, 'dataset-id', '10.5072/envidat.1', 'admin', session=session)
+    session.commit()
+    return entry
+
+
+def _make_due(engine, entry_id):
+    engine.execute(outbox.datacite_outbox.update().where(outbox.datacite_outbox.c.id == entry_id)
+                   .values(next_attempt=datetime.datetime.utcnow()))
+
+
+def _stages(entry_id):
+    return [stage for stage, started in outbox.get(entry_id)['timings']]
+
+
+class TestOutbox(object):
+
+    def test_claim(self, session):
+        entry = _add(session)
+        assert outbox.get_pending('dataset-id', outbox.PUBLISH)['id'] == entry['id']
+        assert outbox.get_due_ids() == [entry['id']]
+
+        claimed = outbox.claim(entry['id'], lease=600)
+        assert claimed['state'] == outbox.SENDING
+        assert claimed['attempts'] == 1
+        # reserved for the lease
+        assert outbox.claim(entry['id']) is None
+        assert outbox.get_due_ids() == []
+
+    def test_claim_after_lease(self, session):
+        entry = _add(session)
+        outbox.claim(entry['id'], lease=0)
+        # the sender died, claimed again by another one
+        assert outbox.claim(entry['id'])['attempts'] == 2
+
+    def test_stages_committed_on_own_connection(self, session):
+        entry = _add(session)
+        outbox.set_stage(entry['id'], 'exporting')
+        session.rollback()
+        assert outbox.get(entry['id'])['stage'] == 'exporting'
+
+    def test_done_with_the_dataset_change(self, session):
+        entry = _add(session)
+        outbox.claim(entry['id'])
+        sent = datetime.datetime.utcnow()
+
+        # rolled back with the dataset change
+        outbox.complete(entry['id'], session=session, sent=sent)
+        assert outbox.get(entry['id'])['state'] == outbox.SENDING
+        session.rollback()
+        assert outbox.get(entry['id'])['state'] == outbox.SENDING
+        assert 'sent' not in _stages(entry['id'])
+
+        outbox.complete(entry['id'], session=session, sent=sent)
+        session.commit()
+        done = outbox.get(entry['id'])
+        assert done['state'] == outbox.DONE
+        assert _stages(entry['id']) == ['queued', 'sent', 'done']
+        assert done['timings'][1][1] == sent.isoformat()
+        assert outbox.get_pending('dataset-id', outbox.PUBLISH) is None
+
+    def test_status(self, session):
+        entry = _add(session)
+        outbox.set_stage(entry['id'], 'sending')
+        status = outbox.get_status(outbox.get(entry['id']))
+        assert status['stage'] == 'sending'
+        assert not status['finished']
+        assert [timing['stage'] for timing in status['timings']] == ['queued', 'sending']
+
+
+class TestProcessOutboxEntry(object):
+
+    @pytest.fixture
+    def sender(self, engine, ckan_config, monkeypatch):
+        monkeypatch.setitem(ckan_config, 'datacite_publication.outbox.max_attempts', '2')
+        monkeypatch.setitem(ckan_config, 'datacite_publication.outbox.backoff', '60')
+        dataset_dict = {'id': 'dataset-id', 'name': 'dataset', 'publication_state': 'approved'}
+        monkeypatch.setattr(logic.toolkit, 'get_action', lambda name: lambda context, data_dict: dict(dataset_dict))
+        sent = []
+
+        def send(results):
+            def _send_publication(dataset_dict, doi, context, deadline=None, on_stage=None, retried=False):
+                sent.append(retried)
+                on_stage('sending')
+                return results.pop(0)
+            monkeypatch.setattr(logic, '_send_publication', _send_publication)
+            return sent
+        return send
+
+    def test_retry_then_fail(self, sender, session, engine):
+        sent = sender([{'success': False, 'error': 'HTTP 503'}, {'success': False, 'error': 'HTTP 503'}])
+        entry = _add(session)
+
+        result = logic.process_outbox_entry(entry['id'])
+        assert not result['success']
+        retried = outbox.get(entry['id'])
+        assert retried['state'] == outbox.PENDING
+        assert retried['error'] == 'HTTP 503'
+        assert retried['next_attempt'] > datetime.datetime.utcnow() + datetime.timedelta(seconds=50)
+        assert _stages(entry['id']) == ['queued', 'sending', 'queued']
+        # not due before the backoff
+        assert logic.process_outbox_entry(entry['id']) is None
+
+        _make_due(engine, entry['id'])
+        logic.process_outbox_entry(entry['id'])
+        assert outbox.get(entry['id'])['state'] == outbox.FAILED
+        assert sent == [False, True]
+
+    def test_done(self, sender, session):
+        sender([{'success': True, 'error': None}])
+        entry = _add(session)
+        assert logic.process_outbox_entry(entry['id'])['success']
+        assert outbox.get(entry['id'])['state'] == outbox.DONE
+
+
+class Publisher(object):
+
+    def __init__(self, registered):
+        self.registered = registered
+
+    def export_package(self, pkg, context):
+        return '<resource/>'
+
+    def get_package_url(self, pkg):
+        return 'https://envidat.ch/dataset/' + pkg['name']
+
+    def get_publication_hash(self, xml, url):
+        return 'hash'
+
+    def publish(self, doi, **kwargs):
+        return None, 'Error publishing to DataCite: HTTP Code: 422, error: This DOI has already been taken'
+
+    def is_doi_registered(self, doi, pkg, deadline=None):
+        return self.registered
+
+
+class TestSendPublication(object):
+
+    @pytest.fixture
+    def changes(self, monkeypatch):
+        changes = []
+        monkeypatch.setattr(logic, '_record_publication_hash', lambda doi, publication_hash: None)
+        monkeypatch.setattr(logic, '_change_dataset', lambda dataset_dict, context, transition, *args, **fields:
+                            changes.append(fields['publication_state']))
+        monkeypatch.setattr(logic, 'datacite_finished_mail', lambda *args, **kwargs: None)
+        return changes
+
+    @pytest.mark.parametrize('retried, registered, success', [(True, True, True),
+                                                               (True, False, False),
+                                                               (False, True, False)])
+    def test_already_registered(self, changes, monkeypatch, retried, registered, success):
+        monkeypatch.setattr(logic, 'DatacitePublisher', lambda: Publisher(registered))
+        dataset_dict = {'id': 'dataset-id', 'name': 'dataset', 'publication_state': 'approved'}
+        result = logic._send_publication(dataset_dict, '10.5072/envidat.1', {}, retried=retried)
+        assert result['success'] == success
+        assert changes == (['published'] if success else [])
+
+
+def test_update_exported_by_the_sender(ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, 'datacite_publication.outbox', 'true')
+    monkeypatch.setitem(ckan_config, 'datacite_publication.doi_prefix', '10.5072')
+    dataset_dict = {'id': 'dataset-id', 'name': 'dataset', 'publication_state': 'published',
+                    'doi': '10.5072/envidat.1'}
+    monkeypatch.setattr(logic.toolkit, 'get_action', lambda name: lambda context, data_dict: dict(dataset_dict))
+    monkeypatch.setattr(logic.authz, 'is_authorized', lambda action, context, data_dict=None: {'success': True})
+    monkeypatch.setattr(logic.helpers, 'datacite_publication_is_admin', lambda user=None: True)
+    monkeypatch.setattr(logic.minter_registry, 'get_minter', lambda prefix=None, name=None: object())
+
+    def no_publisher():
+        raise AssertionError('exported in the request')
+    monkeypatch.setattr(logic, 'DatacitePublisher', no_publisher)
+    added = []
+    monkeypatch.setattr(logic, '_add_to_outbox', lambda operation, dataset_dict, doi, context, data=None:
+                        added.append((operation, doi, data)) or {'success': True, 'pending': True})
+
+    assert logic._update_in_datacite({'id': 'dataset-id', 'force': 'false'}, {})['pending']
+    assert added == [(outbox.UPDATE, '10.5072/envidat.1', {'force': False})]
@@ -0,0 +1,81 @@
+"""Tests for payload.py."""
+import base64
+import json
+
+import pytest
+
+import ckanext.datacite_publication.payload as payload
+
+RECORD = u'''<?xml version="1.0" encoding="UTF-8"?>
+<resource xmlns="http://datacite.org/schema/kernel-4">
+  <identifier identifierType="DOI">10.5072/envidat.1</identifier>
+  <titles>
+    <title xml:lang="en">Snow depth, Davos été – {0}</title>
+  </titles>
+  <descriptions>
+    <description descriptionType="Abstract">First line
+      second line	with a tab</description>
+  </descriptions>
+</resource>
+'''
+
+
+def _get_xml(records=1):
+    return u''.join(RECORD.format(i) for i in range(records))
+
+
+def _normalize(xml):
+    # non-chunked reference
+    return b'><'.join(payload._FORMATTING_WHITESPACE.split(xml.encode('utf-8')))
+
+
+def test_formatting_whitespace_removed():
+    normalized = payload.normalize_xml(_get_xml())
+    assert b'>\n ' not in normalized and b'>\n<' not in normalized
+    assert b'<titles><title xml:lang="en">' in normalized
+    # text content is kept as is
+    assert b'First line\n      second line\twith a tab' in normalized
+
+
+@pytest.mark.parametrize('chunk_size', [128, 200, 333, 1000, 4096])
+def test_chunks_match_non_chunked(chunk_size):
+    xml = _get_xml(50)
+    expected = _normalize(xml)
+    assert b''.join(payload.iter_normalized_xml(xml, chunk_size)) == expected
+    assert b''.join(payload.iter_normalized_xml(xml.encode('utf-8'), chunk_size)) == expected
+
+
+def test_chunks_are_cut_after_a_tag_start():
+    chunks = list(payload.iter_normalized_xml(_get_xml(50), 256))
+    assert len(chunks) > 1
+    assert all(chunk.endswith(b'<') for chunk in chunks[:-1])
+
+
+@pytest.mark.parametrize('chunk_sizes', [[1], [2, 5], [3, 3, 7], [1000]])
+def test_base64_chunks_match_non_chunked(chunk_sizes):
+    data = _get_xml(10).encode('utf-8')
+    chunks = []
+    start = 0
+    i = 0
+    while start < len(data):
+        size = chunk_sizes[i % len(chunk_sizes)]
+        chunks.append(data[start:start + size])
+        start += size
+        i += 1
+    assert b''.join(payload.iter_base64(chunks)) == base64.b64encode(data)
+
+
+@pytest.mark.parametrize('update', [False, True])
+def test_build_payload(update):
+    # larger than a chunk
+    xml = _get_xml(payload.CHUNK_SIZE // len(RECORD) + 10)
+    body = payload.build_payload('10.5072/envidat.1 ', 'https://envidat.ch/dataset/snow', xml, update=update)
+    assert isinstance(body, bytes)
+
+    data = json.loads(body.decode('utf-8'))['data']
+    assert data['id'] == '10.5072/envidat.1'
+    assert data['type'] == 'dois'
+    attributes = data['attributes']
+    assert attributes['event'] == ('' if update else 'publish')
+    assert attributes['url'] == 'https://envidat.ch/dataset/snow'
+    assert base64.b64decode(attributes['xml']) == _normalize(xml)
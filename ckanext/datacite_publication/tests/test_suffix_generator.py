@@ -0,0 +1,66 @@
+"""Tests for suffix_generator.py."""
+import time
+
+import pytest
+
+import ckanext.datacite_publication.suffix_generator as suffix_generator
+
+
+def test_ulids_are_valid():
+    for suffix in suffix_generator.generate_ulids(100):
+        assert len(suffix) == suffix_generator.TIME_LENGTH + suffix_generator.RANDOM_LENGTH + 1
+        assert suffix_generator.is_valid_suffix(suffix)
+
+
+def test_ulids_are_ordered():
+    suffixes = suffix_generator.generate_ulids(1000) + suffix_generator.generate_ulids(1000)
+    assert suffixes == sorted(suffixes)
+    assert len(set(suffixes)) == len(suffixes)
+
+
+def test_ulid_timestamp():
+    before = time.time()
+    suffix = suffix_generator.generate_ulids(1)[0]
+    # the milliseconds may have been borrowed by the previous calls
+    assert before - 1 <= suffix_generator.get_timestamp(suffix) <= time.time() + 1
+
+
+def test_checksum_detects_single_mistyped_character():
+    suffix = suffix_generator.generate_ulids(1)[0]
+    for i, char in enumerate(suffix):
+        for other in suffix_generator.ALPHABET:
+            if other != char:
+                assert not suffix_generator.is_valid_suffix(suffix[:i] + other + suffix[i + 1:])
+
+
+def test_checksum_detects_adjacent_swaps():
+    suffix = suffix_generator.generate_ulids(1)[0]
+    for i in range(len(suffix) - 1):
+        if suffix[i] != suffix[i + 1]:
+            swapped = suffix[:i] + suffix[i + 1] + suffix[i] + suffix[i + 2:]
+            assert not suffix_generator.is_valid_suffix(swapped)
+
+
+def test_checksum_is_case_insensitive():
+    suffix = suffix_generator.generate_ulids(1)[0]
+    assert suffix_generator.is_valid_suffix(suffix.upper())
+
+
+def test_valid_suffix_with_tag():
+    suffix = suffix_generator.generate_ulids(1)[0]
+    assert suffix_generator.is_valid_suffix('envidat.' + suffix, 'envidat.')
+    # the tag is optional
+    assert suffix_generator.is_valid_suffix(suffix, 'envidat.')
+    assert not suffix_generator.is_valid_suffix('envidat.' + suffix)
+
+
+@pytest.mark.parametrize('suffix', ['', 'a', 'not-base32!', 'envidat.1'])
+def test_invalid_suffixes(suffix):
+    assert not suffix_generator.is_valid_suffix(suffix)
+
+
+def test_generate_suffixes():
+    assert len(suffix_generator.generate_suffixes(3, 'uuid')) == 3
+    assert all(suffix_generator.is_valid_suffix(suffix) for suffix in suffix_generator.generate_suffixes(3, 'ulid'))
+    with pytest.raises(ValueError):
+        suffix_generator.generate_suffixes(1, 'sequence')
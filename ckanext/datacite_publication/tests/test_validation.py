@@ -0,0 +1,76 @@
+"""Tests for validation.py."""
+import pytest
+
+import ckanext.datacite_publication.validation as validation
+
+XSD = b'''<?xml version="1.0" encoding="UTF-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+  <xs:element name="resource">
+    <xs:complexType>
+      <xs:sequence>
+        <xs:element name="title" type="xs:string"/>
+        <xs:element name="publicationYear" type="xs:gYear"/>
+      </xs:sequence>
+    </xs:complexType>
+  </xs:element>
+</xs:schema>
+'''
+
+
+def _record(year):
+    return '<resource><title>Dataset</title><publicationYear>{0}</publicationYear></resource>'.format(year)
+
+
+@pytest.fixture
+def xsd(tmp_path, ckan_config, monkeypatch):
+    monkeypatch.setattr(validation, '_schemas', {})
+    location = str(tmp_path / 'metadata.xsd')
+    with open(location, 'wb') as xsd_file:
+        xsd_file.write(XSD)
+    monkeypatch.setitem(ckan_config, 'datacite_publication.xsd.datacite', location)
+    return location
+
+
+class TestValidateXml(object):
+
+    def test_valid(self, xsd):
+        assert validation.validate_xml(_record(2026)) == (True, [])
+        assert validation.validate_xml(_record(2026).encode('utf-8')) == (True, [])
+
+    def test_invalid(self, xsd):
+        valid, errors = validation.validate_xml(_record('last year'))
+        assert not valid
+        assert 'publicationYear' in errors[0]
+
+    def test_not_xml(self, xsd):
+        assert validation.validate_xml('') == (False, ['Empty XML record'])
+        valid, errors = validation.validate_xml('<resource>')
+        assert not valid
+        assert errors[0].startswith('XML syntax error')
+
+    def test_compiled_once(self, xsd):
+        schema = validation.get_schema()
+        assert validation.get_schema() is schema
+        validation.invalidate_schemas()
+        assert validation.get_schema() is not schema
+
+    def test_schema_not_found(self, xsd, tmp_path):
+        with pytest.raises(validation.SchemaLoadError):
+            validation.get_schema_at(str(tmp_path / 'missing.xsd'))
+
+
+class TestIterValidate(object):
+
+    @pytest.mark.parametrize('processes', [1, 2])
+    def test_in_order(self, xsd, processes):
+        records = [(i, _record(2000 + i if i % 3 else 'unknown')) for i in range(20)]
+        results = list(validation.iter_validate(iter(records), processes=processes))
+        assert [key for key, valid, errors in results] == list(range(20))
+        assert [valid for key, valid, errors in results] == [bool(i % 3) for i in range(20)]
+        assert all(errors for key, valid, errors in results if not valid)
+
+    def test_schema_error_in_worker(self, xsd, monkeypatch):
+        # a worker that could not get the schema reports it for each of its records
+        monkeypatch.setattr(validation, '_worker_schema', None)
+        monkeypatch.setattr(validation, '_worker_error', 'Could not load the XML schema')
+        assert validation._validate_in_worker(_record(2026)) == (False, ['Could not load the XML schema'])
@@ -0,0 +1,175 @@
+import collections
+import multiprocessing
+import os
+import threading
+import time
+
+import requests
+from lxml import etree
+
+from ckantoolkit import config, asint
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# process-wide cache of the compiled XML schemas, keyed by XSD location (url or path)
+_schemas = {}
+_schemas_lock = threading.Lock()
+
+
+class SchemaLoadError(Exception):
+    pass
+
+
+class _HTTPResolver(etree.Resolver):
+    # lxml does not fetch https, the included and imported XSDs are downloaded with requests
+    def resolve(self, url, pubid, context):
+        if url.startswith('http://') or url.startswith('https://'):
+            response = requests.get(url, timeout=30)
+            response.raise_for_status()
+            return self.resolve_string(response.content, context, base_url=url)
+        return None
+
+
+class CachedSchema(object):
+    """Compiled XML schema, validations are serialized as the schema keeps the errors of the last one"""
+
+    def __init__(self, location, schema):
+        self.location = location
+        self.schema = schema
+        self.loaded = time.time()
+        self.lock = threading.Lock()
+
+    def validate(self, xml):
+        """Returns (valid, errors) for an XML string or bytes"""
+        if not xml:
+            return False, ['Empty XML record']
+        if isinstance(xml, str):
+            xml = xml.encode('utf-8')
+        try:
+            doc = etree.fromstring(xml)
+        except etree.XMLSyntaxError as e:
+            return False, ['XML syntax error: {0}'.format(e)]
+        with self.lock:
+            valid = self.schema.validate(doc)
+            errors = ['line {0}: {1}'.format(error.line, error.message) for error in self.schema.error_log]
+        return valid, errors
+
+
+def load_schema(location):
+    """Downloads (or reads) and compiles the XSD at location, including its imports"""
+    parser = etree.XMLParser()
+    parser.resolvers.add(_HTTPResolver())
+    start = time.perf_counter()
+    try:
+        if location.startswith('http://') or location.startswith('https://'):
+            response = requests.get(location, timeout=30)
+            response.raise_for_status()
+            xsd_doc = etree.fromstring(response.content, parser, base_url=location)
+        else:
+            xsd_doc = etree.parse(location, parser)
+        schema = etree.XMLSchema(xsd_doc)
+    except (requests.exceptions.RequestException, etree.LxmlError, IOError) as e:
+        raise SchemaLoadError('Could not load the XML schema {0}: {1}'.format(location, e))
+    log.info('Compiled XML schema {0} in {1:.2f}s'.format(location, time.perf_counter() - start))
+    return schema
+
+
+def get_schema_location(metadata_format='datacite'):
+    """XSD of the metadata format: datacite_publication.xsd.<format> (url or path) or the package converter one"""
+    location = config.get('datacite_publication.xsd.{0}'.format(metadata_format), '')
+    if location:
+        return location
+    from ckanext.package_converter.model.metadata_format import MetadataFormats
+    try:
+        return MetadataFormats().get_metadata_formats(metadata_format)[0].get_xsd_url()
+    except (IndexError, AttributeError) as e:
+        raise SchemaLoadError('No XML schema for the metadata format {0}: {1}'.format(metadata_format, e))
+
+
+def get_schema(metadata_format='datacite'):
+    """Returns the compiled schema of the metadata format, compiled once per process"""
+    return get_schema_at(get_schema_location(metadata_format))
+
+
+def get_schema_at(location):
+    """Returns the compiled schema of the XSD at location, compiled once per process"""
+    # optionally compiled again after max_age seconds, to pick up a changed XSD
+    max_age = asint(config.get('datacite_publication.xsd.max_age', 0))
+    cached_schema = _schemas.get(location)
+    if cached_schema is None or (max_age and time.time() - cached_schema.loaded > max_age):
+        with _schemas_lock:
+            cached_schema = _schemas.get(location)
+            if cached_schema is None or (max_age and time.time() - cached_schema.loaded > max_age):
+                cached_schema = CachedSchema(location, load_schema(location))
+                _schemas[location] = cached_schema
+    return cached_schema
+
+
+def invalidate_schemas(location=None):
+    """Drops the compiled schema at location, or all of them, they are compiled again on next use"""
+    with _schemas_lock:
+        if location:
+            _schemas.pop(location, None)
+        else:
+            _schemas.clear()
+    log.info('Invalidated the cached XML schemas {0}'.format(location or '(all)'))
+
+
+def validate_xml(xml, metadata_format='datacite'):
+    """Validates XML against the cached schema of the metadata format, returns (valid, errors)"""
+    return get_schema(metadata_format).validate(xml)
+
+
+# schema of a validation worker process
+_worker_schema = None
+_worker_error = None
+
+
+def _init_worker(location):
+    global _worker_schema, _worker_error
+    try:
+        # a forked worker gets the schema compiled by the parent, with a lock of its own
+        _worker_schema = CachedSchema(location, get_schema_at(location).schema)
+    except Exception as e:
+        # not raised, the pool would start new workers failing the same way
+        _worker_error = str(e)
+
+
+def _validate_in_worker(xml):
+    if _worker_schema is None:
+        return False, [_worker_error]
+    try:
+        return _worker_schema.validate(xml)
+    except Exception as e:
+        return False, ['Exception validating the record: {0}'.format(e)]
+
+
+def iter_validate(records, metadata_format='datacite', processes=None):
+    """Validates (key, xml) records in a pool of processes, each one with its own compiled schema.
+       Yields (key, valid, errors) in the order of the records, the records are consumed as the
+       results come back (at most a few per process in flight).
+    """
+    location = get_schema_location(metadata_format)
+    processes = processes or asint(config.get('datacite_publication.validation.processes', 0)) or os.cpu_count()
+    # compiled once here, inherited by the forked workers
+    schema = get_schema_at(location)
+
+    if processes == 1:
+        for key, xml in records:
+            valid, errors = schema.validate(xml)
+            yield key, valid, errors
+        return
+
+    window = processes * 4
+    with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(location,)) as pool:
+        pending = collections.deque()
+        for key, xml in records:
+            pending.append((key, pool.apply_async(_validate_in_worker, (xml,))))
+            if len(pending) >= window:
+                key, result = pending.popleft()
+                yield (key,) + tuple(result.get())
+        while pending:
+            key, result = pending.popleft()
+            yield (key,) + tuple(result.get())